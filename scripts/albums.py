@@ -0,0 +1,213 @@
+"""Telegram albums (grouped messages) and their sampling policy.
+
+Ingest keeps only a sample of each album (by default the 1st, 4th, 7th and
+10th photo).  Every album is recorded in ``albums`` with the policy that
+sampled it, and every member message in ``album_members`` with its position
+in the album and whether it was sampled.  Retention, "show the whole album"
+and per-channel policies are then indexed queries, instead of group keys
+parsed back out of file names (which broke on channel names containing
+``_``) over a full directory listing.
+
+A member's image is the ``images`` row with the same channel and message ID.
+Libraries from before this table are backfilled once from ``images``: albums
+with more than four files on disk were downloaded in full and get the
+default policy; smaller ones were already sampled and are kept whole
+(``legacy``).
+
+Config:
+  "telegram": {"sampling": {"step": 3, "max": 4},
+               "channel_overrides": {"some_channel": {"sampling": {"step": 1, "max": 0}}}}
+  (step 1 / max 0 keeps whole albums)
+
+Usage:
+  python albums.py show <file_name>
+  python albums.py backfill
+"""
+
+import os
+import sys
+from collections import namedtuple
+
+LEGACY = 'legacy'
+LEGACY_WHOLE = 4  # the old cleanup rule never thinned groups of up to this many files
+
+INSERT_ALBUM = '''INSERT INTO albums (channel, grouped_id, size, policy, first_id, captured_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(channel, grouped_id) DO UPDATE SET size = MAX(size, excluded.size), policy = excluded.policy'''
+INSERT_MEMBER = ("INSERT OR REPLACE INTO album_members (channel, grouped_id, msg_id, position, sampled) "
+                 "VALUES (?, ?, ?, ?, ?)")
+
+
+class SamplingPolicy(namedtuple('SamplingPolicy', 'step limit')):
+    """Keep every ``step``-th photo of an album, at most ``limit`` of them (0 = no limit)."""
+
+    def positions(self, size: int):
+        picked = list(range(0, size, self.step))
+        return picked[:self.limit] if self.limit else picked
+
+    @property
+    def signature(self) -> str:
+        return f"step={self.step},max={self.limit}"
+
+
+DEFAULT_POLICY = SamplingPolicy(3, 4)
+
+
+def _policy(conf, default: SamplingPolicy = DEFAULT_POLICY) -> SamplingPolicy:
+    if not conf:
+        return default
+    return SamplingPolicy(max(1, int(conf.get('step', default.step))), max(0, int(conf.get('max', default.limit))))
+
+
+class AlbumSampling:
+    """The sampling policy of each channel."""
+
+    def __init__(self, default: SamplingPolicy = DEFAULT_POLICY, overrides: dict = None):
+        self.default = default
+        self.overrides = overrides or {}
+
+    def for_channel(self, channel: str) -> SamplingPolicy:
+        return self.overrides.get(channel, self.default)
+
+
+def sampling_from_config(cfg: dict) -> AlbumSampling:
+    tg = cfg.get('telegram', {})
+    default = _policy(tg.get('sampling'))
+    overrides = {ch: _policy(o['sampling'], default)
+                 for ch, o in (tg.get('channel_overrides') or {}).items() if o.get('sampling')}
+    return AlbumSampling(default, overrides)
+
+
+def record_album(db, channel: str, grouped_id, messages, picked, policy: SamplingPolicy):
+    """Buffer an album (``messages`` sorted by ID) and which positions ``policy`` picked."""
+    grouped_id = str(grouped_id)
+    picked = set(picked)
+    db.queue(INSERT_ALBUM, (channel, grouped_id, len(messages), policy.signature, messages[0].id,
+                            int(messages[0].date.timestamp())))
+    for pos, message in enumerate(messages):
+        db.queue(INSERT_MEMBER, (channel, grouped_id, int(message.id), pos, int(pos in picked)))
+
+
+def _parse_member(channel: str, file_name: str):
+    """(grouped_id, msg_id) from photo_<channel>_<date>_<time>_<group>_<id>.jpg, or None for singles."""
+    base = os.path.splitext(os.path.basename(file_name))[0]
+    prefix = f"photo_{channel}_"
+    if not base.startswith(prefix):
+        return None
+    parts = base[len(prefix):].split('_')
+    if len(parts) != 4 or parts[2].startswith('S'):
+        return None
+    try:
+        return parts[2], int(parts[3])
+    except ValueError:
+        return None
+
+
+def backfill(db) -> int:
+    """Derive albums from the ``images`` rows of libraries ingested before album tracking; returns albums added."""
+    if db.get_meta('albums_backfilled'):
+        return 0
+    db.flush()
+    conn = db.conn
+    known = {(r[0], r[1]) for r in conn.execute("SELECT channel, grouped_id FROM albums")}
+    groups = {}
+    for channel, file_name, ts in conn.execute("SELECT channel, file_name, timestamp FROM images "
+                                               "WHERE channel IS NOT NULL AND channel != ''"):
+        parsed = _parse_member(channel, file_name)
+        if parsed and (channel, parsed[0]) not in known:
+            groups.setdefault((channel, parsed[0]), []).append((parsed[1], ts))
+    albums, members = [], []
+    for (channel, grouped_id), rows in groups.items():
+        rows.sort()
+        if len(rows) > LEGACY_WHOLE:
+            policy, picked = DEFAULT_POLICY.signature, set(DEFAULT_POLICY.positions(len(rows)))
+        else:
+            policy, picked = LEGACY, set(range(len(rows)))
+        albums.append((channel, grouped_id, len(rows), policy, rows[0][0], rows[0][1]))
+        members.extend((channel, grouped_id, msg_id, pos, int(pos in picked)) for pos, (msg_id, _) in enumerate(rows))
+    with db.transaction() as c:
+        c.executemany(INSERT_ALBUM, albums)
+        c.executemany(INSERT_MEMBER, members)
+    db.set_meta('albums_backfilled', len(albums))
+    if albums:
+        print(f"🗂️  albums backfilled from existing images: {len(albums)}")
+    return len(albums)
+
+
+def resample(conn, sampling: AlbumSampling, dry_run: bool = False):
+    """Re-apply the configured policies to albums sampled under another one.
+
+    Returns the changes as ``(channel, grouped_id, picked_positions)``; with
+    ``dry_run`` they are only returned, not written.  ``legacy`` albums are
+    left alone: their original member positions are unknown.
+    """
+    changes = []
+    for channel, grouped_id, size, signature in conn.execute(
+            "SELECT channel, grouped_id, size, policy FROM albums WHERE policy != ?", (LEGACY,)).fetchall():
+        policy = sampling.for_channel(channel)
+        if policy.signature != signature:
+            changes.append((channel, grouped_id, policy.positions(size), policy.signature))
+    if not dry_run and changes:
+        with conn:
+            for channel, grouped_id, picked, signature in changes:
+                marks = ','.join('?' * len(picked)) or '-1'
+                conn.execute(f"UPDATE album_members SET sampled = (position IN ({marks})) "
+                             f"WHERE channel = ? AND grouped_id = ?", (*picked, channel, grouped_id))
+                conn.execute("UPDATE albums SET policy = ? WHERE channel = ? AND grouped_id = ?",
+                             (signature, channel, grouped_id))
+    return [c[:3] for c in changes]
+
+
+def unsampled_files(conn, pending=()):
+    """File names of stored images whose album position is not sampled.
+
+    ``pending`` are unwritten ``resample`` changes (a dry run), applied on the fly.
+    """
+    pending = {(ch, g): set(picked) for ch, g, picked in pending}
+    names = [name for ch, g, name in conn.execute('''SELECT m.channel, m.grouped_id, i.file_name
+        FROM album_members m JOIN images i ON i.channel = m.channel AND i.id = CAST(m.msg_id AS TEXT)
+        WHERE m.sampled = 0''') if (ch, g) not in pending]
+    for (ch, g), picked in pending.items():
+        names.extend(name for pos, name in conn.execute('''SELECT m.position, i.file_name FROM album_members m
+            JOIN images i ON i.channel = m.channel AND i.id = CAST(m.msg_id AS TEXT)
+            WHERE m.channel = ? AND m.grouped_id = ?''', (ch, g)) if pos not in picked)
+    return names
+
+
+def album_of(conn, file_name: str):
+    """Every member of ``file_name``'s album as (position, msg_id, sampled, file_name or None); [] for singles."""
+    row = conn.execute('''SELECT m.channel, m.grouped_id FROM images i
+        JOIN album_members m ON m.channel = i.channel AND m.msg_id = CAST(i.id AS INTEGER)
+        WHERE i.file_name = ?''', (file_name,)).fetchone()
+    if row is None:
+        return []
+    return conn.execute('''SELECT m.position, m.msg_id, m.sampled, i.file_name FROM album_members m
+        LEFT JOIN images i ON i.channel = m.channel AND i.id = CAST(m.msg_id AS TEXT)
+        WHERE m.channel = ? AND m.grouped_id = ? ORDER BY m.position, m.msg_id''', row).fetchall()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from config import config_path, load_config
+    from storage import GalleryDB
+
+    cfg = load_config()
+
+    parser = argparse.ArgumentParser(description='Telegram albums recorded at ingest')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    show = sub.add_parser('show', help='list every member of the album a file belongs to')
+    show.add_argument('file_name', help='path relative to the gallery dir, as stored in images.file_name')
+    sub.add_parser('backfill', help='derive albums from images ingested before album tracking')
+    args = parser.parse_args()
+
+    with GalleryDB(config_path('db_path', cfg)) as db:
+        db.ensure_schema()
+        backfill(db)
+        if args.cmd == 'show':
+            members = album_of(db.conn, args.file_name)
+            if not members:
+                print(f"ℹ️  {args.file_name} is not part of a recorded album")
+                sys.exit(1)
+            for pos, msg_id, sampled, name in members:
+                print(f"  {pos:>3}  {msg_id:>10}  {'sampled' if sampled else '       '}  {name or '-'}")
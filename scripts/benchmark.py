@@ -0,0 +1,439 @@
+"""Reproducible benchmarks for the ingest and maintenance scripts.
+
+Builds a synthetic workspace (gallery directory, gallery.db and a config
+pointing at both), then times each stage in a fresh process so that peak
+RSS is per stage:
+
+  generate   synthetic library: N files in both naming schemes, albums of
+             1-10 photos, matching DB rows (a fraction left unsynced), a
+             few dead rows and orphan thumbnails
+  migrate    migrate_db.migrate_and_init (schema upgrade + metadata backfill)
+  sync       sync_to_db.sync_existing_files(full=True)
+  ingest     main.process_channel over stub_client.FakeTelegramClient, which
+             serves canned photo bytes with configurable latency
+  thumbs     renditions.render_image on a sample of full-size photos
+  manifests  manifests.build_from_config
+  sitemap    generate_sitemap.generate_sitemap
+  cleanup    cleanup_library.deep_clean_and_limit
+  startup    `pencilai.py COMMAND --help` for every command, each in a fresh
+             interpreter: import and config cost of one CLI invocation
+
+Results are JSON (one object per stage: seconds, items, throughput, p50/p99
+per-item latency where items are timed individually, peak RSS of the stage
+and of its worker processes) tagged with the git commit, so runs can be
+compared across commits.
+
+Usage:
+  python benchmark.py run --files 10000 --out base.json
+  python benchmark.py run --files 100000 --stages sync,cleanup
+  python benchmark.py run --stages startup --startup-runs 10
+  python benchmark.py compare base.json head.json
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import random
+import shutil
+import asyncio
+import platform
+import resource
+import datetime
+import tempfile
+import subprocess
+import traceback
+import contextlib
+import multiprocessing
+
+from stub_client import EPOCH, FakeTelegramClient, album_ids, jpeg_bytes
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STAGES = ['generate', 'migrate', 'sync', 'ingest', 'thumbs', 'manifests', 'sitemap', 'cleanup', 'startup']
+
+
+# ---------- synthetic data ----------
+
+def _photo_name(channel: str, msg_id: int, group: str) -> str:
+    ts = EPOCH + datetime.timedelta(seconds=msg_id * 37)
+    return f"photo_{channel}_{ts.strftime('%Y-%m-%d_%H-%M-%S')}_{group}_{msg_id}.jpg"
+
+
+def _legacy_name(msg_id: int) -> str:
+    ts = EPOCH + datetime.timedelta(seconds=msg_id * 37)
+    return f"photo_{ts.strftime('%Y-%m-%d_%H-%M-%S')}_{msg_id}.jpg"
+
+
+def generate_library(ws: dict, files: int, channels: int, legacy_ratio: float, unsynced: float, seed: int):
+    from storage import GalleryDB
+
+    rng = random.Random(seed)
+    gallery = ws['gallery']
+    os.makedirs(gallery, exist_ok=True)
+    canned = [jpeg_bytes(64, 48, seed + i) for i in range(8)]
+    db = GalleryDB(ws['db'], batch_size=5000)
+    db.ensure_schema()
+
+    legacy = int(files * legacy_ratio)
+    per_channel = max(1, (files - legacy) // max(1, channels))
+    written = 0
+    for c in range(channels):
+        channel = f"bench{c}"
+        for msg_id, group in album_ids(rng, per_channel, 1):
+            name = _photo_name(channel, msg_id, group)
+            with open(os.path.join(gallery, name), 'wb') as f:
+                f.write(canned[msg_id % len(canned)])
+            if rng.random() >= unsynced:
+                db.mark_seen(channel, msg_id)
+                db.add_image(msg_id, channel, (EPOCH.timestamp() + msg_id * 37), name, 1)
+            written += 1
+    for i in range(legacy):
+        msg_id = 10_000_000 + i
+        name = _legacy_name(msg_id)
+        with open(os.path.join(gallery, name), 'wb') as f:
+            f.write(canned[i % len(canned)])
+        if rng.random() >= unsynced:
+            db.add_image(msg_id, 'Legacy', int(EPOCH.timestamp()) + msg_id, name, 1)
+        written += 1
+
+    # Work for cleanup: rows whose file is gone, thumbnails whose original is gone.
+    for i in range(max(1, files // 1000)):
+        db.add_image(20_000_000 + i, 'bench0', int(EPOCH.timestamp()), f"photo_gone_{i}.jpg", 1)
+        with open(os.path.join(gallery, f"photo_orphan_{i}_thumb.webp"), 'wb') as f:
+            f.write(b'RIFF')
+    db.close()
+    return written
+
+
+def write_config(ws: dict, workers: int):
+    cfg = {
+        'telegram': {'channels': [], 'download_workers': workers},
+        'paths': {
+            'tg_gallery_dir': ws['gallery'],
+            'db_path': ws['db'],
+            'manifest_dir': ws['manifests'],
+            'timer_config': os.path.join(ws['root'], 'timer_config.json'),
+        },
+    }
+    with open(ws['config'], 'w', encoding='utf-8') as f:
+        json.dump(cfg, f, indent=2)
+
+
+# ---------- stages (each runs in its own process) ----------
+
+def _stage_generate(ws, opts):
+    n = generate_library(ws, opts['files'], opts['channels'], opts['legacy_ratio'], opts['unsynced'], opts['seed'])
+    return {'items': n}
+
+
+def _stage_migrate(ws, opts):
+    import migrate_db
+
+    migrate_db.migrate_and_init()
+    return {'items': opts['files']}
+
+
+def _stage_sync(ws, opts):
+    import sync_to_db
+
+    added = sync_to_db.sync_existing_files(full=True) or 0
+    return {'items': opts['files'], 'extra': {'added': added}}
+
+
+def _stage_ingest(ws, opts):
+    import main
+    from storage import GalleryDB
+
+    payload = jpeg_bytes(320, 240, opts['seed'])
+    latencies = []
+
+    class TimedPipeline(main.IngestPipeline):
+        async def _download(self, message, channel_name, group_id):
+            started = time.perf_counter()
+            try:
+                return await super()._download(message, channel_name, group_id)
+            finally:
+                latencies.append(time.perf_counter() - started)
+
+    os.makedirs(ws['gallery'], exist_ok=True)
+
+    async def run():
+        client = FakeTelegramClient(opts['messages'], opts['latency_ms'] / 1000, opts['jitter_ms'] / 1000,
+                                    payload, opts['seed'])
+        db = GalleryDB(ws['db'])
+        db.ensure_schema()
+        pipeline = TimedPipeline(client, int(time.time()), ws['gallery'], db, workers=opts['workers'], per_channel=2)
+        pipeline.start()
+        slots = asyncio.Semaphore(3)
+
+        async def scan(ch):
+            async with slots:
+                await main.process_channel(pipeline, ch, opts['messages'])
+
+        try:
+            await asyncio.gather(*(scan(f"live{c}") for c in range(opts['channels'])))
+        finally:
+            await pipeline.stop()
+            db.close()
+        return client.downloaded_bytes
+
+    downloaded = asyncio.run(run())
+    return {'items': len(latencies), 'latencies': latencies, 'bytes': downloaded}
+
+
+def _timed_render(args):
+    path, spec = args
+    from renditions import render_image
+
+    started = time.perf_counter()
+    render_image(path, spec)
+    return time.perf_counter() - started
+
+
+def _stage_thumbs(ws, opts):
+    from concurrent.futures import ProcessPoolExecutor
+    from renditions import spec_from_config
+
+    sample_dir = os.path.join(ws['root'], 'thumb_sample')
+    os.makedirs(sample_dir, exist_ok=True)
+    payloads = [jpeg_bytes(2400, 1800, opts['seed'] + i) for i in range(4)]
+    paths = []
+    for i in range(opts['thumb_sample']):
+        path = os.path.join(sample_dir, f"photo_sample_2024-01-01_00-00-00_S{i}_{i}.jpg")
+        with open(path, 'wb') as f:
+            f.write(payloads[i % len(payloads)])
+        paths.append(path)
+    spec = spec_from_config({})
+    with ProcessPoolExecutor(max_workers=opts['workers']) as pool:
+        latencies = list(pool.map(_timed_render, [(p, spec) for p in paths]))
+    return {'items': len(paths), 'latencies': latencies}
+
+
+def _stage_manifests(ws, opts):
+    import manifests
+    from config import load_config
+
+    index = manifests.build_from_config(load_config())
+    return {'items': index['total']}
+
+
+def _stage_sitemap(ws, opts):
+    import generate_sitemap
+
+    generate_sitemap.generate_sitemap()
+    return {'items': opts['files']}
+
+
+def _stage_cleanup(ws, opts):
+    import cleanup_library
+
+    stats = cleanup_library.deep_clean_and_limit() or {}
+    return {'items': opts['files'], 'extra': stats}
+
+
+def _stage_startup(ws, opts):
+    from pencilai import COMMANDS
+
+    # --help stops each command at argparse, after its imports and config lookups.
+    script = os.path.join(BASE_DIR, 'pencilai.py')
+    latencies, best = [], {}
+    for name in COMMANDS:
+        samples = []
+        for _ in range(opts['startup_runs']):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, script, name, '--help'], stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL, check=True)
+            samples.append(time.perf_counter() - started)
+        latencies += samples
+        best[name] = round(min(samples) * 1000, 1)
+    return {'items': len(latencies), 'latencies': latencies, 'extra': best}
+
+
+def _run_stage(name, ws, opts, out):
+    sys.path.insert(0, BASE_DIR)
+    started = time.perf_counter()
+    cpu = time.process_time()
+    sink = sys.stdout if opts['verbose'] else open(os.devnull, 'w')
+    try:
+        with contextlib.redirect_stdout(sink):
+            result = globals()[f"_stage_{name}"](ws, opts)
+    except BaseException:
+        # Always answer the parent, which is blocked on the queue.
+        out.put({'error': traceback.format_exc()})
+        raise
+    result['seconds'] = time.perf_counter() - started
+    result['cpu_seconds'] = time.process_time() - cpu
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['children_peak_rss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    out.put(result)
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run_stage(name: str, ws: dict, opts: dict) -> dict:
+    ctx = multiprocessing.get_context('spawn')
+    out = ctx.Queue()
+    proc = ctx.Process(target=_run_stage, args=(name, ws, opts, out))
+    proc.start()
+    while True:
+        try:
+            result = out.get(timeout=1)
+            break
+        except queue.Empty:
+            if not proc.is_alive():
+                # Killed without a word (e.g. by the OOM killer).
+                raise RuntimeError(f"stage {name} died with exit code {proc.exitcode}")
+    proc.join()
+    if 'error' in result:
+        raise RuntimeError(f"stage {name} failed:\n{result['error']}")
+    latencies = result.pop('latencies', [])
+    seconds = result['seconds']
+    return {
+        'stage': name,
+        'items': result['items'],
+        'seconds': round(seconds, 4),
+        'cpu_seconds': round(result['cpu_seconds'], 4),
+        'throughput_per_s': round(result['items'] / seconds, 2) if seconds > 0 else None,
+        'p50_ms': round(_percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        'p99_ms': round(_percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        'peak_rss_kb': result['peak_rss_kb'],
+        'children_peak_rss_kb': result['children_peak_rss_kb'],
+        **({'bytes': result['bytes']} if 'bytes' in result else {}),
+        **({'extra': result['extra']} if result.get('extra') else {}),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(opts: dict, stages, workdir: str = None, keep: bool = False):
+    root = workdir or tempfile.mkdtemp(prefix='pencilai-bench-')
+    if 'generate' in stages and os.path.exists(root) and os.listdir(root):
+        shutil.rmtree(root)
+    os.makedirs(root, exist_ok=True)
+    ws = {
+        'root': root,
+        'gallery': os.path.join(root, 'tg_gallery'),
+        'db': os.path.join(root, 'gallery.db'),
+        'manifests': os.path.join(root, 'manifests'),
+        'config': os.path.join(root, 'config.json'),
+    }
+    write_config(ws, opts['workers'])
+    # Every script resolves its paths from here; the stage processes inherit it.
+    os.environ['PENCILAI_CONFIG'] = ws['config']
+    os.environ['PENCILAI_GALLERY_DB'] = ws['db']
+    os.environ['PENCILAI_SITEMAP_PATH'] = os.path.join(root, 'sitemap_gallery.xml')
+    os.environ['PENCILAI_BASE_URL'] = 'http://bench.local/'
+
+    results = []
+    try:
+        for name in stages:
+            r = run_stage(name, ws, opts)
+            results.append(r)
+            lat = f", p50 {r['p50_ms']}ms p99 {r['p99_ms']}ms" if r['p50_ms'] is not None else ''
+            print(f"⏱️  {name:<10} {r['seconds']:>9.3f}s  {r['items']:>9} items  "
+                  f"{r['throughput_per_s'] or 0:>10.1f}/s{lat}  rss {r['peak_rss_kb'] // 1024}MB")
+    finally:
+        if not keep and not workdir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    return {
+        'commit': _git_commit(),
+        'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'params': {k: v for k, v in opts.items() if k != 'verbose'},
+        'stages': results,
+    }
+
+
+def compare(base: dict, head: dict):
+    """Print per-stage changes between two result files (head relative to base)."""
+    print(f"base {base.get('commit')}  ->  head {head.get('commit')}")
+    before = {s['stage']: s for s in base['stages']}
+    for s in head['stages']:
+        b = before.get(s['stage'])
+        if b is None:
+            continue
+        parts = [f"{s['stage']:<10}", f"time {b['seconds']:.3f}s -> {s['seconds']:.3f}s"]
+        if b['seconds']:
+            parts.append(f"({(s['seconds'] / b['seconds'] - 1) * 100:+.1f}%)")
+        if b.get('p99_ms') and s.get('p99_ms'):
+            parts.append(f"p99 {b['p99_ms']}ms -> {s['p99_ms']}ms")
+        parts.append(f"rss {b['peak_rss_kb'] // 1024}MB -> {s['peak_rss_kb'] // 1024}MB")
+        print('  '.join(parts))
+        if s['stage'] == 'startup':
+            # Best-of-N milliseconds per command.
+            for name, ms in s.get('extra', {}).items():
+                if name in b.get('extra', {}):
+                    print(f"    {name:<13} {b['extra'][name]}ms -> {ms}ms")
+    if base.get('params') != head.get('params'):
+        print("⚠️  parameters differ between the two runs; numbers are not directly comparable")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the gallery scripts on a synthetic library')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+
+    p_run = sub.add_parser('run')
+    p_run.add_argument('--files', type=int, default=10000, help='synthetic library size (e.g. 10000/100000/1000000)')
+    p_run.add_argument('--channels', type=int, default=4)
+    p_run.add_argument('--legacy-ratio', type=float, default=0.2, help='share of files using the legacy naming')
+    p_run.add_argument('--unsynced', type=float, default=0.1, help='share of files without a DB row')
+    p_run.add_argument('--messages', type=int, default=500, help='stub messages per channel for the ingest stage')
+    p_run.add_argument('--latency-ms', type=float, default=20.0, help='stub download latency')
+    p_run.add_argument('--jitter-ms', type=float, default=10.0)
+    p_run.add_argument('--thumb-sample', type=int, default=64, help='full-size photos rendered by the thumbs stage')
+    p_run.add_argument('--startup-runs', type=int, default=5, help='timed starts per command for the startup stage')
+    p_run.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    p_run.add_argument('--seed', type=int, default=1)
+    p_run.add_argument('--stages', default=','.join(STAGES))
+    p_run.add_argument('--workdir', default=None, help='reuse/keep this workspace instead of a temp dir')
+    p_run.add_argument('--keep', action='store_true', help='keep the temporary workspace')
+    p_run.add_argument('--out', default=None, help='write JSON results here (default: stdout)')
+    p_run.add_argument('--verbose', action='store_true', help="show the stages' own output")
+
+    p_cmp = sub.add_parser('compare')
+    p_cmp.add_argument('base')
+    p_cmp.add_argument('head')
+
+    args = parser.parse_args()
+    if args.cmd == 'compare':
+        with open(args.base, 'r', encoding='utf-8') as f1, open(args.head, 'r', encoding='utf-8') as f2:
+            compare(json.load(f1), json.load(f2))
+        sys.exit(0)
+
+    stages = [s.strip() for s in args.stages.split(',') if s.strip()]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(unknown)}")
+    opts = {
+        'files': args.files, 'channels': args.channels, 'legacy_ratio': args.legacy_ratio,
+        'unsynced': args.unsynced, 'messages': args.messages, 'latency_ms': args.latency_ms,
+        'jitter_ms': args.jitter_ms, 'thumb_sample': args.thumb_sample, 'startup_runs': max(1, args.startup_runs),
+        'workers': args.workers,
+        'seed': args.seed, 'verbose': args.verbose,
+    }
+    report = run(opts, stages, workdir=args.workdir, keep=args.keep)
+    data = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(data + '\n')
+        print(f"📄 results written to {args.out}")
+    else:
+        print(data)
@@ -0,0 +1,57 @@
+"""Captions, hashtags and channel metadata captured at ingest.
+
+Telegram puts an album's caption on one of its messages only, so the first
+non-empty text of an album is recorded for every sampled member.  Each
+downloaded message with text gets a ``captions`` row (indexed for full-text
+search by ``captions_fts``, see storage.py) and one ``hashtags`` row per
+distinct ``#tag``; ``channels`` keeps the title and username of each
+scanned channel.  Rows follow their image: deleting an ``images`` row drops
+its caption and tags (trigger ``images_drop_caption``).
+
+Searching and paging is query.py.
+"""
+
+import re
+import time
+
+# A tag starts after a non-word character (so "a#b" is not one) and runs over word characters, CJK included.
+HASHTAG_RE = re.compile(r'(?<!\w)#(\w+)')
+
+INSERT_CAPTION = '''INSERT INTO captions (channel, msg_id, text) VALUES (?, ?, ?)
+    ON CONFLICT(channel, msg_id) DO UPDATE SET text = excluded.text WHERE text != excluded.text'''
+INSERT_HASHTAG = "INSERT OR IGNORE INTO hashtags (tag, channel, msg_id) VALUES (?, ?, ?)"
+INSERT_CHANNEL = '''INSERT INTO channels (channel, peer_id, title, username, updated_at) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(channel) DO UPDATE SET peer_id = excluded.peer_id, title = excluded.title,
+    username = excluded.username, updated_at = excluded.updated_at'''
+
+
+def message_text(message) -> str:
+    # raw_text is the caption without the markdown markup Telethon adds to ``text``.
+    return (getattr(message, 'raw_text', None) or getattr(message, 'text', None) or '').strip()
+
+
+def album_text(messages) -> str:
+    return next((text for text in map(message_text, messages) if text), '')
+
+
+def parse_hashtags(text: str):
+    """Distinct lower-cased tags of ``text``, without the ``#``, in order of appearance."""
+    return list(dict.fromkeys(tag.lower() for tag in HASHTAG_RE.findall(text or '')))
+
+
+def record_caption(db, channel: str, msg_id, text: str):
+    """Buffer the caption and tags of one message; empty text records nothing."""
+    if not text:
+        return
+    msg_id = int(msg_id)
+    db.queue(INSERT_CAPTION, (channel, msg_id, text))
+    for tag in parse_hashtags(text):
+        db.queue(INSERT_HASHTAG, (tag, channel, msg_id))
+
+
+def record_channel(db, channel: str, entity):
+    """Buffer the metadata of a resolved Telegram entity (a channel or chat)."""
+    if entity is None:
+        return
+    db.queue(INSERT_CHANNEL, (channel, getattr(entity, 'id', None), getattr(entity, 'title', None),
+                              getattr(entity, 'username', None), int(time.time())))
@@ -0,0 +1,330 @@
+"""Content-addressed storage of originals: one blob per distinct file.
+
+The same photo is often posted in several channels, or fetched again after
+the history was lost, and every copy used to be stored in full under its own
+``photo_<channel>_...`` name.  With ``cas.enabled`` each download is hashed
+(SHA-256) while it streams to disk, then stored once as
+``blobs/<ab>/<cd>/<sha256>`` inside the gallery dir.  The gallery name is a
+hard link to that blob, so the web front end, thumbnails and every script
+keep working on plain paths.
+
+``blob_refs`` maps each gallery name to its blob; triggers keep
+``blobs.refs`` equal to the number of names, so deleting a name (cleanup,
+channel deletion, disk budget, rejected duplicates) only frees the blob when
+``release`` sees its last reference go.  A download whose blob already
+existed gets a link instead of a new file, and its thumbnail, renditions and
+display metadata are linked from a copy that is already rendered, so no pool
+job runs for it.
+
+The batch mode folds an existing library into the store: originals with the
+same content become links to one blob.
+
+Usage:
+  python cas.py [--workers N] [--dry-run]   # adopt existing originals
+  python cas.py --gc                        # drop unreferenced blobs
+"""
+
+import os
+import sys
+import errno
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import Metrics
+from thumbs import ORIGINAL_EXTS, THUMB_SUFFIX, thumb_path_for
+from renditions import rendition_dir_for
+from layout import iter_gallery, resolve
+from downloads import PartFile
+
+BLOB_DIR = 'blobs'
+CHUNK = 1 << 20
+RELEASE_CHUNK = 500
+# Hard links are not available on this filesystem (or across devices).
+NO_LINK_ERRNOS = (errno.EPERM, errno.EXDEV, errno.ENOTSUP, errno.EMLINK)
+
+INSERT_REF = "INSERT OR IGNORE INTO blob_refs (file_name, sha256, size) VALUES (?, ?, ?)"
+
+
+def blob_dir_for(gallery_dir: str) -> str:
+    return os.path.join(gallery_dir, BLOB_DIR)
+
+
+def blob_path(root: str, digest: str) -> str:
+    return os.path.join(root, digest[:2], digest[2:4], digest)
+
+
+def sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _link_over(src: str, dst: str):
+    """Atomically make ``dst`` a hard link to ``src``, replacing whatever is there."""
+    tmp = f"{dst}.link"
+    try:
+        os.remove(tmp)
+    except FileNotFoundError:
+        pass
+    os.link(src, tmp)
+    os.replace(tmp, dst)
+
+
+class ContentStore:
+    """Stores downloads by content and records which gallery names share a blob."""
+
+    def __init__(self, db, gallery_dir: str, metrics: Metrics = None):
+        self.db = db
+        self.gallery_dir = gallery_dir
+        self.root = blob_dir_for(gallery_dir)
+        self.metrics = metrics or db.metrics
+        self.enabled = True
+        self.hits = 0
+        self.saved = 0
+
+    def open(self, full_path: str) -> PartFile:
+        """Output stream for a download of ``full_path`` that hashes as it writes."""
+        return PartFile(full_path, hashed=True)
+
+    def commit(self, out: PartFile, file_name: str) -> bool:
+        """Store a finished (``out.finish()``-ed) download; True when its content was already stored."""
+        if not self.enabled:
+            out.publish()
+            return False
+        digest = out.hexdigest()
+        blob = blob_path(self.root, digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            # New content: the download itself becomes the blob.
+            os.link(out.path, blob)
+            hit = False
+        except FileExistsError:
+            hit = True
+        except OSError as e:
+            if e.errno not in NO_LINK_ERRNOS:
+                raise
+            print(f"      ⚠️  hard links unavailable under {self.root} ({e.strerror}); content store disabled")
+            self.enabled = False
+            out.publish()
+            return False
+        if hit:
+            _link_over(blob, out.final_path)
+            os.remove(out.path)
+            self.hits += 1
+            self.saved += out.size
+            self.metrics.inc('pencilai_cas_hits_total')
+            self.metrics.inc('pencilai_cas_saved_bytes_total', out.size)
+        else:
+            out.publish()
+        self.db.queue(INSERT_REF, (file_name, digest, out.size))
+        return hit
+
+    def adopt(self, file_name: str, full_path: str, digest: str = None) -> int:
+        """Register an existing original, turning it into a link when its content is already stored.
+
+        Returns the bytes freed (the size of a replaced copy that had no other link).
+        """
+        st = os.stat(full_path)
+        digest = digest or sha256_file(full_path)
+        blob = blob_path(self.root, digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        freed = 0
+        try:
+            os.link(full_path, blob)
+        except FileExistsError:
+            if not os.path.samefile(blob, full_path):
+                _link_over(blob, full_path)
+                freed = st.st_size if st.st_nlink == 1 else 0
+        self.db.queue(INSERT_REF, (file_name, digest, st.st_size))
+        return freed
+
+    def reuse(self, file_name: str, full_path: str, digest: str):
+        """Link the outputs of an already rendered copy of blob ``digest`` for ``file_name``.
+
+        Returns a result in the shape of ``renditions.render_image`` for
+        ``ThumbnailStage.reuse``, or None when no copy is rendered yet (or one of
+        its files is gone) and the image must go through the pool.
+        """
+        conn = self.db.conn
+        row = conn.execute('''SELECT i.file_name, i.thumb_name, i.thumb_size, i.placeholder
+            FROM blob_refs s JOIN images i ON i.file_name = s.file_name
+            WHERE s.sha256 = ? AND s.file_name != ? AND i.thumb_size IS NOT NULL LIMIT 1''',
+                           (digest, file_name)).fetchone()
+        if row is None:
+            return None
+        sibling, sibling_thumb, thumb_size, placeholder = row
+        rows = conn.execute("SELECT width, format, name, height, bytes, spec, src_hash FROM renditions "
+                            "WHERE file_name = ?", (sibling,)).fetchall()
+        if not rows:
+            return None
+        old_base, new_base = os.path.splitext(sibling)[0], os.path.splitext(file_name)[0]
+        out_dir = rendition_dir_for(self.gallery_dir)
+        items = []
+        try:
+            for w, fmt, name, h, size, _, _ in rows:
+                if not name.startswith(old_base):
+                    return None
+                new_name = new_base + name[len(old_base):]
+                dst = resolve(out_dir, new_name)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                _link_over(resolve(out_dir, name), dst)
+                items.append((w, fmt, new_name, h, size))
+            if thumb_size and sibling_thumb:
+                _link_over(resolve(self.gallery_dir, sibling_thumb), thumb_path_for(full_path))
+        except FileNotFoundError:
+            return None
+
+        from dedup import unsigned_hash
+        hashes = conn.execute("SELECT phash, dhash FROM phashes WHERE file_name = ?", (sibling,)).fetchone()
+        st = os.stat(full_path)
+        return {
+            'src_hash': rows[0][6],
+            'src_size': st.st_size,
+            'src_mtime': st.st_mtime_ns,
+            'spec': rows[0][5],
+            'items': items,
+            'rendered': 0,
+            'thumb': None,
+            'thumb_size': thumb_size if sibling_thumb else 0,
+            'placeholder': placeholder,
+            'hashes': (unsigned_hash(hashes[0]), unsigned_hash(hashes[1])) if hashes else None,
+        }
+
+
+def release(conn, gallery_dir: str, file_names) -> int:
+    """Drop the blob references of deleted originals and unlink blobs left without any; returns bytes freed."""
+    file_names = list(file_names)
+    digests = set()
+    for i in range(0, len(file_names), RELEASE_CHUNK):
+        chunk = file_names[i:i + RELEASE_CHUNK]
+        marks = ','.join('?' * len(chunk))
+        with conn:
+            digests.update(r[0] for r in conn.execute(
+                f"SELECT DISTINCT sha256 FROM blob_refs WHERE file_name IN ({marks})", chunk))
+            conn.execute(f"DELETE FROM blob_refs WHERE file_name IN ({marks})", chunk)
+    if not digests:
+        return 0
+    root = blob_dir_for(gallery_dir)
+    freed = 0
+    dead = []
+    digests = sorted(digests)
+    for i in range(0, len(digests), RELEASE_CHUNK):
+        chunk = digests[i:i + RELEASE_CHUNK]
+        marks = ','.join('?' * len(chunk))
+        dead.extend(r[0] for r in conn.execute(
+            f"SELECT sha256 FROM blobs WHERE refs <= 0 AND sha256 IN ({marks})", chunk))
+    for digest in dead:
+        path = blob_path(root, digest)
+        try:
+            st = os.stat(path)
+            os.remove(path)
+            freed += st.st_size if st.st_nlink == 1 else 0
+        except FileNotFoundError:
+            pass
+    with conn:
+        conn.executemany("DELETE FROM blobs WHERE sha256 = ? AND refs <= 0", [(d,) for d in dead])
+    return freed
+
+
+def store_from_config(cfg: dict, db, gallery_dir: str, metrics: Metrics = None):
+    if not cfg.get('cas', {}).get('enabled', False):
+        return None
+    return ContentStore(db, gallery_dir, metrics=metrics)
+
+
+# ---------- batch ----------
+
+def _hash_job(path: str):
+    try:
+        return path, sha256_file(path), None
+    except OSError as e:
+        return path, None, f"{type(e).__name__}: {e}"
+
+
+def adopt_library(db, gallery_dir: str, workers: int = None, dry_run: bool = False):
+    """Move every original without a ``blob_refs`` row into the store; returns (adopted, freed, failures)."""
+    db.flush()
+    known = {r[0] for r in db.conn.execute("SELECT file_name FROM blob_refs")}
+    todo = []
+    for rel, entry in iter_gallery(gallery_dir):
+        lower = entry.name.lower()
+        if lower.endswith(ORIGINAL_EXTS) and not lower.endswith(THUMB_SUFFIX) and rel not in known:
+            todo.append((rel, entry.path))
+    workers = workers or min(8, os.cpu_count() or 1)
+    print(f"🔎 {len(todo)} originals not in the content store, hashing on {workers} threads...")
+
+    store = ContentStore(db, gallery_dir)
+    names = {path: rel for rel, path in todo}
+    adopted, freed, failures = 0, 0, []
+    seen = {}
+    # hashlib releases the GIL on large buffers, so threads keep the disk busy.
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for path, digest, error in pool.map(_hash_job, [p for _, p in todo]):
+            if error:
+                failures.append((path, error))
+                continue
+            if dry_run:
+                stored = digest in seen or db.conn.execute("SELECT 1 FROM blobs WHERE sha256 = ?",
+                                                           (digest,)).fetchone()
+                freed += os.path.getsize(path) if stored else 0
+                seen[digest] = path
+            else:
+                freed += store.adopt(names[path], path, digest)
+            adopted += 1
+    db.flush()
+    print(f"✅ content store: {adopted} originals {'would be ' if dry_run else ''}adopted, "
+          f"{freed / 1024 ** 2:.1f} MB {'would be ' if dry_run else ''}freed, {len(failures)} failed")
+    return adopted, freed, failures
+
+
+def collect_garbage(conn, gallery_dir: str) -> int:
+    """Remove blob files no gallery name links to and no reference counts; returns files removed."""
+    live = {r[0] for r in conn.execute("SELECT sha256 FROM blobs WHERE refs > 0")}
+    root = blob_dir_for(gallery_dir)
+    removed = 0
+    for dirpath, _, files in os.walk(root):
+        for name in files:
+            path = os.path.join(dirpath, name)
+            try:
+                # A second link means a gallery name still uses it (e.g. a download not flushed yet).
+                if name in live or os.stat(path).st_nlink > 1:
+                    continue
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    with conn:
+        conn.execute("DELETE FROM blobs WHERE refs <= 0")
+    return removed
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from config import config_path, load_config
+    from storage import GalleryDB
+    from scheduler import gallery_lock
+
+    cfg = load_config()
+
+    parser = argparse.ArgumentParser(description='Store gallery originals by content (SHA-256)')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--dry-run', action='store_true', help='only report what adopting would free')
+    parser.add_argument('--gc', action='store_true', help='remove blobs that nothing references')
+    args = parser.parse_args()
+
+    gallery_dir = config_path('tg_gallery_dir', cfg)
+    # Ingest writes blobs and refs too (under any session, shard workers included); never run next to it.
+    with gallery_lock(config_path('db_path', cfg), exclusive=True) as acquired:
+        if not acquired:
+            print("⏭️  an ingest run holds the lock; try again when it is done")
+            sys.exit(1)
+        with GalleryDB(config_path('db_path', cfg)) as db:
+            db.ensure_schema()
+            if args.gc:
+                print(f"🧹 removed {collect_garbage(db.conn, gallery_dir)} unreferenced blobs")
+                sys.exit(0)
+            _, _, failures = adopt_library(db, gallery_dir, workers=args.workers, dry_run=args.dry_run)
+    sys.exit(1 if failures else 0)
@@ -1,46 +1,32 @@
 import os
-import json
-import sqlite3
 import time
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DEFAULT_CONFIG = os.path.join(BASE_DIR, 'config.json')
-
-def _load_config_paths():
-    # Use config.json if present; fallback to config.example.json for path defaults
-    cfg_path = os.environ.get('PENCILAI_CONFIG', DEFAULT_CONFIG)
-    if not os.path.exists(cfg_path):
-        cfg_path = os.path.join(BASE_DIR, 'config.example.json')
-    with open(cfg_path, 'r', encoding='utf-8') as f:
-        cfg = json.load(f)
-    paths = cfg.get('paths', {}) if isinstance(cfg, dict) else {}
-    db_path = paths.get('db_path', './gallery.db')
-    tg_dir = paths.get('tg_gallery_dir', '../tg_gallery')
-    # resolve relative paths against scripts/ directory
-    if not os.path.isabs(db_path):
-        db_path = os.path.abspath(os.path.join(BASE_DIR, db_path))
-    if not os.path.isabs(tg_dir):
-        tg_dir = os.path.abspath(os.path.join(BASE_DIR, tg_dir))
-    return db_path, tg_dir
-
-
-# resolved paths
-db_path, gallery_dir = _load_config_paths()
+from concurrent.futures import ThreadPoolExecutor
+
+from storage import GalleryDB, table_columns
+from manifests import build_from_config
+from renditions import purge_renditions
+from dedup import forget_hashes
+from cas import release
+from downloads import PART_SUFFIX
+from albums import backfill as backfill_albums, resample, unsampled_files, sampling_from_config
+from layout import iter_gallery, resolve
+from config import config_path, load_config
+
+# 路径统一由 config.py 解析（同一进程内只读一次配置）
+db_path, gallery_dir = config_path('db_path'), config_path('tg_gallery_dir')
 
 
 def init_and_migrate_db():
     """【整合功能】初始化数据库索引并补齐缺失的入库时间"""
     if not os.path.exists(db_path): return
     
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    db = GalleryDB(db_path)
+    cursor = db.conn.cursor()
     print("🚀 启动数据库维护：初始化索引与补齐时间...")
 
     # 1. 结构维护：确保 captured_at 字段存在
-    try:
-        cursor.execute("ALTER TABLE images ADD COLUMN captured_at INTEGER")
+    if 'captured_at' in db.ensure_schema():
         print("✅ 成功检查/添加 captured_at 字段。")
-    except sqlite3.OperationalError:
-        pass
 
     # 2. 数据维护：补齐历史记录的时间戳权重
     cursor.execute("SELECT COUNT(*) FROM images WHERE captured_at IS NULL")
@@ -50,131 +36,235 @@ def init_and_migrate_db():
         cursor.execute("UPDATE images SET captured_at = ? WHERE captured_at IS NULL", (current_now,))
         print(f"📊 已为 {missing_count} 条历史记录补齐入库时间。")
 
-    # 3. 性能优化：建立复合高速索引
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sort_flow ON images (captured_at, timestamp)")
-    print("⚡ 复合索引 idx_sort_flow 已就绪。")
+    # 3. 性能优化：排序索引 idx_images_ts / idx_sort_channel 已由 ensure_schema 建立
+    print("⚡ 排序索引 idx_images_ts / idx_sort_channel 已就绪。")
     
+    db.conn.commit()
+    db.close()
+
+SCAN_CHUNK = 5000     # scandir 结果分批写入临时表
+TXN_CHUNK = 1000      # 每个数据库事务删除的行数，避免长时间持有写锁
+UNLINK_WORKERS = 16   # 并行删除文件的线程数
+SAMPLE_LIMIT = 10     # --dry-run 报告里每类展示的样例数
+PART_MAX_AGE = 3600   # 超过该秒数的 .part 下载残留视为中断遗留
+
+
+def _scan_into_temp(conn):
+    """一次扫描目录（含分片子目录），结果流式写入临时表 disk_files；name 为相对路径。
+
+    返回 (文件总数, 过期的 .part 下载残留列表)。
+    """
+    conn.execute("PRAGMA temp_store=FILE")
+    conn.execute("DROP TABLE IF EXISTS temp.disk_files")
+    conn.execute('''CREATE TEMP TABLE disk_files
+        (name TEXT PRIMARY KEY, is_thumb INTEGER NOT NULL)''')
+    total = 0
+    batch = []
+    stale_parts = []
+    cutoff = time.time() - PART_MAX_AGE
+    for name, entry in iter_gallery(gallery_dir):
+        if name.endswith(PART_SUFFIX):
+            if entry.stat().st_mtime < cutoff:
+                stale_parts.append(name)
+            continue
+        batch.append((name, int(name.endswith('_thumb.webp'))))
+        if len(batch) >= SCAN_CHUNK:
+            conn.executemany("INSERT OR IGNORE INTO disk_files VALUES (?, ?)", batch)
+            total += len(batch)
+            batch = []
+    conn.executemany("INSERT OR IGNORE INTO disk_files VALUES (?, ?)", batch)
+    total += len(batch)
     conn.commit()
-    conn.close()
+    return total, stale_parts
+
+
+def _unlink_all(names):
+    """线程池并行删除文件，返回实际删除的数量。"""
+    def _rm(name):
+        try:
+            os.remove(resolve(gallery_dir, name))
+            return 1
+        except FileNotFoundError:
+            return 0
+        except OSError as e:
+            print(f"⚠️  删除失败 {name}: {e}")
+            return 0
+
+    if not names:
+        return 0
+    with ThreadPoolExecutor(max_workers=UNLINK_WORKERS) as pool:
+        return sum(pool.map(_rm, names, chunksize=256))
 
-def deep_clean_and_limit():
-    """物理清理核心逻辑：原图为本，不删无缩略图的原图"""
+
+def _delete_rows(conn, file_names):
+    """按块删除 images / files / phashes 中的记录，每块一个短事务；内容存储中已无引用的 blob 一并删除。"""
+    for i in range(0, len(file_names), TXN_CHUNK):
+        chunk = [(f,) for f in file_names[i:i + TXN_CHUNK]]
+        with conn:
+            conn.executemany("DELETE FROM images WHERE file_name = ?", chunk)
+            conn.executemany("DELETE FROM files WHERE file_name = ?", chunk)
+    forget_hashes(conn, file_names)
+    release(conn, gallery_dir, file_names)
+
+
+def _purge_originals(conn, file_names, dry_run=False):
+    """统一删除引擎：原图 + 对应缩略图 + 多尺寸副本 + 数据库记录。"""
+    if dry_run or not file_names:
+        return len(file_names)
+    thumbs = [f"{os.path.splitext(f)[0]}_thumb.webp" for f in file_names]
+    _unlink_all(list(file_names) + thumbs)
+    purge_renditions(conn, gallery_dir, file_names)
+    _delete_rows(conn, list(file_names))
+    return len(file_names)
+
+
+def _report(title, names, count=None):
+    print(f"{title}: {len(names) if count is None else count}")
+    for name in names[:SAMPLE_LIMIT]:
+        print(f"    - {name}")
+    if len(names) > SAMPLE_LIMIT:
+        print(f"    ... 另有 {len(names) - SAMPLE_LIMIT} 项")
+
+
+def deep_clean_and_limit(dry_run=False):
+    """物理清理核心逻辑：原图为本，不删无缩略图的原图
+
+    目录只用 os.scandir 扫描一次并载入临时表，孤儿缩略图 / 数据库死链由 SQL
+    连接查询得出；相册采样冗余图直接查 albums / album_members 表（按各频道当前
+    采样策略，见 albums.py），再分批删除。dry_run=True 时只输出报告。
+    """
     if not os.path.exists(db_path): return
     
     # 🌟 先执行数据库初始化维护
-    init_and_migrate_db()
+    if not dry_run:
+        init_and_migrate_db()
 
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    db = GalleryDB(db_path)
+    conn = db.conn
 
-    print("🔍 启动物理清理：遵循“原图至上”原则...")
-    orphan_thumb = 0    # 已删除的孤儿缩略图
-    dead_db_count = 0   # 数据库死链记录
-    
-    all_files = set(os.listdir(gallery_dir))
-    
-    # --- 1. 双向孤儿检查 (已改为只清理孤儿缩略图) ---
-    for f in list(all_files):
-        f_path = os.path.join(gallery_dir, f)
-        
-        # 情况 A: 清理孤儿缩略图
-        if f.endswith('_thumb.webp'):
-            original_jpg = f.replace('_thumb.webp', '.jpg')
-            if original_jpg not in all_files:
-                try:
-                    os.remove(f_path)
-                    orphan_thumb += 1
-                except: pass
-        
-        # 情况 B: 原图无缩略图
-        # 🌟 逻辑已反转：只要是 .jpg 且文件存在，此处不做任何操作，确保原图安全。
-
-    # --- 2. 数据库死链清理 (物理原图已失踪的记录) ---
-    cursor.execute("SELECT file_name FROM images")
-    db_records = cursor.fetchall()
-    for (fname,) in db_records:
-        if fname not in all_files:
-            cursor.execute("DELETE FROM images WHERE file_name = ?", (fname,))
-            dead_db_count += 1
-
-    # --- 3. 1-4-7 采样规则清理 (保持不变) ---
-    current_files = [f for f in os.listdir(gallery_dir) if f.endswith('.jpg') and not f.endswith('_thumb.webp')]
-    groups = {}
-    for f in current_files:
-        try:
-            parts = f.split('_')
-            if len(parts) < 6: continue
-            group_id = parts[4]
-            if group_id.startswith('S'): continue
-            group_key = f"{parts[1]}_{parts[2]}_{parts[3]}_{group_id}"
-            if group_key not in groups: groups[group_key] = []
-            groups[group_key].append(f)
-        except: continue
-
-    redundant_deleted = 0
-    for group_key, file_list in groups.items():
-        if len(file_list) <= 4: continue
-        file_list.sort(key=lambda x: int(x.split('_')[-1].split('.')[0]))
-        to_keep = [file_list[i] for i in range(0, len(file_list), 3)][:4]
-        for f in file_list:
-            if f not in to_keep:
-                file_path = os.path.join(gallery_dir, f)
-                base = os.path.splitext(f)[0]
-                thumb_path = os.path.join(gallery_dir, f"{base}_thumb.webp")
-                if os.path.exists(file_path): os.remove(file_path)
-                if os.path.exists(thumb_path): os.remove(thumb_path)
-                cursor.execute("DELETE FROM images WHERE file_name = ?", (f,))
-                redundant_deleted += 1
+    print("🔍 启动物理清理：遵循“原图至上”原则..." + ("（演练模式，不做任何修改）" if dry_run else ""))
+    # 扫描前已提交记录的 rowid 上界：扫描期间入库（WAL 下并发提交）的新记录，其文件可能在
+    # 扫描经过该目录后才写入，不能当作死链删除
+    row_bound = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM images").fetchone()[0]
+    scanned, stale_parts = _scan_into_temp(conn)
+    print(f"📂 目录扫描完成：{scanned} 个文件")
 
-    conn.commit()
-    conn.close()
+    # --- 1. 孤儿缩略图：对应的 .jpg 原图已不存在 ---
+    orphan_thumbs = [r[0] for r in conn.execute('''
+        SELECT t.name FROM disk_files t
+        WHERE t.is_thumb = 1 AND NOT EXISTS (
+            SELECT 1 FROM disk_files o WHERE o.name = substr(t.name, 1, length(t.name) - 11) || '.jpg')''')]
+
+    # --- 2. 数据库死链 (物理原图已失踪的记录，仅限扫描前已入库的) ---
+    dead_rows = [r[0] for r in conn.execute('''
+        SELECT i.file_name FROM images i
+        WHERE i.rowid <= ? AND NOT EXISTS (SELECT 1 FROM disk_files d WHERE d.name = i.file_name)''', (row_bound,))]
+
+    # --- 2b. 孤儿多尺寸副本：原图已不存在 ---
+    orphan_renditions = [r[0] for r in conn.execute('''
+        SELECT DISTINCT r.file_name FROM renditions r
+        WHERE NOT EXISTS (SELECT 1 FROM disk_files d WHERE d.name = r.file_name)''')] \
+        if table_columns(conn, 'renditions') else []
+
+    # --- 3. 相册采样规则：按频道当前策略（默认第 1/4/7/10 张），未被采样的成员为冗余 ---
+    sampling = sampling_from_config(load_config())
+    if dry_run:
+        if not table_columns(conn, 'albums') or not db.get_meta('albums_backfilled'):
+            print("ℹ️  相册索引尚未建立，实际运行时会先从现有记录回填，演练报告不含历史相册。")
+            redundant = []
+        else:
+            redundant = unsampled_files(conn, resample(conn, sampling, dry_run=True))
+    else:
+        backfill_albums(db)
+        changed = resample(conn, sampling)
+        if changed:
+            print(f"🔁 {len(changed)} 个相册按新采样策略重新标记")
+        redundant = unsampled_files(conn)
+    missing = set(dead_rows)
+    redundant = [n for n in redundant if n not in missing]
+
+    if dry_run:
+        _report("🗑️  [演练] 将清理孤儿缩略图", orphan_thumbs)
+        _report("🧹 [演练] 将移除数据库死链记录", dead_rows)
+        _report("🗑️  [演练] 将清理孤儿多尺寸副本（按原图计）", orphan_renditions)
+        _report("♻️  [演练] 将按采样规则删除冗余图", redundant)
+        _report("🧩 [演练] 将清理中断下载残留 (.part)", stale_parts)
+        db.close()
+        return {'orphan_thumbs': len(orphan_thumbs), 'dead_rows': len(dead_rows),
+                'orphan_renditions': len(orphan_renditions), 'redundant': len(redundant),
+                'stale_parts': len(stale_parts)}
+
+    orphan_thumb = _unlink_all(orphan_thumbs)
+    _delete_rows(conn, dead_rows)
+    purge_renditions(conn, gallery_dir, orphan_renditions)
+    redundant_deleted = _purge_originals(conn, redundant)
+    parts_deleted = _unlink_all(stale_parts)
+
+    conn.execute("DROP TABLE IF EXISTS temp.disk_files")
+    db.close()
     
     print(f"✅ 任务完成！")
     print(f"🗑️  清理孤儿缩略图: {orphan_thumb} 张")
-    print(f"🧹 移除数据库死链记录: {dead_db_count} 条")
+    print(f"🧹 移除数据库死链记录: {len(dead_rows)} 条")
+    print(f"🗑️  清理孤儿多尺寸副本: {len(orphan_renditions)} 组")
     print(f"♻️  按采样规则删除冗余图: {redundant_deleted} 张")
+    print(f"🧩 清理中断下载残留: {parts_deleted} 个")
+    return {'orphan_thumbs': orphan_thumb, 'dead_rows': len(dead_rows),
+            'orphan_renditions': len(orphan_renditions), 'redundant': redundant_deleted,
+            'stale_parts': parts_deleted}
 
-if __name__ == "__main__":
-    deep_clean_and_limit()
-def delete_by_channel(channel_name):
+
+def delete_by_channel(channel_name, dry_run=False):
     """
     【新增】按频道名彻底物理删除：原图 + 缩略图 + 数据库记录
     """
     if not os.path.exists(db_path): return
 
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
+        db = GalleryDB(db_path)
 
         # 1. 查找该频道的所有原图文件名
-        cursor.execute("SELECT file_name FROM images WHERE channel = ?", (channel_name,))
-        rows = cursor.fetchall()
+        names = [r[0] for r in db.conn.execute("SELECT file_name FROM images WHERE channel = ?", (channel_name,))]
         
-        if not rows:
+        if not names:
             print(f"ℹ️  库中未发现来自频道 [{channel_name}] 的图片。")
-            conn.close()
+            db.close()
             return
 
-        print(f"🗑️  正在彻底清理频道 [{channel_name}]，共 {len(rows)} 组文件...")
-
-        for row in rows:
-            f = row[0]
-            # 路径 A: 原图路径
-            f_path = os.path.join(gallery_dir, f)
-            # 路径 B: 缩略图路径
-            base = os.path.splitext(f)[0]
-            t_path = os.path.join(gallery_dir, f"{base}_thumb.webp")
-            
-            # 物理删除
-            if os.path.exists(f_path): os.remove(f_path)
-            if os.path.exists(t_path): os.remove(t_path)
-
-        # 2. 数据库记录一键清除
-        cursor.execute("DELETE FROM images WHERE channel = ?", (channel_name,))
-        
-        conn.commit()
-        conn.close()
+        if dry_run:
+            _report(f"🗑️  [演练] 频道 [{channel_name}] 将删除的原图", names)
+            db.close()
+            return
+
+        print(f"🗑️  正在彻底清理频道 [{channel_name}]，共 {len(names)} 组文件...")
+
+        # 2. 与 deep_clean_and_limit 共用删除引擎：并行删文件 + 分块删记录
+        db.ensure_schema()
+        _purge_originals(db.conn, names)
+        with db.conn:
+            db.conn.execute("DELETE FROM album_members WHERE channel = ?", (channel_name,))
+            db.conn.execute("DELETE FROM albums WHERE channel = ?", (channel_name,))
+            db.conn.execute("DELETE FROM channels WHERE channel = ?", (channel_name,))
+
+        db.close()
         print(f"✅ 频道 [{channel_name}] 已从硬盘和数据库中完全抹除。")
 
     except Exception as e:
-        print(f"❌ 清理出错: {str(e)}")
\ No newline at end of file
+        print(f"❌ 清理出错: {str(e)}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="图库物理清理")
+    parser.add_argument('--dry-run', action='store_true', help="只输出将要删除的内容，不做任何修改")
+    parser.add_argument('--channel', help="按频道名彻底删除该频道的全部图片")
+    args = parser.parse_args()
+
+    if args.channel:
+        delete_by_channel(args.channel, dry_run=args.dry_run)
+    else:
+        deep_clean_and_limit(dry_run=args.dry_run)
+    # 清理后重新发布分页清单，让前端立即看到结果
+    if os.path.exists(db_path) and not args.dry_run:
+        build_from_config(load_config())
@@ -0,0 +1,81 @@
+"""Config and path resolution shared by every script.
+
+The config file is ``$PENCILAI_CONFIG``, else ``scripts/config.json``, else
+(for scripts that only need paths) ``config.example.json``.  It is parsed
+once per process and re-read only when the file changes, so modules can
+resolve their paths at import time for the cost of a ``stat``.  Relative
+paths in ``paths`` resolve against the scripts directory, which is what
+every script has always done by hand.
+
+Usage:
+  python config.py        print the config file in use and the resolved paths
+"""
+
+import os
+import copy
+import json
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CONFIG = os.path.join(BASE_DIR, 'config.json')
+EXAMPLE_CONFIG = os.path.join(BASE_DIR, 'config.example.json')
+
+PATH_DEFAULTS = {
+    'site_root': '..',
+    'tg_gallery_dir': '../tg_gallery',
+    'db_path': './gallery.db',
+    'session_file': './anon',
+    'timer_config': './timer_config.json',
+    'last_ids': './last_ids.json',
+    'download_history': './download_history.txt',
+    'manifest_dir': './manifests',
+}
+
+_cache = {}
+
+
+def config_file(require: bool = False) -> str:
+    cfg_path = os.environ.get('PENCILAI_CONFIG', DEFAULT_CONFIG)
+    if not os.path.exists(cfg_path):
+        if require:
+            raise FileNotFoundError(
+                f"Config not found: {cfg_path}. Copy config.example.json to config.json and fill in your secrets."
+            )
+        cfg_path = EXAMPLE_CONFIG
+    return cfg_path
+
+
+def _parsed(require: bool = False) -> dict:
+    cfg_path = config_file(require)
+    st = os.stat(cfg_path)
+    key = (st.st_mtime_ns, st.st_size)
+    hit = _cache.get(cfg_path)
+    if hit is None or hit[0] != key:
+        with open(cfg_path, 'r', encoding='utf-8') as f:
+            cfg = json.load(f)
+        hit = _cache[cfg_path] = (key, cfg if isinstance(cfg, dict) else {})
+    return hit[1]
+
+
+def load_config(require: bool = False) -> dict:
+    """The parsed config; a copy, so callers may adjust it for one run.
+
+    ``require`` raises instead of falling back to config.example.json (ingest
+    needs the real secrets).
+    """
+    return copy.deepcopy(_parsed(require))
+
+
+def resolve(path: str) -> str:
+    return os.path.abspath(os.path.join(BASE_DIR, path))
+
+
+def config_path(key: str, cfg: dict = None) -> str:
+    """Absolute ``paths.<key>`` of ``cfg`` (default: the config file)."""
+    paths = (cfg if cfg is not None else _parsed()).get('paths') or {}
+    return resolve(paths.get(key, PATH_DEFAULTS[key]))
+
+
+if __name__ == '__main__':
+    print(f"config: {config_file()}")
+    for name in PATH_DEFAULTS:
+        print(f"  {name:<18} {config_path(name)}")
@@ -0,0 +1,417 @@
+"""Perceptual-hash near-duplicate detection.
+
+Channels repost each other, so one picture arrives under many
+``photo_<channel>_...`` names with different message IDs.  Every original
+gets a 64-bit DCT pHash and a 64-bit dHash (NumPy, computed from the small
+frame the rendition job already decoded), stored in ``phashes``.  Two images
+are near-duplicates when both hashes are within ``max_distance`` bits.
+
+Lookups use multi-index hashing: the pHash is split into four 16-bit bands
+``b0..b3``, each indexed in SQLite.  If two hashes differ in at most ``d``
+bits, some band differs in at most ``d // 4`` bits, so probing every band
+value within that radius finds all candidates without a table scan.
+
+At ingest ``DuplicateIndex.check`` either links a repost to the first copy
+(``dup_of``; linked rows are hidden from the gallery, see LIVE_IMAGES in
+manifests.py) or rejects it, deleting the file but keeping its ``seen`` key.
+The batch mode hashes the existing library and finds clusters on all cores.
+
+Usage:
+  python dedup.py [--workers N] [--max-distance D] [--link]
+"""
+
+import os
+import sys
+from itertools import combinations, groupby
+
+from thumbs import ORIGINAL_EXTS, THUMB_SUFFIX, thumb_path_for
+from renditions import rendition_dir_for, purge_renditions
+from layout import iter_gallery, rel_name, resolve
+from cas import release
+
+BANDS = 4
+BAND_BITS = 16
+BAND_MASK = (1 << BAND_BITS) - 1
+MAX_DISTANCE = 11  # band radius <= 2, i.e. at most 137 probes per band
+HASH_SIZE = 32  # pHash DCT input is HASH_SIZE x HASH_SIZE grey pixels
+
+INSERT_PHASH = ('''INSERT OR REPLACE INTO phashes (file_name, phash, dhash, b0, b1, b2, b3, dup_of, distance)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''')
+
+_DCT = None
+
+
+def _dct_matrix():
+    global _DCT
+    if _DCT is None:
+        import numpy as np
+
+        k = np.arange(HASH_SIZE)[:, None]
+        i = np.arange(HASH_SIZE)[None, :]
+        m = np.cos(np.pi * (2 * i + 1) * k / (2 * HASH_SIZE)) * np.sqrt(2 / HASH_SIZE)
+        m[0] /= np.sqrt(2)
+        _DCT = m.astype(np.float32)
+    return _DCT
+
+
+def _pack(bits) -> int:
+    import numpy as np
+
+    return int.from_bytes(np.packbits(bits.astype(np.uint8)).tobytes(), 'big')
+
+
+def image_hashes(img):
+    """Return ``(phash, dhash)`` of a PIL image as unsigned 64-bit ints."""
+    import numpy as np
+    from PIL import Image
+
+    grey = img.convert('L')
+    pixels = np.asarray(grey.resize((HASH_SIZE, HASH_SIZE), Image.Resampling.LANCZOS), dtype=np.float32)
+    m = _dct_matrix()
+    low = (m @ pixels @ m.T)[:8, :8].ravel()
+    phash = _pack(low > np.median(low[1:]))
+    small = np.asarray(grey.resize((9, 8), Image.Resampling.LANCZOS), dtype=np.int16)
+    dhash = _pack((small[:, 1:] > small[:, :-1]).ravel())
+    return phash, dhash
+
+
+def hash_file(image_path: str):
+    from PIL import Image
+
+    with Image.open(image_path) as img:
+        if img.format == 'JPEG':
+            # The hash only needs 32x32; let libjpeg decode at 1/8 scale.
+            img.draft('RGB', (HASH_SIZE * 4, HASH_SIZE * 4))
+        return image_hashes(img)
+
+
+def _hash_job(image_path: str):
+    # Runs in a worker process; returns a picklable (path, hashes, error) triple.
+    try:
+        return image_path, hash_file(image_path), None
+    except Exception as e:
+        return image_path, None, f"{type(e).__name__}: {e}"
+
+
+def signed_hash(h: int) -> int:
+    """A 64-bit hash as stored in SQLite, whose integers are signed 64-bit."""
+    return h - (1 << 64) if h >= 1 << 63 else h
+
+
+def unsigned_hash(v: int) -> int:
+    """A hash read back from SQLite (see ``signed_hash``)."""
+    return v + (1 << 64) if v < 0 else v
+
+
+def _bands(h: int):
+    return [(h >> (BAND_BITS * k)) & BAND_MASK for k in range(BANDS)]
+
+
+def _distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+def _neighbours(value: int, radius: int):
+    """Every band value within ``radius`` bits of ``value``."""
+    out = [value]
+    for r in range(1, radius + 1):
+        for bits in combinations(range(BAND_BITS), r):
+            flipped = value
+            for b in bits:
+                flipped ^= 1 << b
+            out.append(flipped)
+    return out
+
+
+def phash_row(file_name: str, phash: int, dhash: int, dup_of: str = None, distance: int = None):
+    return (file_name, signed_hash(phash), signed_hash(dhash), *_bands(phash), dup_of, distance)
+
+
+def find_match(conn, phash: int, dhash: int, max_distance: int, exclude: str = None):
+    """Closest first-copy within ``max_distance`` (both hashes), as ``(file_name, distance)`` or None."""
+    radius = min(max_distance, MAX_DISTANCE) // BANDS
+    best = None
+    checked = set()
+    for k, band in enumerate(_bands(phash)):
+        probes = _neighbours(band, radius)
+        marks = ','.join('?' * len(probes))
+        rows = conn.execute(f"SELECT file_name, phash, dhash FROM phashes "
+                            f"WHERE b{k} IN ({marks}) AND dup_of IS NULL", probes)
+        for file_name, p, d in rows:
+            if file_name in checked or file_name == exclude:
+                continue
+            checked.add(file_name)
+            dist = _distance(phash, unsigned_hash(p))
+            if dist <= max_distance and _distance(dhash, unsigned_hash(d)) <= max_distance:
+                if best is None or dist < best[1]:
+                    best = (file_name, dist)
+    return best
+
+
+class DuplicateIndex:
+    """Ingest-time near-duplicate check against ``phashes``.
+
+    Rows are buffered in ``GalleryDB``, so first copies whose ``phashes`` row
+    is not flushed yet are kept in ``_recent`` and compared directly; a flush
+    empties it (at most one batch is ever scanned), after which the band index
+    finds them.
+    """
+
+    def __init__(self, db, gallery_dir: str, max_distance: int = 4, action: str = 'link'):
+        self.db = db
+        self.gallery_dir = gallery_dir
+        self.max_distance = min(int(max_distance), MAX_DISTANCE)
+        self.action = action if action in ('link', 'reject') else 'link'
+        self._recent = []
+        db.flush_hooks.append(self._recent.clear)
+        self.linked = 0
+        self.rejected = 0
+
+    def _match(self, file_name, phash, dhash):
+        best = find_match(self.db.conn, phash, dhash, self.max_distance, exclude=file_name)
+        for name, p, d in self._recent:
+            dist = _distance(phash, p)
+            if name != file_name and dist <= self.max_distance and _distance(dhash, d) <= self.max_distance:
+                if best is None or dist < best[1]:
+                    best = (name, dist)
+        return best
+
+    def check(self, image_path: str, result: dict):
+        """Record the hashes of a rendered image; returns None, 'linked' or 'rejected'."""
+        hashes = result.get('hashes')
+        if not hashes:
+            return None
+        file_name = rel_name(self.gallery_dir, image_path)
+        phash, dhash = hashes
+        match = self._match(file_name, phash, dhash)
+        if match is None:
+            # Before queueing: a flush triggered by this very row must drop it again.
+            self._recent.append((file_name, phash, dhash))
+            self.db.queue(INSERT_PHASH, phash_row(file_name, phash, dhash))
+            return None
+
+        original, dist = match
+        self.db.queue(INSERT_PHASH, phash_row(file_name, phash, dhash, original, dist))
+        if self.action == 'link':
+            self.linked += 1
+            print(f"      🔗 near-duplicate of {original} (distance {dist}): {file_name}")
+            return 'linked'
+
+        self._reject(image_path, result)
+        self.rejected += 1
+        print(f"      🚫 rejected near-duplicate of {original} (distance {dist}): {file_name}")
+        return 'rejected'
+
+    def _reject(self, image_path: str, result: dict):
+        file_name = rel_name(self.gallery_dir, image_path)
+        # The image row may still be buffered; flush so the delete really follows it.
+        with self.db.transaction() as conn:
+            conn.execute("DELETE FROM images WHERE file_name = ?", (file_name,))
+            conn.execute("DELETE FROM files WHERE file_name = ?", (file_name,))
+        purge_renditions(self.db.conn, self.gallery_dir, [file_name])
+        release(self.db.conn, self.gallery_dir, [file_name])
+        out_dir = rendition_dir_for(self.gallery_dir)
+        paths = [image_path, thumb_path_for(image_path)] + [resolve(out_dir, item[2])
+                                                             for item in result.get('items', ())]
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def forget_hashes(conn, file_names):
+    """Drop the hashes of deleted originals.
+
+    The surviving copies linked to a deleted first copy stay one gallery
+    entry: the oldest (lowest images rowid) becomes the first copy and the
+    others are linked to it.
+    """
+    file_names = list(file_names)
+    for i in range(0, len(file_names), 500):
+        chunk = file_names[i:i + 500]
+        marks = ','.join('?' * len(chunk))
+        with conn:
+            conn.execute(f"DELETE FROM phashes WHERE file_name IN ({marks})", chunk)
+            rows = conn.execute(f'''SELECT dup_of, file_name, phash FROM (
+                SELECT p.dup_of, p.file_name, p.phash,
+                       (SELECT MIN(i.rowid) FROM images i WHERE i.file_name = p.file_name) AS pos
+                FROM phashes p WHERE p.dup_of IN ({marks}))
+                WHERE pos IS NOT NULL ORDER BY dup_of, pos''', chunk).fetchall()
+            promoted, relinked = [], []
+            for _, group in groupby(rows, key=lambda r: r[0]):
+                _, first, first_hash = next(group)
+                promoted.append((first,))
+                relinked += [(first, _distance(unsigned_hash(first_hash), unsigned_hash(h)), name)
+                             for _, name, h in group]
+            conn.executemany("UPDATE phashes SET dup_of = NULL, distance = NULL WHERE file_name = ?", promoted)
+            conn.executemany("UPDATE phashes SET dup_of = ?, distance = ? WHERE file_name = ?", relinked)
+
+
+def dedup_from_config(cfg: dict, db, gallery_dir: str):
+    dcfg = cfg.get('dedup', {})
+    if not dcfg.get('enabled', True):
+        return None
+    return DuplicateIndex(db, gallery_dir, max_distance=int(dcfg.get('max_distance', 4)),
+                          action=dcfg.get('action', 'link'))
+
+
+# ---------- batch ----------
+
+_POPCOUNT = None
+
+
+def _popcount(x):
+    import numpy as np
+
+    global _POPCOUNT
+    if _POPCOUNT is None:
+        _POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    return _POPCOUNT[x.view(np.uint8)].reshape(x.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def _band_pairs(args):
+    """Candidate pairs sharing one band exactly, verified on both hashes (runs in a worker)."""
+    import numpy as np
+
+    phashes, dhashes, shift, bits, max_distance = args
+    keys = (phashes >> np.uint64(shift)) & np.uint64((1 << bits) - 1)
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    ends = np.r_[starts[1:], len(order)]
+    out = []
+    for s, e in zip(starts, ends):
+        if e - s < 2:
+            continue
+        idx = order[s:e]
+        p, d = phashes[idx], dhashes[idx]
+        for r in range(0, len(idx), 1024):
+            close = ((_popcount(p[r:r + 1024, None] ^ p[None, :]) <= max_distance)
+                     & (_popcount(d[r:r + 1024, None] ^ d[None, :]) <= max_distance))
+            i, j = np.nonzero(close)
+            keep = i + r < j
+            out.append(np.stack([idx[i[keep] + r], idx[j[keep]]], axis=1))
+    return np.concatenate(out) if out else np.empty((0, 2), dtype=np.int64)
+
+
+def find_clusters(phashes, dhashes, max_distance: int, workers: int = None):
+    """Group near-duplicate hashes; returns lists of indices (size >= 2).
+
+    Pigeonhole on ``max_distance + 1`` bands: two hashes within the distance
+    share at least one band exactly, so only same-band buckets are compared,
+    each band in its own process.  Indices refer to the input order.
+    """
+    import numpy as np
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Exact repeats (and degenerate hashes of flat images) collapse to one entry
+    # first, so no band bucket is swamped by identical values.
+    uniq, inverse = np.unique(np.stack([np.asarray(phashes, dtype=np.uint64),
+                                        np.asarray(dhashes, dtype=np.uint64)], axis=1),
+                              axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    phashes, dhashes = np.ascontiguousarray(uniq[:, 0]), np.ascontiguousarray(uniq[:, 1])
+    parent = list(range(len(uniq)))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    bands = min(max_distance, 15) + 1
+    bits = 64 // bands
+    jobs = [(phashes, dhashes, k * bits, bits, max_distance) for k in range(bands)]
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        for pairs in pool.map(_band_pairs, jobs):
+            for a, b in pairs:
+                ra, rb = root(int(a)), root(int(b))
+                if ra != rb:
+                    parent[max(ra, rb)] = min(ra, rb)
+
+    clusters = {}
+    for i, u in enumerate(inverse):
+        clusters.setdefault(root(u), []).append(i)
+    return [c for c in clusters.values() if len(c) > 1]
+
+
+def hash_library(db, gallery_dir: str, workers: int = None):
+    """Hash every original that has no ``phashes`` row yet; returns (hashed, failures)."""
+    db.flush()
+    known = {r[0] for r in db.conn.execute("SELECT file_name FROM phashes")}
+    todo = []
+    for rel, entry in iter_gallery(gallery_dir):
+        lower = entry.name.lower()
+        if lower.endswith(ORIGINAL_EXTS) and not lower.endswith(THUMB_SUFFIX) and rel not in known:
+            todo.append(entry.path)
+    workers = workers or os.cpu_count() or 1
+    print(f"🔎 {len(todo)} originals without perceptual hash, hashing on {workers} processes...")
+
+    hashed, failures = 0, []
+    if todo:
+        from concurrent.futures import ProcessPoolExecutor
+
+        chunksize = max(1, min(64, len(todo) // (workers * 4)))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for image_path, hashes, error in pool.map(_hash_job, todo, chunksize=chunksize):
+                if error:
+                    failures.append((image_path, error))
+                    continue
+                db.queue(INSERT_PHASH, phash_row(rel_name(gallery_dir, image_path), *hashes))
+                hashed += 1
+    db.flush()
+    return hashed, failures
+
+
+def dedup_library(db, gallery_dir: str, max_distance: int = 4, link: bool = False, workers: int = None):
+    """Hash the library, report near-duplicate clusters and optionally link them to their first copy."""
+    hashed, failures = hash_library(db, gallery_dir, workers)
+    rows = db.conn.execute('''SELECT p.file_name, p.phash, p.dhash, MIN(i.timestamp)
+        FROM phashes p LEFT JOIN images i ON i.file_name = p.file_name
+        GROUP BY p.file_name''').fetchall()
+    clusters = find_clusters([unsigned_hash(r[1]) for r in rows], [unsigned_hash(r[2]) for r in rows],
+                             max_distance, workers)
+
+    updates = []
+    dupes = 0
+    for members in clusters:
+        # The first copy is the oldest message; files without a DB row sort last.
+        members.sort(key=lambda i: (rows[i][3] is None, rows[i][3] or 0, rows[i][0]))
+        first = rows[members[0]]
+        updates.append((None, None, first[0]))
+        for i in members[1:]:
+            updates.append((first[0], _distance(unsigned_hash(first[1]), unsigned_hash(rows[i][1])), rows[i][0]))
+        dupes += len(members) - 1
+        print(f"  🔗 {first[0]} <- {len(members) - 1} near-duplicates")
+
+    if link and updates:
+        with db.transaction() as conn:
+            conn.executemany("UPDATE phashes SET dup_of = ?, distance = ? WHERE file_name = ?", updates)
+    print(f"✅ dedup: {hashed} newly hashed, {len(rows)} hashes, {len(clusters)} clusters, "
+          f"{dupes} near-duplicates{' linked' if link else ''}, {len(failures)} failed")
+    return clusters, failures
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from config import config_path, load_config
+    from storage import GalleryDB
+    from manifests import build_from_config
+
+    cfg = load_config()
+
+    parser = argparse.ArgumentParser(description='Find near-duplicate clusters in the gallery')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-distance', type=int, default=int(cfg.get('dedup', {}).get('max_distance', 4)))
+    parser.add_argument('--link', action='store_true', help='mark later copies as duplicates (hides them)')
+    args = parser.parse_args()
+
+    with GalleryDB(config_path('db_path', cfg)) as db:
+        db.ensure_schema()
+        _, failures = dedup_library(db, config_path('tg_gallery_dir', cfg),
+                                    max_distance=args.max_distance, link=args.link, workers=args.workers)
+        if args.link:
+            build_from_config(cfg, db)
+    sys.exit(1 if failures else 0)
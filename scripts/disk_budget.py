@@ -0,0 +1,137 @@
+"""Disk budget for the gallery directory.
+
+Replaces the old per-download ``check_and_clean_disk`` directory scan.  The
+``files`` table in gallery.db indexes every original's size and age and is
+kept current as files are written, so enforcing the budget is:
+
+1. an estimate (last measured free space minus bytes written since) that
+   skips ``shutil.disk_usage`` entirely while we are clearly above the floor,
+   re-measured at most every ``check_interval`` seconds;
+2. when below ``min_free_gb``: one query for the oldest originals whose sizes
+   add up to the bytes needed to reach ``target_free_gb``, then a single
+   batch that unlinks them with their thumbnails and renditions and drops
+   their DB rows.
+
+``seen`` keys are kept, so evicted messages are not downloaded again.
+Several processes may share one gallery (shards.py); a lock file next to
+the DB lets only one of them evict at a time.
+"""
+
+import os
+import time
+import shutil
+
+from storage import GalleryDB
+from metrics import Metrics
+from thumbs import ORIGINAL_EXTS, THUMB_SUFFIX
+from renditions import purge_renditions
+from dedup import forget_hashes
+from cas import release
+from layout import iter_gallery, resolve
+from scheduler import run_lock
+
+GB = 1024 ** 3
+EVICT_CHUNK = 500
+
+
+class DiskBudget:
+    def __init__(self, db: GalleryDB, gallery_dir: str, min_free_gb: float = 5, target_free_gb: float = 10,
+                 check_interval: float = 30.0, metrics: Metrics = None):
+        self.db = db
+        self.metrics = metrics or db.metrics
+        self.gallery_dir = gallery_dir
+        self.min_free = int(min_free_gb * GB)
+        self.target_free = int(max(target_free_gb, min_free_gb) * GB)
+        self.check_interval = check_interval
+        self._free = None
+        self._written = 0
+        self._checked_at = 0.0
+
+    def ensure_index(self):
+        """Seed the ``files`` index with one scandir pass the first time it is used."""
+        if self.db.get_meta('file_index_built'):
+            return
+        count = 0
+        for rel, entry in iter_gallery(self.gallery_dir):
+            lower = entry.name.lower()
+            if not lower.endswith(ORIGINAL_EXTS) or lower.endswith(THUMB_SUFFIX):
+                continue
+            st = entry.stat()
+            self.note_file(rel, st.st_size, st.st_mtime)
+            count += 1
+        self.db.set_meta('file_index_built', int(time.time()))
+        print(f"🗂️  disk index seeded with {count} originals")
+
+    def note_file(self, file_name: str, size: int, mtime: float = None):
+        """Record a newly written original (buffered with the other ingest rows)."""
+        self.db.queue("INSERT OR REPLACE INTO files (file_name, size, mtime) VALUES (?, ?, ?)",
+                      (file_name, int(size), int(mtime if mtime is not None else time.time())))
+        self._written += int(size)
+
+    def _measure(self):
+        self._free = shutil.disk_usage(self.gallery_dir).free
+        self._written = 0
+        self._checked_at = time.monotonic()
+        return self._free
+
+    def maybe_enforce(self):
+        """Cheap check meant to run before every download.  Returns bytes freed."""
+        stale = time.monotonic() - self._checked_at >= self.check_interval
+        if not stale and self._free is not None and self._free - self._written >= self.min_free:
+            return 0
+        if self._measure() >= self.min_free:
+            return 0
+        # Ingest workers sharing the gallery (shards.py) evict one at a time; the others carry on.
+        with run_lock(self.db.db_path + '.evict.lock') as acquired:
+            if not acquired or self._measure() >= self.min_free:
+                return 0
+            freed = self.evict(self.target_free - self._free)
+        self._measure()
+        return freed
+
+    def evict(self, need_bytes: int):
+        """Delete the oldest originals (plus thumbnails, renditions and DB rows) until ``need_bytes`` are freed."""
+        self.db.flush()
+        conn = self.db.conn
+        freed = 0
+        removed = 0
+        started = time.perf_counter()
+        while freed < need_bytes:
+            rows = conn.execute("SELECT file_name, size FROM files ORDER BY mtime LIMIT ?", (EVICT_CHUNK,)).fetchall()
+            if not rows:
+                break
+            batch = []
+            for file_name, size in rows:
+                if freed >= need_bytes:
+                    break
+                freed += self._unlink(file_name)
+                batch.append((file_name,))
+            freed += purge_renditions(conn, self.gallery_dir, [b[0] for b in batch])
+            forget_hashes(conn, [b[0] for b in batch])
+            freed += release(conn, self.gallery_dir, [b[0] for b in batch])
+            with conn:
+                conn.executemany("DELETE FROM images WHERE file_name = ?", batch)
+                conn.executemany("DELETE FROM files WHERE file_name = ?", batch)
+            removed += len(batch)
+        self.metrics.stage('evict', time.perf_counter() - started)
+        self.metrics.inc('pencilai_evicted_files_total', removed)
+        self.metrics.inc('pencilai_evicted_bytes_total', freed)
+        if removed:
+            print(f"🧹 disk budget: evicted {removed} originals, freed {freed / GB:.2f} GB")
+        return freed
+
+    def _unlink(self, file_name: str) -> int:
+        freed = 0
+        base, _ = os.path.splitext(file_name)
+        for name in (file_name, f"{base}{THUMB_SUFFIX}"):
+            path = resolve(self.gallery_dir, name)
+            try:
+                st = os.stat(path)
+                os.remove(path)
+                # A name shared with a blob (cas.py) frees nothing until the blob goes.
+                freed += st.st_size if st.st_nlink == 1 else 0
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"      ⚠️  evict {name} failed: {e}")
+        return freed
@@ -0,0 +1,122 @@
+"""Atomic, verified photo downloads and the per-channel photo size policy.
+
+Downloads are streamed into ``<name>.part`` through ``PartFile``.  When
+Telegram is done the file is checked against the byte count announced for
+the chosen photo size and for a complete image trailer
+(``imageinfo.is_complete``), fsync'd, and only then renamed over the final
+name.  A crash or timeout can only leave a ``.part`` file behind, which the
+next attempt overwrites; a file under its final name is always complete.
+Failed checks raise ``IncompleteDownload`` and go through the normal retry.
+
+Telegram keeps each photo in several sizes (``m`` 320px, ``x`` 800px,
+``y`` 1280px, ``w`` 2560px, progressive variants).  ``SizePolicy`` fetches
+the smallest size whose longer side reaches ``photo_max_side``; the largest
+when none does or the limit is 0.  Channels that are only ever served as
+1080px renditions need not pull 2560px originals.
+
+Config (``telegram`` section):
+  "photo_max_side": 0,
+  "channel_overrides": {"some_channel": {"photo_max_side": 1280}}
+"""
+
+import os
+import hashlib
+
+from imageinfo import is_complete
+
+PART_SUFFIX = '.part'
+
+
+class IncompleteDownload(IOError):
+    pass
+
+
+class PartFile:
+    """Write-only stream for ``download_media`` that lands on ``final_path`` only when complete.
+
+    With ``hashed`` the SHA-256 of the content is computed as it streams
+    (used by the content store, cas.py).
+    """
+
+    def __init__(self, final_path: str, hashed: bool = False):
+        self.final_path = final_path
+        self.path = final_path + PART_SUFFIX
+        self.size = 0
+        self._sha = hashlib.sha256() if hashed else None
+        self._f = open(self.path, 'wb')
+
+    def write(self, data) -> int:
+        if self._sha is not None:
+            self._sha.update(data)
+        self.size += len(data)
+        return self._f.write(data)
+
+    def flush(self):
+        self._f.flush()
+
+    def hexdigest(self) -> str:
+        return self._sha.hexdigest()
+
+    def finish(self, expected: int = None):
+        """fsync and close, then verify; raises ``IncompleteDownload`` for a short or damaged file."""
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        if expected and self.size != expected:
+            raise IncompleteDownload(f"got {self.size} of {expected} bytes")
+        if not self.size or not is_complete(self.path):
+            raise IncompleteDownload(f"truncated or damaged image ({self.size} bytes)")
+
+    def publish(self):
+        os.replace(self.path, self.final_path)
+
+    def discard(self):
+        self._f.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class SizePolicy:
+    def __init__(self, max_side: int = 0, overrides: dict = None):
+        self.max_side = max(0, int(max_side or 0))
+        self.overrides = {ch: max(0, int(o.get('photo_max_side') or 0))
+                          for ch, o in (overrides or {}).items() if 'photo_max_side' in o}
+
+    def max_side_for(self, channel: str) -> int:
+        return self.overrides.get(channel, self.max_side)
+
+    def choose(self, photo, channel: str):
+        """``(size_type, expected_bytes)`` to fetch, or None to let Telethon take the largest."""
+        sizes = sorted((max(w, h), expected, size_type) for size_type, w, h, expected in photo_sizes(photo))
+        if not sizes:
+            return None
+        limit = self.max_side_for(channel)
+        _, expected, size_type = next((s for s in sizes if s[0] >= limit), sizes[-1]) if limit else sizes[-1]
+        return size_type, expected
+
+
+def photo_sizes(photo):
+    """``(type, w, h, bytes)`` of each downloadable size of a Telegram photo."""
+    sizes = []
+    for s in getattr(photo, 'sizes', None) or ():
+        w, h = getattr(s, 'w', 0), getattr(s, 'h', 0)
+        if not w or not h:
+            # Stripped previews and vector outlines are not photos.
+            continue
+        if getattr(s, 'sizes', None):
+            expected = max(s.sizes)  # progressive: the full file is the last step
+        elif isinstance(getattr(s, 'size', None), int):
+            expected = s.size
+        elif getattr(s, 'bytes', None) is not None:
+            expected = len(s.bytes)
+        else:
+            continue
+        sizes.append((s.type, w, h, expected))
+    return sizes
+
+
+def size_policy_from_config(cfg: dict) -> SizePolicy:
+    tg = cfg.get('telegram', {})
+    return SizePolicy(tg.get('photo_max_side', 0), tg.get('channel_overrides'))
@@ -0,0 +1,276 @@
+"""Standalone JSON feed of gallery pages for the front end's infinite scroll.
+
+Serves pages straight from gallery.db without a WordPress bootstrap:
+
+  GET /feed/latest?cursor=&limit=&q=&tag=    newest first, keyset cursor (query.py)
+  GET /feed/channel/<name>?cursor=&limit=     the same, one channel
+  GET /feed/random?seed=&page=                seeded permutation, as manifests.py publishes it
+  GET /metrics                                the server's own counters
+
+Each response is ``{"items": [...], "next": cursor | page | null}`` with
+items in the manifest shape (``f``, ``t``, ``s``, ``w``, ``h``, ``p`` and
+the ``r``/``a`` rendition lists).  Random pages read the sort keys
+manifests.py stores, so new images join them with the next manifest build.
+Queries run on a small thread pool, each
+thread holding its own read-only connection.  Rendered pages are kept in an
+LRU; ``PRAGMA data_version`` tells when another connection (ingest, cleanup)
+committed, which drops the whole cache and moves ``Last-Modified``.  Every
+page carries an ``ETag`` (digest of the body) and ``Last-Modified``, and
+``If-None-Match``/``If-Modified-Since`` get a body-less 304.
+
+Config (``feed`` section, all optional):
+  listen        "127.0.0.1:8765"
+  per_page      defaults to manifests.per_page
+  cache_pages   pages kept in the LRU (512)
+  db_threads    read-only connections (4)
+  cors_origin   Access-Control-Allow-Origin value when the page is on another origin, '' for none
+
+Usage:
+  python feed_server.py [--listen 127.0.0.1:8765]
+"""
+
+import json
+import time
+import asyncio
+import hashlib
+import threading
+import email.utils
+from collections import OrderedDict
+from urllib.parse import unquote, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+from storage import connect
+from metrics import Metrics
+from manifests import LIVE_IMAGES, attach_renditions
+from query import MAX_LIMIT, page as query_page
+from config import config_path, load_config
+
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           500: 'Internal Server Error'}
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def _manifest_item(file_name, thumb_name, size, width, height, placeholder) -> dict:
+    return {'f': file_name, 't': thumb_name or '', 's': size or 0, 'w': width or 0, 'h': height or 0,
+            'p': placeholder or ''}
+
+
+def _int_param(params: dict, name: str, default: int, low: int, high: int) -> int:
+    try:
+        value = int(params.get(name, [default])[0])
+    except ValueError:
+        raise BadRequest(f"{name} must be an integer")
+    return max(low, min(value, high))
+
+
+class FeedServer:
+    def __init__(self, db_path: str, listen: str = '127.0.0.1:8765', per_page: int = 15, random_seeds: int = 8,
+                 random_pages: int = 100, cache_pages: int = 512, db_threads: int = 4, cors_origin: str = '',
+                 metrics: Metrics = None):
+        self.db_path = db_path
+        self.listen = listen
+        self.per_page = max(1, per_page)
+        self.random_seeds = max(1, random_seeds)
+        self.random_pages = max(1, random_pages)
+        self.cache_pages = max(0, cache_pages)
+        self.cors_origin = cors_origin
+        self.metrics = metrics or Metrics()
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, db_threads), thread_name_prefix='feed-db')
+        self._cache = OrderedDict()
+        self._watch = None
+        self._version = None
+        self._modified = 0.0
+        self._server = None
+
+    # ---------- database side (pool threads) ----------
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = connect(self.db_path, readonly=True)
+            self._local.conn = conn
+        return conn
+
+    def _render(self, view: str, arg: str, params: dict) -> bytes:
+        conn = self._conn()
+        if view == 'random':
+            seed = _int_param(params, 'seed', 0, 0, 2 ** 31) % self.random_seeds
+            number = _int_param(params, 'page', 1, 1, self.random_pages)
+            rows = conn.execute(f'''SELECT file_name, thumb_name, file_size, width, height, placeholder
+                FROM perm_keys JOIN images ON images.rowid = perm_keys.img
+                WHERE perm_keys.seed = ? AND {LIVE_IMAGES} ORDER BY perm_keys.perm LIMIT ? OFFSET ?''',
+                                (seed + 1, self.per_page, (number - 1) * self.per_page)).fetchall()
+            items = [_manifest_item(*row) for row in rows]
+            following = number + 1 if len(rows) == self.per_page and number < self.random_pages else None
+        else:
+            limit = _int_param(params, 'limit', self.per_page, 1, MAX_LIMIT)
+            try:
+                result = query_page(conn, limit, params.get('cursor', [None])[0], channel=arg,
+                                    text=params.get('q', [''])[0], tag=params.get('tag', [None])[0])
+            except (ValueError, RuntimeError) as e:
+                raise BadRequest(str(e))
+            items = [_manifest_item(r['file_name'], r['thumb_name'], r['file_size'], r['width'], r['height'],
+                                    r['placeholder']) for r in result.items]
+            following = result.cursor
+        if items:
+            attach_renditions(conn, items)
+        return json.dumps({'items': items, 'next': following}, ensure_ascii=False,
+                          separators=(',', ':')).encode('utf-8')
+
+    # ---------- cache ----------
+
+    def _check_version(self):
+        """Drop the cache when any other connection committed since the last check."""
+        version = self._watch.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._version:
+            self._version = version
+            self._modified = time.time()
+            self._cache.clear()
+
+    async def page(self, view: str, arg: str, params: dict):
+        """``(body, etag, cache_result)`` of one feed page, from the LRU when it is still current."""
+        self._check_version()
+        key = (view, arg, tuple(sorted((k, tuple(v)) for k, v in params.items())))
+        hit = self._cache.get(key)
+        if hit is not None:
+            self._cache.move_to_end(key)
+            return hit + ('hit',)
+        version = self._version
+        body = await asyncio.get_running_loop().run_in_executor(self._pool, self._render, view, arg, params)
+        etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+        # A commit during the query could have made it stale already; serve it but do not keep it.
+        if self.cache_pages and version == self._version:
+            self._cache[key] = (body, etag)
+            while len(self._cache) > self.cache_pages:
+                self._cache.popitem(last=False)
+        return body, etag, 'miss'
+
+    # ---------- HTTP ----------
+
+    def _route(self, path: str):
+        parts = [unquote(p) for p in path.strip('/').split('/')]
+        if len(parts) == 2 and parts[0] == 'feed' and parts[1] in ('latest', 'random'):
+            return parts[1], None
+        if len(parts) == 3 and parts[0] == 'feed' and parts[1] == 'channel' and parts[2]:
+            return 'channel', parts[2]
+        return None, None
+
+    def _not_modified(self, headers: dict, etag: str) -> bool:
+        if 'if-none-match' in headers:
+            return etag in [t.strip() for t in headers['if-none-match'].split(',')] or headers['if-none-match'] == '*'
+        since = headers.get('if-modified-since')
+        if since:
+            try:
+                return int(self._modified) <= email.utils.parsedate_to_datetime(since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=5)
+            lines = request.decode('latin-1').split('\r\n')
+            method, target = (lines[0].split(' ') + ['', ''])[:2]
+            headers = {}
+            for line in lines[1:]:
+                name, sep, value = line.partition(':')
+                if sep:
+                    headers[name.strip().lower()] = value.strip()
+            path, _, qs = target.partition('?')
+            status, body, extra = await self._respond(method, path, parse_qs(qs), headers)
+            head = [f"HTTP/1.1 {status} {REASONS[status]}", "Connection: close"]
+            head += [f"{k}: {v}" for k, v in extra.items()]
+            if status != 304:
+                head.append(f"Content-Length: {len(body)}")
+            writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1')
+                         + (body if method != 'HEAD' and status != 304 else b''))
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, method: str, path: str, params: dict, headers: dict):
+        if method not in ('GET', 'HEAD'):
+            return 405, b'', {'Allow': 'GET, HEAD'}
+        if path == '/metrics':
+            return 200, self.metrics.render().encode('utf-8'), {
+                'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+        view, arg = self._route(path)
+        if view is None:
+            return 404, b'not found\n', {'Content-Type': 'text/plain'}
+        try:
+            body, etag, result = await self.page(view, arg, params)
+        except BadRequest as e:
+            self.metrics.inc('pencilai_feed_requests_total', view=view, result='bad_request')
+            return 400, json.dumps({'error': str(e)}).encode('utf-8'), {'Content-Type': 'application/json'}
+        except Exception as e:
+            self.metrics.inc('pencilai_feed_requests_total', view=view, result='error')
+            print(f"❌ feed {path}: {type(e).__name__}: {e}")
+            return 500, b'{"error":"internal"}', {'Content-Type': 'application/json'}
+        extra = {'Content-Type': 'application/json; charset=utf-8', 'ETag': etag,
+                 'Last-Modified': email.utils.formatdate(self._modified, usegmt=True),
+                 # Always revalidate: the ETag makes that a 304 until something is committed.
+                 'Cache-Control': 'no-cache'}
+        if self.cors_origin:
+            extra['Access-Control-Allow-Origin'] = self.cors_origin
+            extra['Access-Control-Expose-Headers'] = 'ETag, Last-Modified'
+        if self._not_modified(headers, etag):
+            self.metrics.inc('pencilai_feed_requests_total', view=view, result='not_modified')
+            return 304, b'', extra
+        self.metrics.inc('pencilai_feed_requests_total', view=view, result=result)
+        return 200, body, extra
+
+    async def start(self):
+        self._watch = connect(self.db_path, readonly=True)
+        self._check_version()
+        host, _, port = self.listen.rpartition(':')
+        self._server = await asyncio.start_server(self._handle, host or '127.0.0.1', int(port))
+        print(f"🛰️  feed on http://{host or '127.0.0.1'}:{port}/feed/latest")
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        self._pool.shutdown(wait=True)
+        if self._watch is not None:
+            self._watch.close()
+            self._watch = None
+
+
+def server_from_config(cfg: dict, listen: str = None) -> FeedServer:
+    mcfg = cfg.get('manifests', {})
+    fcfg = cfg.get('feed', {})
+    return FeedServer(config_path('db_path', cfg),
+                      listen=listen or fcfg.get('listen', '127.0.0.1:8765'),
+                      per_page=int(fcfg.get('per_page', mcfg.get('per_page', 15))),
+                      random_seeds=int(mcfg.get('random_seeds', 8)),
+                      random_pages=int(mcfg.get('random_pages', 100)),
+                      cache_pages=int(fcfg.get('cache_pages', 512)),
+                      db_threads=int(fcfg.get('db_threads', 4)),
+                      cors_origin=fcfg.get('cors_origin', ''))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve gallery pages as JSON for infinite scroll')
+    parser.add_argument('--listen', default=None, help='host:port, overrides config feed.listen')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(server_from_config(load_config(), args.listen).serve_forever())
+    except KeyboardInterrupt:
+        pass
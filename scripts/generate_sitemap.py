@@ -1,84 +1,203 @@
-"""Generate a simple sitemap for the gallery.
+"""Generate the gallery sitemap.
+
+Pages are streamed from the DB in the same "latest" order as the published
+manifests and written as gzip-compressed shards of at most
+PENCILAI_SITEMAP_SHARD_URLS URLs (50,000 is the protocol limit), plus a
+sitemap index at PENCILAI_SITEMAP_PATH.  Each page's <lastmod> is the newest
+captured_at among its images, and a shard file is only replaced when its
+content changed since the last run (digests live in ``sitemap_shards``).
 
 This open-source version DOES NOT ship any Google Indexing API key.
 If you want to push URLs with Indexing API, provide a service account key file yourself
-and set environment variables.
-
-Env vars:
-  - PENCILAI_GALLERY_DB: path to gallery.db
-  - PENCILAI_SITEMAP_PATH: output sitemap path (default: ../sitemap_gallery.xml)
-  - PENCILAI_BASE_URL: base site url, e.g. https://example.com/
-  - PENCILAI_GOOGLE_INDEXING_KEY: optional service account json key file
+and set it in the config (or the environment).
+
+Config (``sitemap`` section, all optional; the DB is ``paths.db_path`` and
+pages have ``manifests.per_page`` images, like everywhere else):
+  base_url      base site url, e.g. https://example.com/ (default: http://localhost/)
+  path          output sitemap index path (default: ../sitemap_gallery.xml);
+                shards are written next to it as sitemap_gallery-<n>.xml.gz
+  shard_urls    URLs per shard (default: 50000)
+  indexing_key  optional service account json key file (push options: see indexing_push.py)
+
+Env vars override the config: PENCILAI_GALLERY_DB, PENCILAI_PER_PAGE,
+PENCILAI_SITEMAP_PATH, PENCILAI_SITEMAP_SHARD_URLS, PENCILAI_BASE_URL and
+PENCILAI_GOOGLE_INDEXING_KEY.  Both are read when the sitemap is generated
+(``settings_from_config``), not on import.
 """
 
 import os
-import sqlite3
+import gzip
 import datetime
-import json
-
-PER_PAGE = int(os.environ.get('PENCILAI_PER_PAGE', '15'))
-DB_PATH = os.environ.get('PENCILAI_GALLERY_DB', os.path.join(os.path.dirname(__file__), 'gallery.db'))
-SITEMAP_PATH = os.environ.get('PENCILAI_SITEMAP_PATH', os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'sitemap_gallery.xml')))
-BASE_URL = os.environ.get('PENCILAI_BASE_URL', 'http://localhost/')
-KEY_PATH = os.environ.get('PENCILAI_GOOGLE_INDEXING_KEY', '')
-
-
-def generate_sitemap():
-    if not os.path.exists(DB_PATH):
-        raise FileNotFoundError(f"DB not found: {DB_PATH}")
-
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute('SELECT COUNT(*) FROM images')
-    total_images = cur.fetchone()[0]
-    conn.close()
-
-    total_pages = (total_images // PER_PAGE) + 1
-    now = datetime.datetime.utcnow().strftime('%Y-%m-%d')
-
-    xml = ['<?xml version="1.0" encoding="UTF-8"?>']
-    xml.append('<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">')
-
-    for p in range(1, total_pages + 1):
-        priority = '0.9' if p <= 10 else '0.6'
-        loc = f"{BASE_URL}?action=gallery&paged={p}"
-        xml.append(f"  <url><loc>{loc}</loc><lastmod>{now}</lastmod><priority>{priority}</priority></url>")
-
-    xml.append('</urlset>')
-
-    with open(SITEMAP_PATH, 'w', encoding='utf-8') as f:
-        f.write('\n'.join(xml))
-
+import hashlib
+from collections import namedtuple
+
+from storage import GalleryDB
+from manifests import LIVE_IMAGES, LATEST_ORDER
+from config import config_path, load_config, resolve
+
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+Settings = namedtuple('Settings', 'db_path path base_url per_page shard_urls key_path')
+
+
+def settings_from_config(cfg: dict) -> Settings:
+    scfg = cfg.get('sitemap', {})
+    key = os.environ.get('PENCILAI_GOOGLE_INDEXING_KEY') or (
+        resolve(scfg['indexing_key']) if scfg.get('indexing_key') else '')
+    return Settings(
+        db_path=os.environ.get('PENCILAI_GALLERY_DB') or config_path('db_path', cfg),
+        path=os.environ.get('PENCILAI_SITEMAP_PATH') or resolve(scfg.get('path', '../sitemap_gallery.xml')),
+        base_url=os.environ.get('PENCILAI_BASE_URL') or scfg.get('base_url', 'http://localhost/'),
+        per_page=int(os.environ.get('PENCILAI_PER_PAGE') or cfg.get('manifests', {}).get('per_page', 15)),
+        shard_urls=min(50000, int(os.environ.get('PENCILAI_SITEMAP_SHARD_URLS') or scfg.get('shard_urls', 50000))),
+        key_path=key)
+
+
+def _iter_pages(conn, per_page: int):
+    """Yield (page, lastmod_ts) in gallery order, one page of ``per_page`` rows at a time."""
+    rows = conn.execute(
+        f"SELECT COALESCE(captured_at, timestamp, 0) FROM images WHERE {LIVE_IMAGES} ORDER BY {LATEST_ORDER}")
+    page, count, newest = 1, 0, 0
+    for (ts,) in rows:
+        newest = max(newest, int(ts or 0))
+        count += 1
+        if count == per_page:
+            yield page, newest
+            page, count, newest = page + 1, 0, 0
+    if count or page == 1:
+        yield page, newest
+
+
+def _fmt_date(ts: int) -> str:
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).strftime('%Y-%m-%d') if ts else ''
+
+
+def _shard_path(sitemap_path: str, n: int) -> str:
+    base, _ = os.path.splitext(sitemap_path)
+    return f"{base}-{n}.xml.gz"
+
+
+class _ShardWriter:
+    """Streams one shard to a temp gzip file while hashing its uncompressed content."""
+
+    def __init__(self, sitemap_path: str, n: int):
+        self.n = n
+        self.path = _shard_path(sitemap_path, n)
+        self.tmp = f"{self.path}.tmp"
+        self._gz = gzip.GzipFile(self.tmp, 'wb', compresslevel=6, mtime=0)
+        self._hash = hashlib.blake2b(digest_size=16)
+        self.lastmod = 0
+        self.urls = 0
+        self._write(f'<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="{SITEMAP_NS}">\n')
+
+    def _write(self, text: str):
+        data = text.encode('utf-8')
+        self._gz.write(data)
+        self._hash.update(data)
+
+    def add(self, loc: str, lastmod_ts: int, priority: str):
+        lastmod = _fmt_date(lastmod_ts)
+        tag = f"<lastmod>{lastmod}</lastmod>" if lastmod else ''
+        self._write(f"  <url><loc>{loc}</loc>{tag}<priority>{priority}</priority></url>\n")
+        self.lastmod = max(self.lastmod, lastmod_ts)
+        self.urls += 1
+
+    def finish(self, known_digest):
+        """Close the shard; keep it only if its content changed.  Returns the digest."""
+        self._write('</urlset>\n')
+        self._gz.close()
+        digest = self._hash.hexdigest()
+        if digest == known_digest and os.path.exists(self.path):
+            os.remove(self.tmp)
+        else:
+            os.replace(self.tmp, self.path)
+        return digest
+
+
+def generate_sitemap(settings: Settings = None):
+    """Write the shards and the index; returns the number of pages."""
+    s = settings or settings_from_config(load_config())
+    if not os.path.exists(s.db_path):
+        raise FileNotFoundError(f"DB not found: {s.db_path}")
+
+    base = s.base_url.rstrip('/') + '/'
+    db = GalleryDB(s.db_path)
+    db.ensure_schema()
+    conn = db.conn
+    known = {n: (digest, lastmod) for n, digest, lastmod in conn.execute(
+        "SELECT shard, digest, lastmod FROM sitemap_shards")}
+
+    shards = []
+    changed = 0
+    writer = None
+    total_pages = 0
+    try:
+        for page, lastmod_ts in _iter_pages(conn, s.per_page):
+            if writer is None or writer.urls >= s.shard_urls:
+                if writer is not None:
+                    shards.append(writer)
+                writer = _ShardWriter(s.path, len(shards) + 1)
+            priority = '0.9' if page <= 10 else '0.6'
+            writer.add(f"{base}?action=gallery&amp;paged={page}", lastmod_ts, priority)
+            total_pages = page
+        shards.append(writer)
+
+        rows = []
+        for w in shards:
+            old_digest = known.get(w.n, (None, None))[0]
+            digest = w.finish(old_digest)
+            if digest != old_digest:
+                changed += 1
+                rows.append((w.n, digest, _fmt_date(w.lastmod)))
+        stale = [n for n in known if n > len(shards)]
+        for n in stale:
+            if os.path.exists(_shard_path(s.path, n)):
+                os.remove(_shard_path(s.path, n))
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO sitemap_shards (shard, digest, lastmod) VALUES (?, ?, ?)", rows)
+            conn.executemany("DELETE FROM sitemap_shards WHERE shard = ?", [(n,) for n in stale])
+            lastmods = dict(conn.execute("SELECT shard, lastmod FROM sitemap_shards"))
+    finally:
+        db.close()
+
+    # The index is tiny (one line per 50k pages); rewrite it every run.
+    xml = ['<?xml version="1.0" encoding="UTF-8"?>', f'<sitemapindex xmlns="{SITEMAP_NS}">']
+    for w in shards:
+        loc = base + os.path.basename(w.path)
+        lastmod = lastmods.get(w.n)
+        tag = f"<lastmod>{lastmod}</lastmod>" if lastmod else ''
+        xml.append(f"  <sitemap><loc>{loc}</loc>{tag}</sitemap>")
+    xml.append('</sitemapindex>')
+    tmp = s.path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(xml) + '\n')
+    os.replace(tmp, s.path)
+
+    print(f"🗺️  {len(shards)} shards, {changed} rewritten")
     return total_pages
 
 
-def push_to_google(urls):
-    # Optional: only if user provides a key file
-    if not KEY_PATH or not os.path.exists(KEY_PATH):
-        print('No indexing key provided, skip push.')
-        return
+def push_to_google(settings: Settings = None):
+    """Push pages whose content changed since their last successful push (see indexing_push.py)."""
+    from indexing_push import push_changed_pages
 
+    s = settings or settings_from_config(load_config())
     try:
-        from google.oauth2 import service_account
-        from google.auth.transport.requests import AuthorizedSession
-
-        scopes = ['https://www.googleapis.com/auth/indexing']
-        credentials = service_account.Credentials.from_service_account_file(KEY_PATH, scopes=scopes)
-        session = AuthorizedSession(credentials)
-        endpoint = 'https://indexing.googleapis.com/v3/urlNotifications:publish'
-
-        for url in urls:
-            data = json.dumps({'url': url, 'type': 'URL_UPDATED'})
-            r = session.post(endpoint, data=data)
-            print(url, r.status_code)
+        return push_changed_pages(s.db_path, s.base_url, s.per_page, key_path=s.key_path)
     except Exception as e:
         print('Push failed:', e)
+        return 0
+
+
+def main(argv=None):
+    import argparse
+
+    argparse.ArgumentParser(description='Write the sitemap shards and index, then push changed pages').parse_args(argv)
+    settings = settings_from_config(load_config())
+    pages = generate_sitemap(settings)
+    print(f"Sitemap created: {pages} pages -> {settings.path}")
+    push_to_google(settings)
 
 
 if __name__ == '__main__':
-    pages = generate_sitemap()
-    print(f"Sitemap created: {pages} pages -> {SITEMAP_PATH}")
-    # Push newest 20 pages
-    base = BASE_URL.rstrip('/') + '/'
-    urls = [f"{base}?action=gallery&paged={p}" for p in range(1, min(21, pages + 1))]
-    push_to_google(urls)
+    main()
@@ -0,0 +1,86 @@
+"""Header-only image probing (no Pillow, no full decode).
+
+``read_dimensions`` reads at most a few KB from the start of a JPEG, PNG,
+GIF or WebP file and returns ``(width, height)``, or None if the format is
+unknown or the header is damaged.  ``is_complete`` checks the other end:
+whether the file still ends the way its format requires, which catches the
+truncated files an interrupted download leaves behind.
+"""
+
+import os
+import struct
+
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def read_dimensions(path: str):
+    with open(path, 'rb') as f:
+        head = f.read(32)
+        if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+            return struct.unpack('>II', head[16:24])
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            return struct.unpack('<HH', head[6:10])
+        if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+            return _webp_size(head)
+        if head[:2] == b'\xff\xd8':
+            f.seek(2)
+            return _jpeg_size(f)
+    return None
+
+
+def is_complete(path: str) -> bool:
+    """False when a JPEG, PNG, GIF or WebP file is cut short; unknown formats count as complete."""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        head = f.read(12)
+        f.seek(max(0, size - 64))
+        tail = f.read().rstrip(b'\x00')
+    if head[:2] == b'\xff\xd8':
+        return tail.endswith(b'\xff\xd9')
+    if head[:8] == b'\x89PNG\r\n\x1a\n':
+        return tail[-12:-4] == b'\x00\x00\x00\x00IEND'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return tail.endswith(b'\x3b')
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return int.from_bytes(head[4:8], 'little') + 8 <= size
+    return True
+
+
+def _webp_size(head: bytes):
+    chunk = head[12:16]
+    if chunk == b'VP8X':
+        return int.from_bytes(head[24:27], 'little') + 1, int.from_bytes(head[27:30], 'little') + 1
+    if chunk == b'VP8L':
+        bits = int.from_bytes(head[21:25], 'little')
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8 ':
+        w, h = struct.unpack('<HH', head[26:30])
+        return w & 0x3FFF, h & 0x3FFF
+    return None
+
+
+def _jpeg_size(f):
+    while True:
+        byte = f.read(1)
+        while byte and byte != b'\xff':
+            byte = f.read(1)
+        while byte == b'\xff':
+            byte = f.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            continue
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = struct.unpack('>H', length_bytes)[0]
+        if marker in _JPEG_SOF:
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            h, w = struct.unpack('>HH', data[1:5])
+            return w, h
+        if marker == 0xD9 or length < 2:
+            return None
+        f.seek(length - 2, 1)
@@ -0,0 +1,301 @@
+"""Change-driven push of gallery pages to the Google Indexing API.
+
+Only pages whose content changed since their last successful push are sent:
+each page's digest (over the file names it shows) is kept in ``push_state``
+and compared on every run.  Requests go out concurrently over a small pool of
+keep-alive connections, grouped into multipart batch calls when
+PENCILAI_INDEXING_BATCH=1, and are retried with exponential backoff on
+429/5xx.  Successful notifications are counted per UTC day in
+``push_quota`` so a run never exceeds PENCILAI_INDEXING_DAILY_QUOTA.
+
+Env vars (in addition to generate_sitemap.py's):
+  - PENCILAI_INDEXING_ENDPOINT: publish URL (default: Google's); point it at a
+    local stub server for testing - no credentials are needed then
+  - PENCILAI_INDEXING_BATCH_ENDPOINT: batch URL (default: Google's)
+  - PENCILAI_INDEXING_BATCH: 1 to use the batch endpoint (default: 1)
+  - PENCILAI_INDEXING_DAILY_QUOTA: notifications per day (default: 200)
+  - PENCILAI_INDEXING_CONCURRENCY: parallel requests / pooled connections (default: 4)
+"""
+
+import os
+import re
+import json
+import time
+import queue
+import random
+import asyncio
+import datetime
+import hashlib
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+from storage import GalleryDB
+from manifests import LIVE_IMAGES, LATEST_ORDER
+
+GOOGLE_ENDPOINT = 'https://indexing.googleapis.com/v3/urlNotifications:publish'
+GOOGLE_BATCH_ENDPOINT = 'https://indexing.googleapis.com/batch'
+
+ENDPOINT = os.environ.get('PENCILAI_INDEXING_ENDPOINT', GOOGLE_ENDPOINT)
+BATCH_ENDPOINT = os.environ.get('PENCILAI_INDEXING_BATCH_ENDPOINT', GOOGLE_BATCH_ENDPOINT)
+USE_BATCH = os.environ.get('PENCILAI_INDEXING_BATCH', '1') == '1'
+DAILY_QUOTA = int(os.environ.get('PENCILAI_INDEXING_DAILY_QUOTA', '200'))
+CONCURRENCY = max(1, int(os.environ.get('PENCILAI_INDEXING_CONCURRENCY', '4')))
+
+BATCH_SIZE = 100
+MAX_RETRIES = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class ConnectionPool:
+    """A fixed set of keep-alive HTTP(S) connections to one host, shared by worker threads."""
+
+    def __init__(self, url: str, size: int):
+        parts = urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.netloc
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(None)
+
+    def _new(self):
+        cls = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+        return cls(self.host, timeout=30)
+
+    def request(self, method: str, path: str, body: bytes, headers: dict):
+        conn = self._idle.get() or self._new()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            data = resp.read()
+            result = resp.status, dict(resp.getheaders()), data
+            if resp.will_close:
+                conn.close()
+                conn = None
+            return result
+        except Exception:
+            conn.close()
+            conn = None
+            raise
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        while not self._idle.empty():
+            conn = self._idle.get_nowait()
+            if conn is not None:
+                conn.close()
+
+
+class _Auth:
+    """Bearer tokens from a service account key; no-op when there is no key."""
+
+    def __init__(self, key_path: str):
+        self.credentials = None
+        if key_path and os.path.exists(key_path):
+            from google.oauth2 import service_account
+
+            self.credentials = service_account.Credentials.from_service_account_file(
+                key_path, scopes=['https://www.googleapis.com/auth/indexing'])
+
+    def headers(self) -> dict:
+        if self.credentials is None:
+            return {}
+        if not self.credentials.valid:
+            from google.auth.transport.requests import Request
+
+            self.credentials.refresh(Request())
+        return {'Authorization': f'Bearer {self.credentials.token}'}
+
+
+def _today() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d')
+
+
+def changed_pages(conn, base_url: str, per_page: int):
+    """Yield (url, digest) for pages whose content differs from the last push, first page first."""
+    pushed = dict(conn.execute("SELECT url, digest FROM push_state"))
+    rows = conn.execute(f"SELECT file_name FROM images WHERE {LIVE_IMAGES} ORDER BY {LATEST_ORDER}")
+    page, count, h = 1, 0, hashlib.blake2b(digest_size=12)
+    for (file_name,) in rows:
+        h.update(file_name.encode('utf-8') + b'\n')
+        count += 1
+        if count == per_page:
+            url = f"{base_url}?action=gallery&paged={page}"
+            digest = h.hexdigest()
+            if pushed.get(url) != digest:
+                yield url, digest
+            page, count, h = page + 1, 0, hashlib.blake2b(digest_size=12)
+    if count:
+        url = f"{base_url}?action=gallery&paged={page}"
+        digest = h.hexdigest()
+        if pushed.get(url) != digest:
+            yield url, digest
+
+
+def _backoff(attempt: int, headers: dict) -> float:
+    retry_after = headers.get('Retry-After') or headers.get('retry-after')
+    if retry_after and str(retry_after).isdigit():
+        return float(retry_after)
+    return min(2 ** attempt, 60) + random.random()
+
+
+def _batch_body(urls, boundary: str, publish_path: str) -> bytes:
+    parts = []
+    for i, url in enumerate(urls):
+        payload = json.dumps({'url': url, 'type': 'URL_UPDATED'})
+        parts.append(
+            f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <item{i}>\r\n\r\n"
+            f"POST {publish_path} HTTP/1.1\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(payload.encode('utf-8'))}\r\n\r\n{payload}\r\n")
+    parts.append(f"--{boundary}--\r\n")
+    return ''.join(parts).encode('utf-8')
+
+
+def _parse_batch(headers: dict, data: bytes, count: int):
+    """Return the per-item HTTP statuses of a multipart batch response (None = missing)."""
+    ctype = headers.get('Content-Type') or headers.get('content-type') or ''
+    m = re.search(r'boundary="?([^";]+)"?', ctype)
+    statuses = [None] * count
+    if not m:
+        return statuses
+    for part in data.decode('utf-8', 'replace').split('--' + m.group(1)):
+        cid = re.search(r'Content-ID:\s*<?response-item(\d+)>?', part, re.I)
+        status = re.search(r'HTTP/1\.[01] (\d{3})', part)
+        if cid and status and int(cid.group(1)) < count:
+            statuses[int(cid.group(1))] = int(status.group(1))
+    return statuses
+
+
+class IndexingPusher:
+    def __init__(self, key_path: str = '', endpoint: str = ENDPOINT, batch_endpoint: str = BATCH_ENDPOINT,
+                 use_batch: bool = USE_BATCH, concurrency: int = CONCURRENCY):
+        self.auth = _Auth(key_path)
+        self.endpoint = endpoint
+        self.publish_path = urlsplit(endpoint).path or '/'
+        self.batch_endpoint = batch_endpoint
+        self.use_batch = use_batch
+        self.concurrency = concurrency
+        url = batch_endpoint if use_batch else endpoint
+        self.pool = ConnectionPool(url, concurrency)
+        self.path = urlsplit(url).path or '/'
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    @property
+    def enabled(self) -> bool:
+        # Without credentials only a non-Google (stub) endpoint makes sense.
+        return self.auth.credentials is not None or self.endpoint != GOOGLE_ENDPOINT
+
+    def _post(self, body: bytes, headers: dict):
+        return self.pool.request('POST', self.path, body, {**headers, **self.auth.headers()})
+
+    async def _send(self, body: bytes, headers: dict):
+        loop = asyncio.get_running_loop()
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                status, resp_headers, data = await loop.run_in_executor(self._executor, self._post, body, headers)
+            except (OSError, http.client.HTTPException) as e:
+                # Network errors and truncated/garbled responses alike: retry like a 5xx.
+                status, resp_headers, data = 0, {}, str(e).encode()
+            if status not in RETRY_STATUSES and status != 0:
+                return status, resp_headers, data
+            if attempt < MAX_RETRIES:
+                await asyncio.sleep(_backoff(attempt, resp_headers))
+        return status, resp_headers, data
+
+    async def _push_single(self, url: str):
+        body = json.dumps({'url': url, 'type': 'URL_UPDATED'}).encode('utf-8')
+        status, _, _ = await self._send(body, {'Content-Type': 'application/json'})
+        return [(url, status)]
+
+    async def _push_batch(self, urls):
+        results = {}
+        pending = list(urls)
+        for attempt in range(MAX_RETRIES + 1):
+            boundary = f"pencilai_{random.getrandbits(64):x}"
+            body = _batch_body(pending, boundary, self.publish_path)
+            status, headers, data = await self._send(body, {'Content-Type': f'multipart/mixed; boundary={boundary}'})
+            statuses = _parse_batch(headers, data, len(pending)) if status == 200 else [status] * len(pending)
+            retry = []
+            for url, item_status in zip(pending, statuses):
+                results[url] = item_status
+                if item_status in RETRY_STATUSES:
+                    retry.append(url)
+            if not retry or status != 200 or attempt == MAX_RETRIES:
+                break
+            # Individual items can be throttled inside a successful batch; resend just those.
+            pending = retry
+            await asyncio.sleep(_backoff(attempt, {}))
+        return [(url, results[url]) for url in urls]
+
+    async def push(self, urls, on_result):
+        """Push ``urls`` concurrently; ``on_result(url, status)`` is called for each."""
+        if self.use_batch:
+            chunks = [urls[i:i + BATCH_SIZE] for i in range(0, len(urls), BATCH_SIZE)]
+            jobs = [self._push_batch(chunk) for chunk in chunks]
+        else:
+            jobs = [self._push_single(url) for url in urls]
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def run(job):
+            async with slots:
+                for url, status in await job:
+                    on_result(url, status)
+
+        await asyncio.gather(*(run(job) for job in jobs))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.pool.close()
+
+
+def push_changed_pages(db_path: str, base_url: str, per_page: int, key_path: str = '',
+                       daily_quota: int = DAILY_QUOTA, **pusher_kwargs):
+    """Push every changed page, newest first, within today's remaining quota."""
+    pusher = IndexingPusher(key_path, **pusher_kwargs)
+    if not pusher.enabled:
+        print('No indexing key provided, skip push.')
+        pusher.close()
+        return 0
+
+    base = base_url.rstrip('/') + '/'
+    db = GalleryDB(db_path)
+    db.ensure_schema()
+    conn = db.conn
+    day = _today()
+    row = conn.execute("SELECT used FROM push_quota WHERE day = ?", (day,)).fetchone()
+    budget = max(0, daily_quota - (row[0] if row else 0))
+
+    todo = []
+    for item in changed_pages(conn, base, per_page):
+        if len(todo) >= budget:
+            break
+        todo.append(item)
+    digests = dict(todo)
+
+    ok, failed = [], []
+
+    def on_result(url, status):
+        if status == 200:
+            ok.append(url)
+            # Commit each success right away so a crash never re-spends quota on it
+            # (at most a few hundred pushes a day: one small transaction each is fine).
+            with db.transaction() as tx:
+                tx.execute("INSERT OR REPLACE INTO push_state (url, digest, pushed_at) VALUES (?, ?, ?)",
+                           (url, digests[url], int(time.time())))
+                tx.execute("INSERT INTO push_quota (day, used) VALUES (?, 1) "
+                           "ON CONFLICT(day) DO UPDATE SET used = used + 1", (day,))
+        else:
+            failed.append((url, status))
+
+    try:
+        if todo:
+            asyncio.run(pusher.push([url for url, _ in todo], on_result))
+    finally:
+        pusher.close()
+        db.close()
+
+    for url, status in failed:
+        print(f"  ❌ {url} -> {status}")
+    print(f"📣 indexing push: {len(ok)} ok, {len(failed)} failed, budget {budget}/{daily_quota} today")
+    return len(ok)
@@ -0,0 +1,142 @@
+"""Directory layout of the gallery: flat, hashed or date-bucketed shards.
+
+A flat ``tg_gallery/`` with hundreds of thousands of entries makes every
+directory listing (sync, cleanup, disk index, PHP fallback) and every backup
+slower.  With a sharded layout each original lives in a subdirectory chosen
+from its name alone, and its ``_thumb.webp`` and renditions follow it:
+
+  flat   photo_x_2024-05-01_12-00-00_S1_1.jpg
+  hash   3f/photo_x_...jpg          (depth 2: 3f/a0/photo_x_...jpg)
+  date   2024/05/photo_x_...jpg     (names without a date go to undated/)
+
+``images.file_name`` (and every other ``file_name`` column) stores the path
+relative to the gallery directory with '/' separators, so joining it onto
+the gallery dir or the /tg_gallery/ URL works for every layout.  Existing
+flat libraries are moved by migrate_layout.py; until then both forms coexist
+and ``iter_gallery`` lists them together.
+
+Config:  "layout": {"scheme": "flat" | "hash" | "date", "depth": 1}
+"""
+
+import os
+import re
+import hashlib
+import posixpath
+from collections import namedtuple
+
+from thumbs import THUMB_SUFFIX
+from config import load_config
+
+SCHEMES = ('flat', 'hash', 'date')
+UNDATED = 'undated'
+MAX_DEPTH = 2
+
+Layout = namedtuple('Layout', 'scheme depth')
+FLAT = Layout('flat', 0)
+
+_DATE = re.compile(r'(?:^|_)(\d{4})-(\d{2})-\d{2}_')
+# Directory names a shard can have, at any level: hash (2 hex), year, month, undated.
+_SHARD_DIR = re.compile(r'^(?:[0-9a-f]{2}|\d{4}|undated)$')
+
+
+def layout_from_config(cfg: dict) -> Layout:
+    lcfg = cfg.get('layout', {}) or {}
+    scheme = lcfg.get('scheme', 'flat')
+    if scheme not in SCHEMES:
+        raise ValueError(f"unknown layout scheme {scheme!r}, expected one of {', '.join(SCHEMES)}")
+    if scheme == 'flat':
+        return FLAT
+    return Layout(scheme, min(MAX_DEPTH, max(1, int(lcfg.get('depth', 1)))))
+
+
+def load_layout() -> Layout:
+    """Layout of the configured gallery, for scripts that only read ``paths`` otherwise."""
+    return layout_from_config(load_config())
+
+
+def stem_of(name: str) -> str:
+    """Name without directory, extension or thumbnail suffix; an original and its thumb share it."""
+    base = posixpath.basename(name)
+    if base.endswith(THUMB_SUFFIX):
+        return base[:-len(THUMB_SUFFIX)]
+    return os.path.splitext(base)[0]
+
+
+def shard_of(name: str, layout: Layout) -> str:
+    """Relative directory ('' for flat) that ``name`` belongs in."""
+    if layout.scheme == 'hash':
+        digest = hashlib.blake2b(stem_of(name).encode('utf-8'), digest_size=layout.depth).hexdigest()
+        return '/'.join(digest[i:i + 2] for i in range(0, len(digest), 2))
+    if layout.scheme == 'date':
+        m = _DATE.search(stem_of(name))
+        return f"{m.group(1)}/{m.group(2)}" if m else UNDATED
+    return ''
+
+
+def place(name: str, layout: Layout) -> str:
+    """Relative path of ``name`` under ``layout``."""
+    base = posixpath.basename(name)
+    shard = shard_of(base, layout)
+    return f"{shard}/{base}" if shard else base
+
+
+def rel_name(gallery_dir: str, path: str) -> str:
+    """``path`` relative to ``gallery_dir`` with '/' separators, as stored in the DB."""
+    rel = os.path.relpath(path, gallery_dir)
+    return rel.replace(os.sep, '/') if os.sep != '/' else rel
+
+
+def resolve(gallery_dir: str, file_name: str) -> str:
+    return os.path.join(gallery_dir, *file_name.split('/'))
+
+
+def thumb_name_for(file_name: str) -> str:
+    return f"{os.path.splitext(file_name)[0]}{THUMB_SUFFIX}"
+
+
+def shard_dirs(gallery_dir: str):
+    """Yield ``(rel, path)`` of every shard directory, parents before children."""
+    stack = [('', gallery_dir, 0)]
+    while stack:
+        rel, path, level = stack.pop()
+        if level >= MAX_DEPTH:
+            continue
+        try:
+            it = os.scandir(path)
+        except FileNotFoundError:
+            continue
+        with it:
+            for entry in it:
+                if _SHARD_DIR.match(entry.name) and entry.is_dir(follow_symlinks=False):
+                    child = f"{rel}/{entry.name}" if rel else entry.name
+                    yield child, entry.path
+                    stack.append((child, entry.path, level + 1))
+
+
+def iter_gallery(gallery_dir: str, changed_since: int = 0):
+    """Yield ``(rel, DirEntry)`` for every file at the top level and in shard directories.
+
+    Other subdirectories (renditions/, manifests, ...) are not entered.  With
+    ``changed_since`` (an mtime_ns, e.g. an earlier ``tree_mtime``) directories
+    whose mtime is older are skipped: no file was added to them since.
+    """
+    dirs = [('', gallery_dir)] + list(shard_dirs(gallery_dir))
+    for rel_dir, path in dirs:
+        try:
+            if changed_since and os.stat(path).st_mtime_ns < changed_since:
+                continue
+            it = os.scandir(path)
+        except FileNotFoundError:
+            continue
+        with it:
+            for entry in it:
+                if entry.is_file(follow_symlinks=False):
+                    yield (f"{rel_dir}/{entry.name}" if rel_dir else entry.name), entry
+
+
+def tree_mtime(gallery_dir: str) -> int:
+    """Newest mtime_ns of the gallery dir and its shard dirs: changes whenever a file is added anywhere."""
+    newest = os.stat(gallery_dir).st_mtime_ns
+    for _, path in shard_dirs(gallery_dir):
+        newest = max(newest, os.stat(path).st_mtime_ns)
+    return newest
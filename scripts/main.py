@@ -1,58 +1,32 @@
 import os
 import asyncio
-import shutil
 import json
 import time
-import schedule
-import sqlite3
-from telethon import TelegramClient
-from PIL import Image
-
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DEFAULT_CONFIG = os.path.join(BASE_DIR, 'config.json')
+import functools
+from typing import TYPE_CHECKING
+from storage import GalleryDB
+from imageinfo import read_dimensions, is_complete
+from downloads import PartFile, SizePolicy, size_policy_from_config
+from albums import AlbumSampling, record_album, sampling_from_config
+from captions import album_text, message_text, record_caption, record_channel
+from layout import Layout, FLAT, layout_from_config, place
+from config import config_path, load_config as _load_config, resolve
+
+# telethon and the pipeline stages (thumbnails, renditions, dedup, content store,
+# disk budget, manifests, metrics, scheduler) are imported by the modes that use
+# them: import-state, thumbs and the other scripts importing this module start
+# without the whole graph.
+if TYPE_CHECKING:
+    from cas import ContentStore
+    from disk_budget import DiskBudget
+    from metrics import Metrics
+    from replay import ScanRecorder
+    from thumbs import ThumbnailStage
 
 
 def load_config():
-    cfg_path = os.environ.get('PENCILAI_CONFIG', DEFAULT_CONFIG)
-    if not os.path.exists(cfg_path):
-        raise FileNotFoundError(
-            f"Config not found: {cfg_path}. Copy config.example.json to config.json and fill in your secrets."
-        )
-    with open(cfg_path, 'r', encoding='utf-8') as f:
-        return json.load(f)
-
-
-def init_db(db_path: str):
-    os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS images
-        (id TEXT PRIMARY KEY, channel TEXT, timestamp INTEGER, file_name TEXT, captured_at INTEGER)''')
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sort_flow ON images (captured_at, timestamp)")
-    conn.commit()
-    conn.close()
-
-
-def save_to_db(db_path: str, msg_id, channel, timestamp, file_name, captured_at):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR IGNORE INTO images VALUES (?, ?, ?, ?, ?)",
-                   (str(msg_id), channel, int(timestamp), file_name, captured_at))
-    conn.commit()
-    conn.close()
-
-
-def load_set(path: str):
-    if os.path.exists(path):
-        with open(path, 'r', encoding='utf-8') as f:
-            return set(line.strip() for line in f if line.strip())
-    return set()
-
-
-def append_line(path: str, line: str):
-    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
-    with open(path, 'a', encoding='utf-8') as f:
-        f.write(line + "\n")
+    # Ingest needs the real secrets: no fallback to config.example.json.
+    return _load_config(require=True)
 
 
 def load_json(path: str):
@@ -71,216 +45,570 @@ def save_json(path: str, obj):
         json.dump(obj, f, ensure_ascii=False)
 
 
-def check_and_clean_disk(save_path_root: str, min_free_gb: int = 5, target_free_gb: int = 10):
-    usage = shutil.disk_usage(save_path_root)
-    free_gb = usage.free / (1024 ** 3)
-    if free_gb >= min_free_gb:
-        return
+def import_legacy_state(db: GalleryDB, history_file: str, last_ids_path: str, force: bool = False):
+    """One-shot import of download_history.txt and last_ids.json into the DB.
 
-    all_files = []
-    for f in os.listdir(save_path_root):
-        if f.lower().endswith(('.jpg', '.jpeg', '.png', '.webp', '.gif')):
-            p = os.path.join(save_path_root, f)
-            all_files.append((p, os.path.getmtime(p)))
-    all_files.sort(key=lambda x: x[1])
+    History lines are bare message IDs; each is attributed to the channel(s)
+    whose images row carries that ID, or stored with an empty channel (which
+    ``GalleryDB.is_seen`` treats as "seen in any channel") when none does.
+    """
+    if not force and db.get_meta('legacy_state_imported'):
+        return
+    if not os.path.exists(history_file) and not os.path.exists(last_ids_path):
+        return
 
-    for file_path, _ in all_files:
-        try:
-            os.remove(file_path)
-            if shutil.disk_usage(save_path_root).free / (1024 ** 3) >= target_free_gb:
-                break
-        except Exception:
-            pass
+    imported = 0
+    if os.path.exists(history_file):
+        conn = db.conn
+        with open(history_file, 'r', encoding='utf-8') as f:
+            chunk = []
+            for line in f:
+                line = line.strip()
+                if line.isdigit():
+                    chunk.append((int(line),))
+                if len(chunk) >= 10000:
+                    imported += _import_history_chunk(conn, chunk)
+                    chunk = []
+            if chunk:
+                imported += _import_history_chunk(conn, chunk)
+
+    for channel, last_id in load_json(last_ids_path).items():
+        if str(last_id).isdigit():
+            db.set_cursor(channel, int(last_id))
+
+    db.set_meta('legacy_state_imported', int(time.time()))
+    print(f"📥 imported {imported} history IDs and last_ids into {os.path.basename(db.db_path)}")
+
+
+def _import_history_chunk(conn, chunk):
+    with conn:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS legacy_ids (msg_id INTEGER PRIMARY KEY)")
+        conn.execute("DELETE FROM legacy_ids")
+        conn.executemany("INSERT OR IGNORE INTO legacy_ids (msg_id) VALUES (?)", chunk)
+        conn.execute('''INSERT OR IGNORE INTO seen (channel, msg_id)
+            SELECT i.channel, l.msg_id FROM legacy_ids l JOIN images i ON i.id = CAST(l.msg_id AS TEXT)''')
+        conn.execute('''INSERT OR IGNORE INTO seen (channel, msg_id)
+            SELECT '', l.msg_id FROM legacy_ids l
+            WHERE NOT EXISTS (SELECT 1 FROM images i WHERE i.id = CAST(l.msg_id AS TEXT))''')
+    return len(chunk)
+
+
+class ChannelProgress:
+    """Tracks which scanned message IDs of one channel are still in flight.
+
+    The watermark only moves past a message once it (and every lower ID seen
+    in this run) has been stored, so a failed download is retried next run.
+    """
+
+    def __init__(self, min_id: int):
+        self.min_id = min_id
+        self.max_seen = min_id
+        self.pending = set()
+        self.failed = set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def seen(self, msg_id: int):
+        self.max_seen = max(self.max_seen, msg_id)
+
+    def add(self, msg_id: int):
+        self.pending.add(msg_id)
+        self._idle.clear()
+
+    def settle(self, msg_id: int, ok: bool):
+        self.pending.discard(msg_id)
+        if not ok:
+            self.failed.add(msg_id)
+        if not self.pending:
+            self._idle.set()
+
+    async def wait(self):
+        await self._idle.wait()
+
+    def watermark(self) -> int:
+        blocked = self.pending | self.failed
+        if not blocked:
+            return self.max_seen
+        return max(self.min_id, min(blocked) - 1)
+
+
+class IngestPipeline:
+    """Producer/consumer download pipeline shared by every channel scanner of a run.
+
+    Channel scanners push photo messages onto a bounded queue that a pool of
+    download workers drains.  ``per_channel`` caps how many downloads of one
+    channel may be queued or running at once; the worker count is the global cap.
+    Stage latencies, bytes per channel and queue depths go to ``metrics``.
+    Downloads are atomic and verified, in the photo size ``sizes`` picks per
+    channel (downloads.py); with a ``cas`` content store they are stored by
+    content (cas.py).  Albums are sampled and recorded per ``sampling`` (albums.py);
+    the caption passed to ``submit`` is recorded with the image (captions.py).
+    A ``recorder`` archives every scanned message for offline replays (replay.py).
+    """
+
+    def __init__(self, client, batch_time, save_path_root: str, db: GalleryDB,
+                 workers: int = 4, per_channel: int = 2, max_retries: int = 3, thumbs: 'ThumbnailStage' = None,
+                 disk: 'DiskBudget' = None, metrics: 'Metrics' = None, layout: Layout = FLAT,
+                 cas: 'ContentStore' = None, sizes: SizePolicy = None, sampling: AlbumSampling = None,
+                 recorder: 'ScanRecorder' = None):
+        from telethon import errors
+
+        self.client = client
+        self.batch_time = batch_time
+        self.save_path_root = save_path_root
+        self.db = db
+        self.workers = max(1, workers)
+        self.per_channel = max(1, per_channel)
+        self.max_retries = max(0, max_retries)
+        self.thumbs = thumbs
+        self.disk = disk
+        self.metrics = metrics or db.metrics
+        self.layout = layout
+        self.cas = cas
+        self.sizes = sizes
+        self.sampling = sampling or AlbumSampling()
+        self.recorder = recorder
+        self.queue = asyncio.Queue(maxsize=self.workers * 2)
+        self._channel_slots = {}
+        self._captions = {}
+        self._pause_until = 0.0
+        self._flood_wait = errors.FloodWaitError
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._flusher()))
+
+    async def stop(self):
+        await self.queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.sample_queues()
+
+    def sample_queues(self):
+        self.metrics.set('pencilai_queue_depth', self.queue.qsize(), queue='download')
+        self.metrics.set('pencilai_queue_depth', self.thumbs.backlog if self.thumbs is not None else 0,
+                         queue='thumbnail')
+        self.metrics.set('pencilai_queue_depth', self.db.pending, queue='db_buffer')
+
+    async def _flusher(self):
+        # Time-based flush for quiet periods when no new rows trigger one.
+        while True:
+            await asyncio.sleep(self.db.flush_interval)
+            self.sample_queues()
+            self.db.maybe_flush()
+
+    async def submit(self, message, channel_name, group_id, progress: ChannelProgress, caption: str = ''):
+        slots = self._channel_slots.setdefault(channel_name, asyncio.Semaphore(self.per_channel))
+        await slots.acquire()
+        progress.add(message.id)
+        if caption:
+            self._captions[(channel_name, message.id)] = caption
+        await self.queue.put((message, channel_name, group_id, progress))
+
+    async def _worker(self):
+        while True:
+            message, channel_name, group_id, progress = await self.queue.get()
+            ok = False
+            try:
+                ok = await self._download_with_retry(message, channel_name, group_id)
+            except Exception as e:
+                print(f"      ❌ download failed: {e}")
+            finally:
+                self._channel_slots[channel_name].release()
+                self._captions.pop((channel_name, message.id), None)
+                progress.settle(message.id, ok)
+                self.queue.task_done()
+
+    async def _wait_flood(self):
+        delay = self._pause_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _download_with_retry(self, message, channel_name, group_id) -> bool:
+        for attempt in range(self.max_retries + 1):
+            await self._wait_flood()
+            try:
+                return await self._download(message, channel_name, group_id)
+            except self._flood_wait as e:
+                # Telegram tells us exactly how long to back off; pause every worker, not just this one.
+                wait_s = int(getattr(e, 'seconds', 0) or 0) + 1
+                self.metrics.inc('pencilai_flood_wait_seconds_total', wait_s)
+                self._pause_until = max(self._pause_until, time.monotonic() + wait_s)
+                print(f"      ⏳ FLOOD_WAIT {wait_s}s (attempt {attempt + 1})")
+            except Exception as e:
+                if attempt >= self.max_retries:
+                    print(f"      ❌ download failed: {e}")
+                    return False
+                await asyncio.sleep(min(2 ** attempt, 30))
+        return False
 
+    async def _download(self, message, channel_name, group_id) -> bool:
+        msg_id_str = str(message.id)
+        if self.db.is_seen(channel_name, message.id):
+            self.metrics.inc('pencilai_stage_total', stage='download', result='skipped')
+            return True
+
+        base_name = f"photo_{channel_name}_{message.date.strftime('%Y-%m-%d_%H-%M-%S')}_{group_id}_{message.id}.jpg"
+        # Relative to the gallery dir, including the shard directory of the configured layout.
+        file_name = place(base_name, self.layout)
+        full_path = os.path.join(self.save_path_root, file_name)
+
+        if os.path.exists(full_path) and not is_complete(full_path):
+            # Truncated by a crash before downloads were atomic: fetch it again.
+            print(f"      ⚠️  incomplete file, downloading again: {file_name}")
+        elif os.path.exists(full_path):
+            if self.cas is not None:
+                # Left by a run that stopped before its rows were committed.
+                self.cas.adopt(file_name, full_path)
+            self._record(msg_id_str, channel_name, message, file_name, full_path)
+            self.metrics.inc('pencilai_stage_total', stage='download', result='skipped')
+            return True
+
+        if self.disk is not None:
+            self.disk.maybe_enforce()
+        if self.layout.scheme != 'flat':
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        choice = self.sizes.choose(message.photo, channel_name) if self.sizes is not None else None
+        kwargs = {'thumb': choice[0]} if choice else {}
+        # Failed attempts are counted as download errors; FLOOD_WAIT back-off is not part of the latency.
+        with self.metrics.timed('download'):
+            # Streamed into <name>.part and renamed only once verified, so a final name is never truncated.
+            # With the content store it is hashed on the way; content we already have becomes a link.
+            out = self.cas.open(full_path) if self.cas is not None else PartFile(full_path)
+            try:
+                await self.client.download_media(message, file=out, **kwargs)
+                out.finish(choice[1] if choice else None)
+            except BaseException:
+                out.discard()
+                raise
+            if self.cas is not None:
+                hit = self.cas.commit(out, file_name)
+            else:
+                out.publish()
+                hit = False
+        print(f"      {'♻️  already stored, linked' if hit else '✅ downloaded'}: {file_name}")
+        size = self._record(msg_id_str, channel_name, message, file_name, full_path)
+        self.metrics.inc('pencilai_download_bytes_total', size, channel=channel_name)
+        if self.disk is not None:
+            self.disk.note_file(file_name, size)
+        if self.thumbs is not None:
+            shared = self.cas.reuse(file_name, full_path, out.hexdigest()) if hit else None
+            if shared is not None:
+                self.thumbs.reuse(full_path, shared)
+            else:
+                await self.thumbs.submit(full_path)
+        return True
 
-def create_thumbnail_1080p(image_path: str):
-    target_width = 1080
-    size_threshold = 300 * 1024
-    try:
-        if os.path.getsize(image_path) < size_threshold:
-            return
-        base, _ = os.path.splitext(image_path)
-        thumb_path = f"{base}_thumb.webp"
-        if os.path.exists(thumb_path):
-            return
-        with Image.open(image_path) as img:
-            if img.mode in ("RGBA", "P"):
-                img = img.convert("RGB")
-            if img.size[0] > target_width:
-                w_percent = (target_width / float(img.size[0]))
-                new_height = int(float(img.size[1]) * float(w_percent))
-                img = img.resize((target_width, new_height), Image.Resampling.LANCZOS)
-            img.save(thumb_path, "WEBP", quality=85)
-    except Exception:
-        pass
-
-
-async def download_images(client, message_list, history_set, channel_name, group_id, batch_time,
-                          save_path_root: str, history_file: str, db_path: str):
+    def _record(self, msg_id_str, channel_name, message, file_name, full_path) -> int:
+        # Size and header dimensions are nearly free now; the render job adds thumb and placeholder.
+        size = os.path.getsize(full_path)
+        try:
+            dims = read_dimensions(full_path) or (None, None)
+        except OSError:
+            dims = (None, None)
+        self.db.mark_seen(channel_name, message.id)
+        self.db.add_image(msg_id_str, channel_name, message.date.timestamp(), file_name, self.batch_time,
+                          width=dims[0], height=dims[1], file_size=size)
+        record_caption(self.db, channel_name, message.id, self._captions.pop((channel_name, message.id), ''))
+        return size
+
+
+async def download_images(pipeline: IngestPipeline, message_list, channel_name, group_id, progress: ChannelProgress,
+                          caption: str = None):
+    # ``caption`` is the album's; a single photo carries its own.
     for message in message_list:
         if not message.photo:
             continue
-
-        msg_id_str = str(message.id)
-        if msg_id_str in history_set:
+        if pipeline.db.is_seen(channel_name, message.id):
             continue
+        await pipeline.submit(message, channel_name, group_id, progress,
+                              caption=message_text(message) if caption is None else caption)
 
-        file_name = f"photo_{channel_name}_{message.date.strftime('%Y-%m-%d_%H-%M-%S')}_{group_id}_{message.id}.jpg"
-        full_path = os.path.join(save_path_root, file_name)
 
-        if os.path.exists(full_path):
-            append_line(history_file, msg_id_str)
-            history_set.add(msg_id_str)
-            save_to_db(db_path, msg_id_str, channel_name, message.date.timestamp(), file_name, batch_time)
-            continue
-
-        check_and_clean_disk(save_path_root)
-        try:
-            await client.download_media(message, file=full_path)
-            print(f"      ✅ downloaded: {file_name}")
-            append_line(history_file, msg_id_str)
-            history_set.add(msg_id_str)
-            save_to_db(db_path, msg_id_str, channel_name, message.date.timestamp(), file_name, batch_time)
-            create_thumbnail_1080p(full_path)
-        except Exception as e:
-            print(f"      ❌ download failed: {e}")
-
-
-async def process_group_buffer(client, buffer, history_set, channel_name, batch_time,
-                               save_path_root: str, history_file: str, db_path: str):
+async def process_group_buffer(pipeline: IngestPipeline, buffer, channel_name, progress: ChannelProgress):
     if not buffer:
         return
     g_id = buffer[0].grouped_id if buffer[0].grouped_id else f"S{buffer[0].id}"
     sorted_msgs = sorted(buffer, key=lambda x: x.id)
     total = len(sorted_msgs)
-    targets = [sorted_msgs[i] for i in range(0, total, 3)][:4]
+    policy = pipeline.sampling.for_channel(channel_name)
+    picked = policy.positions(total)
+    targets = [sorted_msgs[i] for i in picked]
+    if buffer[0].grouped_id:
+        record_album(pipeline.db, channel_name, buffer[0].grouped_id, sorted_msgs, picked, policy)
     print(f"  📦 group {g_id}: {total} photos -> sampled {len(targets)}")
-    await download_images(client, targets, history_set, channel_name, g_id, batch_time,
-                          save_path_root, history_file, db_path)
+    await download_images(pipeline, targets, channel_name, g_id, progress, caption=album_text(sorted_msgs))
 
 
-async def process_channel(client, channel_name, last_ids: dict, history_set, batch_time,
-                          save_path_root: str, history_file: str, db_path: str, limit_count: int):
-    min_id = int(last_ids.get(channel_name, 0) or 0)
+async def process_channel(pipeline: IngestPipeline, channel_name, limit_count: int):
+    min_id = pipeline.db.get_cursor(channel_name)
+    progress = ChannelProgress(min_id)
     current_group_buffer = []
     current_grouped_id = None
-    new_max_id = min_id
 
     print(f"📡 scanning {channel_name} (from id {min_id})")
-
-    async for message in client.iter_messages(channel_name, limit=limit_count, min_id=min_id):
-        new_max_id = max(new_max_id, message.id)
+    try:
+        record_channel(pipeline.db, channel_name, await pipeline.client.get_entity(channel_name))
+    except Exception as e:
+        # Metadata only; iter_messages reports a channel that really cannot be resolved.
+        print(f"⚠️  {channel_name}: channel info unavailable: {e}")
+
+    metrics = pipeline.metrics
+    # ``scan`` is the wait for the next message only; time spent queueing downloads is excluded.
+    asked = time.perf_counter()
+    async for message in pipeline.client.iter_messages(channel_name, limit=limit_count, min_id=min_id):
+        metrics.stage('scan', time.perf_counter() - asked)
+        metrics.inc('pencilai_messages_scanned_total', channel=channel_name)
+        progress.seen(message.id)
+        if pipeline.recorder is not None:
+            pipeline.recorder.record(channel_name, message)
 
         if message.photo:
             if message.grouped_id:
                 if current_grouped_id != message.grouped_id:
                     if current_group_buffer:
-                        await process_group_buffer(client, current_group_buffer, history_set, channel_name, batch_time,
-                                                   save_path_root, history_file, db_path)
+                        await process_group_buffer(pipeline, current_group_buffer, channel_name, progress)
                     current_grouped_id = message.grouped_id
                     current_group_buffer = [message]
                 else:
                     current_group_buffer.append(message)
             else:
                 if current_group_buffer:
-                    await process_group_buffer(client, current_group_buffer, history_set, channel_name, batch_time,
-                                               save_path_root, history_file, db_path)
+                    await process_group_buffer(pipeline, current_group_buffer, channel_name, progress)
                     current_group_buffer = []
                     current_grouped_id = None
-                await download_images(client, [message], history_set, channel_name, f"S{message.id}", batch_time,
-                                      save_path_root, history_file, db_path)
+                await download_images(pipeline, [message], channel_name, f"S{message.id}", progress)
         else:
             if current_group_buffer:
-                await process_group_buffer(client, current_group_buffer, history_set, channel_name, batch_time,
-                                           save_path_root, history_file, db_path)
+                await process_group_buffer(pipeline, current_group_buffer, channel_name, progress)
                 current_group_buffer = []
                 current_grouped_id = None
+        asked = time.perf_counter()
 
     if current_group_buffer:
-        await process_group_buffer(client, current_group_buffer, history_set, channel_name, batch_time,
-                                   save_path_root, history_file, db_path)
+        await process_group_buffer(pipeline, current_group_buffer, channel_name, progress)
 
+    # iter_messages walks newest -> oldest, so the watermark is only known once
+    # the scan is over and every queued download of this channel has settled.
+    await progress.wait()
+    new_max_id = progress.watermark()
     if new_max_id > min_id:
-        last_ids[channel_name] = new_max_id
-
+        pipeline.db.set_cursor(channel_name, new_max_id)
+    if progress.failed:
+        print(f"⚠️  {channel_name}: {len(progress.failed)} downloads failed, last id held at {new_max_id}")
+
+
+def _metrics_paths(cfg: dict):
+    mc = cfg.get('metrics', {})
+
+    def path(key, default):
+        value = mc.get(key, default)
+        return resolve(value) if value else ''
+
+    return (path('textfile', ''), path('summary_log', './metrics/runs.jsonl'), path('profile_dir', './metrics/profiles'))
+
+
+async def run_task_once(cfg: dict, metrics: 'Metrics' = None, profile: str = None, channels=None,
+                        manifests: bool = True, make_client=None, record: str = None):
+    """One ingest run over ``channels`` (default: all configured), ending with a JSON summary.
+
+    ``profile`` ('cpu'/'mem') profiles just this run.  Returns the summary, or
+    None when another process is already running against the same session.
+    ``manifests`` rebuilds the page manifests afterwards; ``make_client(session,
+    api_id, api_hash)`` builds the Telegram client (default ``TelegramClient``; a stub
+    in tests, see shards.py).
+    ``record`` appends every scanned message to that archive (replay.py).
+    """
+    from metrics import Metrics, run_summary, log_summary, profiled
+    from scheduler import gallery_lock, run_lock
+
+    session_file = config_path('session_file', cfg)
+    with run_lock(session_file + '.lock') as acquired, gallery_lock(config_path('db_path', cfg)) as ingesting:
+        if not acquired:
+            print("⏭️  another ingest run holds the Telegram session, skipped")
+            return None
+        if not ingesting:
+            print("⏭️  a layout migration or content-store run holds the gallery, skipped")
+            return None
+        textfile, summary_log, profile_dir = _metrics_paths(cfg)
+        standalone = metrics is None
+        metrics = metrics or Metrics()
+        since = metrics.snapshot()
+        metrics.reset_peaks()
+        error = None
+        try:
+            with profiled(profile, profile_dir):
+                await _ingest(cfg, metrics, channels, manifests=manifests, make_client=make_client, record=record)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            summary = run_summary(metrics, since, error)
+            metrics.set('pencilai_last_run_timestamp_seconds', int(time.time()))
+            metrics.set('pencilai_last_run_seconds', summary['seconds'])
+            metrics.set('pencilai_last_run_ok', int(error is None))
+            log_summary(summary, summary_log)
+            if standalone and textfile:
+                metrics.write_textfile(textfile)
+        return summary
+
+
+async def _ingest(cfg: dict, metrics: 'Metrics', channels=None, manifests: bool = True, make_client=None,
+                  record: str = None):
+    from cas import store_from_config
+    from dedup import dedup_from_config
+    from disk_budget import DiskBudget
+    from manifests import build_from_config
+    from renditions import record_result, render_job, spec_from_config
+    from replay import ScanRecorder
+    from thumbs import ThumbnailStage
 
-async def run_task_once(cfg: dict):
     tg = cfg['telegram']
-    paths = cfg['paths']
 
     api_id = int(tg['api_id'])
     api_hash = str(tg['api_hash'])
     phone_number = str(tg['phone_number'])
     two_step_password = str(tg.get('two_step_password') or '')
 
-    channels = tg.get('channels', [])
+    if channels is None:
+        channels = tg.get('channels', [])
     limit_count = int(tg.get('limit_count', 5000))
+    download_workers = int(tg.get('download_workers', 4))
+    channel_concurrency = max(1, int(tg.get('channel_concurrency', 3)))
+    per_channel_downloads = int(tg.get('per_channel_downloads', 2))
+    thumb_workers = int(tg.get('thumb_workers', 0)) or None
 
-    site_root = os.path.abspath(os.path.join(BASE_DIR, paths.get('site_root', '..')))
-    save_path_root = os.path.abspath(os.path.join(BASE_DIR, paths.get('tg_gallery_dir', '../tg_gallery')))
-    db_path = os.path.abspath(os.path.join(BASE_DIR, paths.get('db_path', './gallery.db')))
+    save_path_root = config_path('tg_gallery_dir', cfg)
+    db_path = config_path('db_path', cfg)
 
-    session_file = os.path.abspath(os.path.join(BASE_DIR, paths.get('session_file', './anon')))
-    timer_config = os.path.abspath(os.path.join(BASE_DIR, paths.get('timer_config', './timer_config.json')))
-    last_ids_path = os.path.abspath(os.path.join(BASE_DIR, paths.get('last_ids', './last_ids.json')))
-    history_file = os.path.abspath(os.path.join(BASE_DIR, paths.get('download_history', './download_history.txt')))
+    session_file = config_path('session_file', cfg)
+    last_ids_path = config_path('last_ids', cfg)
+    history_file = config_path('download_history', cfg)
 
     os.makedirs(save_path_root, exist_ok=True)
-    init_db(db_path)
+    db = GalleryDB(db_path, metrics=metrics)
+    db.ensure_schema()
+
+    import_legacy_state(db, history_file, last_ids_path)
 
-    history_set = load_set(history_file)
-    last_ids = load_json(last_ids_path)
+    disk_cfg = cfg.get('disk', {})
+    disk = DiskBudget(db, save_path_root,
+                      min_free_gb=float(disk_cfg.get('min_free_gb', 5)),
+                      target_free_gb=float(disk_cfg.get('target_free_gb', 10)),
+                      check_interval=float(disk_cfg.get('check_interval', 30)))
+    disk.ensure_index()
 
     batch_time = int(time.time())
 
-    client = TelegramClient(session_file, api_id, api_hash)
+    if make_client is None:
+        from telethon import TelegramClient as make_client
+    client = make_client(session_file, api_id, api_hash)
     await client.start(phone=phone_number, password=(two_step_password or None))
 
-    async with client:
-        for ch in channels:
-            try:
-                await process_channel(client, ch, last_ids, history_set, batch_time,
-                                      save_path_root, history_file, db_path, limit_count)
-            except Exception as e:
-                print(f"❌ channel {ch} failed: {e}")
+    dedup = dedup_from_config(cfg, db, save_path_root)
 
-    save_json(last_ids_path, last_ids)
+    def on_rendered(path, result):
+        # Reposts are linked to (or replaced by) their first copy before they reach the gallery.
+        if dedup is not None and dedup.check(path, result) == 'rejected':
+            return
+        record_result(db, path, result, save_path_root)
 
+    # One pool job per download renders every rendition width plus the legacy thumbnail.
+    thumbs = ThumbnailStage(workers=thumb_workers,
+                            job=functools.partial(render_job, spec=spec_from_config(cfg), gallery_dir=save_path_root),
+                            on_result=on_rendered, metrics=metrics)
 
-async def run_daemon(cfg: dict):
-    timer_path = os.path.abspath(os.path.join(BASE_DIR, cfg['paths'].get('timer_config', './timer_config.json')))
+    async with client:
+        pipeline = IngestPipeline(client, batch_time, save_path_root, db,
+                                  workers=download_workers, per_channel=per_channel_downloads, thumbs=thumbs,
+                                  disk=disk, layout=layout_from_config(cfg),
+                                  cas=store_from_config(cfg, db, save_path_root, metrics),
+                                  sizes=size_policy_from_config(cfg), sampling=sampling_from_config(cfg),
+                                  recorder=ScanRecorder(record) if record else None)
+        pipeline.start()
+        channel_slots = asyncio.Semaphore(channel_concurrency)
+
+        async def scan(ch):
+            async with channel_slots:
+                try:
+                    await process_channel(pipeline, ch, limit_count)
+                except Exception as e:
+                    print(f"❌ channel {ch} failed: {e}")
 
-    if not os.path.exists(timer_path):
-        conf = {"mode": "interval", "days": 0, "hours": 6, "mins": 0}
-        save_json(timer_path, conf)
-    else:
-        conf = load_json(timer_path)
+        try:
+            await asyncio.gather(*(scan(ch) for ch in channels))
+        finally:
+            await pipeline.stop()
+            await thumbs.close()
+            if pipeline.recorder is not None:
+                pipeline.recorder.close()
+            try:
+                if manifests:
+                    build_from_config(cfg, db)
+            finally:
+                db.close()
 
-    schedule.clear()
 
-    def job():
-        asyncio.create_task(run_task_once(cfg))
+async def run_daemon(cfg: dict, profile: str = None, record: str = None):
+    from metrics import Metrics, MetricsExporter
+    from scheduler import Scheduler
 
-    if conf.get('mode') == 'daily':
-        schedule.every().day.at(conf['time']).do(job)
-    else:
-        total_m = max(int(conf.get('days', 0)) * 1440 + int(conf.get('hours', 0)) * 60 + int(conf.get('mins', 0)), 1)
-        schedule.every(total_m).minutes.do(job)
+    timer_path = config_path('timer_config', cfg)
+    db_path = config_path('db_path', cfg)
+
+    # One registry for the daemon's lifetime: counters are cumulative, as Prometheus expects.
+    metrics = Metrics()
+    textfile, _, _ = _metrics_paths(cfg)
+    exporter = MetricsExporter(metrics, textfile=textfile, listen=str(cfg.get('metrics', {}).get('listen') or ''))
+    await exporter.start()
 
-    await run_task_once(cfg)
+    pending_profile = [profile]
 
-    while True:
-        schedule.run_pending()
-        await asyncio.sleep(1)
+    async def run(channels):
+        kind, pending_profile[0] = pending_profile[0], None
+        return await run_task_once(cfg, metrics, profile=kind, channels=channels, record=record)
+
+    scheduler = Scheduler(cfg['telegram'].get('channels', []), timer_path, db_path, run, metrics=metrics)
+    try:
+        await scheduler.run_forever()
+    finally:
+        scheduler.close()
+        await exporter.stop()
 
 
 if __name__ == '__main__':
     import sys
+    import argparse
+
+    parser = argparse.ArgumentParser(description='PencilAI Telegram gallery ingest')
+    parser.add_argument('mode', nargs='?', default='once', choices=['once', 'daemon', 'import-state', 'thumbs'])
+    parser.add_argument('--profile', choices=['cpu', 'mem'], default=os.environ.get('PENCILAI_PROFILE') or None,
+                        help='profile one ingest run (the first one in daemon mode)')
+    parser.add_argument('--record', default=None, metavar='ARCHIVE',
+                        help='append every scanned message to this .ndjson.gz for replay.py')
+    args = parser.parse_args()
 
     cfg = load_config()
-    mode = sys.argv[1] if len(sys.argv) > 1 else 'once'
+    mode = args.mode
 
     if mode == 'daemon':
-        asyncio.run(run_daemon(cfg))
+        asyncio.run(run_daemon(cfg, profile=args.profile, record=args.record))
+    elif mode == 'import-state':
+        with GalleryDB(config_path('db_path', cfg)) as db:
+            db.ensure_schema()
+            import_legacy_state(db, config_path('download_history', cfg), config_path('last_ids', cfg), force=True)
+    elif mode == 'thumbs':
+        from renditions import regenerate, spec_from_config
+        from manifests import build_from_config
+
+        gallery_dir = config_path('tg_gallery_dir', cfg)
+        with GalleryDB(config_path('db_path', cfg)) as db:
+            db.ensure_schema()
+            _, failures = regenerate(db, gallery_dir, spec_from_config(cfg))
+            build_from_config(cfg, db)
+        sys.exit(1 if failures else 0)
     else:
-        asyncio.run(run_task_once(cfg))
+        asyncio.run(run_task_once(cfg, profile=args.profile, record=args.record))
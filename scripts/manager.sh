@@ -6,7 +6,7 @@ set -euo pipefail
 # - Reads config from scripts/config.json.
 
 BASE_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
-PY_SCRIPT="$BASE_DIR/main.py"
+PY_SCRIPT="$BASE_DIR/pencilai.py"
 PID_FILE="$BASE_DIR/script.pid"
 LOG_FILE="$BASE_DIR/run.log"
 
@@ -20,7 +20,7 @@ status() {
 
 case "${1:-}" in
   once)
-    python3 -u "$PY_SCRIPT" once
+    python3 -u "$PY_SCRIPT" ingest
     ;;
   daemon-start)
     if [[ -f "$PID_FILE" ]] && ps -p "$(cat "$PID_FILE")" >/dev/null 2>&1; then
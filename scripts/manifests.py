@@ -0,0 +1,191 @@
+"""Precomputed pagination manifests for the gallery page.
+
+Instead of ``penc_get_all_images`` reading (and shuffling) the whole table on
+every page view, this publishes one small JSON file per page:
+
+  <manifest_dir>/index.json             totals and settings
+  <manifest_dir>/latest/<page>.json     newest first (timestamp DESC)
+  <manifest_dir>/random-<k>/<page>.json seeded permutation k (0..random_seeds-1)
+
+Each page holds ``[{"f": file, "t": thumb, "s": bytes, "w": width, "h": height,
+"p": placeholder colour}]`` (see metadata.py),
+plus ``"r"`` (WebP) and ``"a"`` (AVIF) ``[[name, width], ...]`` lists for
+images that have renditions (see renditions.py), ready for ``srcset``.
+Pages are streamed from SQLite one at a time, compared against the digest
+recorded in ``manifest_pages`` and only rewritten (tmp file + rename) when
+their content changed.  Random orders are capped at ``random_pages`` pages
+and read in order from ``perm_keys``, where each image's sort key per seed
+is stored once, the first build after it was ingested.
+
+Usage:
+  python manifests.py
+"""
+
+import os
+import json
+import time
+import hashlib
+
+from storage import GalleryDB
+from metadata import backfill
+from config import config_path, load_config
+
+MASK64 = (1 << 64) - 1
+
+# Rows shown in the gallery and their "latest" order; generate_sitemap.py pages
+# the same way so sitemap URLs line up with the published manifests.
+# Near-duplicates linked to a first copy by dedup.py are not shown.
+LIVE_IMAGES = ("file_name IS NOT NULL AND file_name != '' AND (file_size IS NULL OR file_size > 0) "
+               "AND file_name NOT IN (SELECT file_name FROM phashes WHERE dup_of IS NOT NULL)")
+LATEST_ORDER = "timestamp DESC, rowid DESC"
+
+
+def perm_key(seed: int, rowid: int) -> int:
+    # splitmix64 of (seed, rowid): a cheap, well-mixed sort key per permutation.
+    z = (rowid * 0x9E3779B97F4A7C15 + seed * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+    return (z ^ (z >> 31)) >> 1
+
+
+def ensure_perm_keys(db: GalleryDB, seeds: int) -> int:
+    """Store the ``perm_key`` of every image not keyed yet for seeds 1..``seeds``; returns how many were added.
+
+    Keys depend only on (seed, rowid).  SQLite hands out rowids above the
+    largest one and images_drop_perm removes the keys of deleted rows, so the
+    images to key are those above the highest keyed rowid, plus every image
+    for seeds added since the last build.
+    """
+    done = int(db.get_meta('perm_seeds', 0))
+    with db.transaction() as conn:
+        conn.create_function('penc_perm', 2, perm_key, deterministic=True)
+        keyed = conn.execute("SELECT COALESCE(MAX(img), 0) FROM perm_keys").fetchone()[0]
+        conn.execute("DELETE FROM perm_keys WHERE seed > ?", (seeds,))
+        added = 0
+        for seed in range(1, seeds + 1):
+            added += conn.execute("INSERT OR IGNORE INTO perm_keys (img, seed, perm) "
+                                  "SELECT rowid, ?, penc_perm(?, rowid) FROM images WHERE rowid > ?",
+                                  (seed, seed, keyed if seed <= done else 0)).rowcount
+    if done != seeds:
+        db.set_meta('perm_seeds', seeds)
+    return added
+
+
+def _write_atomic(path: str, data: bytes):
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def attach_renditions(conn, items):
+    """Add each item's renditions (``r``: [name, width] list, ``a``: the AVIF ones) in place."""
+    marks = ','.join('?' * len(items))
+    by_name = {item['f']: item for item in items}
+    rows = conn.execute(f"SELECT file_name, format, name, width FROM renditions WHERE file_name IN ({marks}) "
+                        "ORDER BY file_name, width", list(by_name))
+    for file_name, fmt, name, width in rows:
+        by_name[file_name].setdefault('a' if fmt == 'avif' else 'r', []).append([name, width])
+
+
+def _publish_order(conn, manifest_dir: str, order_key: str, rows, per_page: int):
+    """Write the pages of one order from a row iterator; returns (pages, rewritten)."""
+    out_dir = os.path.join(manifest_dir, order_key)
+    os.makedirs(out_dir, exist_ok=True)
+    known = dict(conn.execute("SELECT page, digest FROM manifest_pages WHERE order_key = ?", (order_key,)))
+
+    page, rewritten, items, changed = 0, 0, [], []
+
+    def emit():
+        nonlocal page, rewritten
+        page += 1
+        if items:
+            attach_renditions(conn, items)
+        data = json.dumps({'page': page, 'items': items}, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        digest = hashlib.blake2b(data, digest_size=12).hexdigest()
+        path = os.path.join(out_dir, f"{page}.json")
+        if known.get(page) != digest or not os.path.exists(path):
+            _write_atomic(path, data)
+            changed.append((order_key, page, digest))
+            rewritten += 1
+
+    for file_name, thumb_name, size, width, height, placeholder in rows:
+        items.append({'f': file_name, 't': thumb_name or '', 's': size or 0, 'w': width or 0, 'h': height or 0,
+                      'p': placeholder or ''})
+        if len(items) == per_page:
+            emit()
+            items = []
+    if items or page == 0:
+        emit()
+
+    stale = [p for p in known if p > page]
+    for p in stale:
+        try:
+            os.remove(os.path.join(out_dir, f"{p}.json"))
+        except FileNotFoundError:
+            pass
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO manifest_pages (order_key, page, digest) VALUES (?, ?, ?)", changed)
+        conn.executemany("DELETE FROM manifest_pages WHERE order_key = ? AND page = ?", [(order_key, p) for p in stale])
+    return page, rewritten
+
+
+def build_manifests(db: GalleryDB, gallery_dir: str, manifest_dir: str, per_page: int = 15,
+                    random_seeds: int = 8, random_pages: int = 100):
+    started = time.time()
+    probed = backfill(db, gallery_dir)
+    ensure_perm_keys(db, random_seeds)
+    conn = db.conn
+
+    cols = "file_name, thumb_name, file_size, width, height, placeholder"
+    live = LIVE_IMAGES
+    total = conn.execute(f"SELECT COUNT(*) FROM images WHERE {live}").fetchone()[0]
+
+    pages, rewritten = _publish_order(
+        conn, manifest_dir, 'latest',
+        conn.execute(f"SELECT {cols} FROM images WHERE {live} ORDER BY {LATEST_ORDER}"), per_page)
+    for k in range(random_seeds):
+        _, n = _publish_order(
+            conn, manifest_dir, f"random-{k}",
+            conn.execute(f"SELECT {cols} FROM perm_keys JOIN images ON images.rowid = perm_keys.img "
+                         f"WHERE perm_keys.seed = ? AND {live} ORDER BY perm_keys.perm LIMIT ?",
+                         (k + 1, random_pages * per_page)), per_page)
+        rewritten += n
+
+    index = {
+        'total': total,
+        'per_page': per_page,
+        'pages': pages,
+        'random_seeds': random_seeds,
+        'random_pages': min(pages, random_pages),
+        'generated_at': int(time.time()),
+    }
+    _write_atomic(os.path.join(manifest_dir, 'index.json'), json.dumps(index).encode('utf-8'))
+    print(f"📑 manifests: {total} images, {pages} pages, {rewritten} files rewritten, "
+          f"{probed} newly probed ({time.time() - started:.1f}s)")
+    return index
+
+
+def build_from_config(cfg: dict, db: GalleryDB = None):
+    mcfg = cfg.get('manifests', {})
+    gallery_dir = config_path('tg_gallery_dir', cfg)
+    manifest_dir = config_path('manifest_dir', cfg)
+    own = db is None
+    if own:
+        db = GalleryDB(config_path('db_path', cfg))
+        db.ensure_schema()
+    try:
+        return build_manifests(db, gallery_dir, manifest_dir,
+                               per_page=int(mcfg.get('per_page', 15)),
+                               random_seeds=int(mcfg.get('random_seeds', 8)),
+                               random_pages=int(mcfg.get('random_pages', 100)))
+    finally:
+        if own:
+            db.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    argparse.ArgumentParser(description='Republish the page manifests').parse_args()
+    build_from_config(load_config())
@@ -0,0 +1,131 @@
+"""Display metadata of gallery images, stored in ``images``.
+
+The gallery page renders from these columns alone, with no ``file_exists``
+or ``filesize`` per card, and reserves each card's box before the image
+loads:
+
+  width, height   pixel size (0 when the file is missing or unreadable)
+  file_size       original bytes
+  thumb_name      legacy ``_thumb.webp`` name, '' when there is none
+  thumb_size      its bytes
+  placeholder     average colour ``#rrggbb`` shown while the image loads
+
+Ingest fills them as files are written (main.py) and rendered
+(renditions.py).  ``backfill`` completes older rows on all cores; it runs
+from migrate_db.py and, for stragglers, before every manifest build.
+
+Usage:
+  python metadata.py [--workers N]
+"""
+
+import os
+import sys
+import posixpath
+
+from imageinfo import read_dimensions
+from thumbs import thumb_path_for
+from layout import resolve
+
+BACKFILL_CHUNK = 1000
+
+# Rows still missing any display metadata.
+NEEDS_BACKFILL = "(width IS NULL OR thumb_size IS NULL OR placeholder IS NULL)"
+
+
+def placeholder_of(img) -> str:
+    """Average colour of a PIL image as ``#rrggbb``."""
+    from PIL import Image
+
+    r, g, b = img.convert('RGB').resize((1, 1), Image.Resampling.BOX).getpixel((0, 0))
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+
+def _placeholder_file(path: str) -> str:
+    from PIL import Image
+
+    with Image.open(path) as img:
+        if img.format == 'JPEG':
+            img.draft('RGB', (64, 64))
+        return placeholder_of(img)
+
+
+def probe(path: str, shard: str = ''):
+    """Return ``(width, height, file_size, thumb_name, thumb_size, placeholder)`` for one original.
+
+    ``shard`` is the original's directory relative to the gallery; ``thumb_name`` is relative too.
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return 0, 0, 0, '', 0, ''
+    try:
+        dims = read_dimensions(path) or (0, 0)
+    except OSError:
+        dims = (0, 0)
+    thumb = thumb_path_for(path)
+    try:
+        thumb_name, thumb_size = posixpath.join(shard, os.path.basename(thumb)), os.path.getsize(thumb)
+    except OSError:
+        thumb_name, thumb_size = '', 0
+    try:
+        placeholder = _placeholder_file(path)
+    except Exception:
+        # Unreadable image: store '' so it is not retried on every build.
+        placeholder = ''
+    return dims[0], dims[1], size, thumb_name, thumb_size, placeholder
+
+
+def _probe_job(args):
+    rowid, path, shard = args
+    return (rowid,) + probe(path, shard)
+
+
+def backfill(db, gallery_dir: str, workers: int = None) -> int:
+    """Fill missing display metadata in parallel; returns the number of rows updated."""
+    db.flush()
+    conn = db.conn
+    first = conn.execute(f"SELECT 1 FROM images WHERE {NEEDS_BACKFILL} LIMIT 1").fetchone()
+    if first is None:
+        return 0
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    workers = workers or os.cpu_count() or 1
+    done = 0
+    last_rowid = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            rows = conn.execute(
+                f"SELECT rowid, file_name FROM images WHERE {NEEDS_BACKFILL} AND rowid > ? ORDER BY rowid LIMIT ?",
+                (last_rowid, BACKFILL_CHUNK)).fetchall()
+            if not rows:
+                break
+            last_rowid = rows[-1][0]
+            jobs = [(rowid, resolve(gallery_dir, file_name or ''), posixpath.dirname(file_name or ''))
+                    for rowid, file_name in rows]
+            results = list(pool.map(_probe_job, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
+            with conn:
+                conn.executemany('''UPDATE images SET width = ?, height = ?, file_size = ?, thumb_name = ?,
+                    thumb_size = ?, placeholder = ? WHERE rowid = ?''',
+                                 [(w, h, s, t, ts, p, r) for r, w, h, s, t, ts, p in results])
+            done += len(rows)
+    return done
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from config import config_path, load_config
+    from storage import GalleryDB
+
+    parser = argparse.ArgumentParser(description='Backfill image display metadata')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    cfg = load_config()
+    with GalleryDB(config_path('db_path', cfg)) as db:
+        db.ensure_schema()
+        count = backfill(db, config_path('tg_gallery_dir', cfg),
+                         workers=args.workers)
+    print(f"✅ metadata backfilled for {count} images")
+    sys.exit(0)
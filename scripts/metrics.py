@@ -0,0 +1,396 @@
+"""Run metrics for the ingest daemon.
+
+One ``Metrics`` registry per process holds counters, gauges and latency
+histograms; the ingest components take it as an optional ``metrics``
+argument and record into a private registry when none is given.
+
+  pencilai_stage_seconds{stage}            histogram: scan (wait for the next
+                                           message), download, thumbnail (pool
+                                           job incl. backlog), db_write (one
+                                           flush), evict (one eviction pass)
+  pencilai_stage_total{stage,result}       ok / error / skipped per stage
+  pencilai_messages_scanned_total{channel}
+  pencilai_download_bytes_total{channel}
+  pencilai_db_rows_total                   rows written by buffered flushes
+  pencilai_evicted_files_total / pencilai_evicted_bytes_total
+  pencilai_flood_wait_seconds_total
+  pencilai_cas_hits_total / pencilai_cas_saved_bytes_total  downloads whose content
+                                           was already stored (cas.py)
+  pencilai_feed_requests_total{view,result}  hit / miss / not_modified / ... of
+                                           feed_server.py (its own registry)
+  pencilai_queue_depth{queue}              gauge: download, thumbnail, db_buffer
+  pencilai_channel_interval_seconds{channel}  gauge: adaptive poll interval
+
+``MetricsExporter`` publishes the registry as a Prometheus textfile
+(node_exporter textfile collector) and/or on a local ``GET /metrics``
+endpoint.  ``run_summary`` turns the difference between two snapshots into
+the JSON summary logged after every run, and ``profiled`` wraps a single run
+in cProfile or tracemalloc (event-loop process only; pool workers are not
+profiled).
+
+Config (``metrics`` section, all optional):
+  textfile      path of the .prom file, '' to disable
+  listen        "127.0.0.1:9108" for the /metrics endpoint, '' to disable
+  summary_log   JSON-lines file every run summary is appended to
+  profile_dir   where profiles are written
+"""
+
+import os
+import io
+import json
+import time
+import bisect
+import datetime
+import contextlib
+
+# asyncio is imported by the exporter's methods: every script imports this module
+# (through storage.py), most of them never start an event loop.
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+DESCRIPTIONS = {
+    'pencilai_stage_seconds': 'Latency of one unit of work per ingest stage.',
+    'pencilai_stage_total': 'Units of work per ingest stage and result.',
+    'pencilai_messages_scanned_total': 'Telegram messages scanned per channel.',
+    'pencilai_download_bytes_total': 'Bytes downloaded per channel.',
+    'pencilai_db_rows_total': 'Rows written by buffered DB flushes.',
+    'pencilai_evicted_files_total': 'Originals deleted by the disk budget.',
+    'pencilai_evicted_bytes_total': 'Bytes freed by the disk budget.',
+    'pencilai_flood_wait_seconds_total': 'Seconds Telegram asked us to back off.',
+    'pencilai_cas_hits_total': 'Downloads whose content was already in the content store.',
+    'pencilai_cas_saved_bytes_total': 'Bytes not stored again thanks to the content store.',
+    'pencilai_feed_requests_total': 'Feed server requests per view and cache result.',
+    'pencilai_queue_depth': 'Current depth of the ingest queues.',
+    'pencilai_channel_interval_seconds': 'Current polling interval per channel.',
+    'pencilai_last_run_timestamp_seconds': 'Unix time the last run finished.',
+    'pencilai_last_run_seconds': 'Wall time of the last run.',
+    'pencilai_last_run_ok': '1 when the last run finished without error.',
+}
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def copy(self):
+        h = Histogram(self.buckets)
+        h.counts, h.count, h.sum = list(self.counts), self.count, self.sum
+        return h
+
+    def minus(self, other):
+        h = self.copy()
+        if other is not None:
+            h.counts = [a - b for a, b in zip(self.counts, other.counts)]
+            h.count -= other.count
+            h.sum -= other.sum
+        return h
+
+    def quantile(self, q: float) -> float:
+        """Estimate from the buckets, interpolating linearly inside the one that holds ``q``."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lo = self.buckets[i - 1] if i else 0.0
+                hi = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lo + (hi - lo) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+def _labels(labels: dict):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _fmt_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    body = ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for k, v in pairs)
+    return '{' + body + '}'
+
+
+def _fmt_value(v) -> str:
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.peaks = {}
+
+    def inc(self, name: str, value=1, **labels):
+        key = (name, _labels(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value, **labels):
+        key = (name, _labels(labels))
+        self.gauges[key] = value
+        if value > self.peaks.get(key, 0):
+            self.peaks[key] = value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, _labels(labels))
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram()
+        hist.observe(seconds)
+
+    def stage(self, stage: str, seconds: float, result: str = 'ok'):
+        self.observe('pencilai_stage_seconds', seconds, stage=stage)
+        self.inc('pencilai_stage_total', stage=stage, result=result)
+
+    @contextlib.contextmanager
+    def timed(self, stage: str):
+        """Time the block as one unit of ``stage``; an exception counts as an error."""
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.stage(stage, time.perf_counter() - started, 'error')
+            raise
+        self.stage(stage, time.perf_counter() - started)
+
+    def snapshot(self) -> dict:
+        return {
+            'at': time.time(),
+            'counters': dict(self.counters),
+            'histograms': {k: h.copy() for k, h in self.histograms.items()},
+        }
+
+    def reset_peaks(self):
+        self.peaks = dict(self.gauges)
+
+    def render(self) -> str:
+        """Prometheus text exposition format (0.0.4)."""
+        families = {}
+        for (name, key), value in self.counters.items():
+            families.setdefault((name, 'counter'), []).append((name, key, (), value))
+        for (name, key), value in self.gauges.items():
+            families.setdefault((name, 'gauge'), []).append((name, key, (), value))
+        for (name, key), hist in self.histograms.items():
+            lines = families.setdefault((name, 'histogram'), [])
+            cumulative = 0
+            for bound, n in zip(hist.buckets + (float('inf'),), hist.counts):
+                cumulative += n
+                lines.append((name + '_bucket', key, (('le', _fmt_value(float(bound))),), cumulative))
+            lines.append((name + '_sum', key, (), hist.sum))
+            lines.append((name + '_count', key, (), hist.count))
+
+        out = io.StringIO()
+        for (name, kind), lines in sorted(families.items()):
+            if name in DESCRIPTIONS:
+                out.write(f"# HELP {name} {DESCRIPTIONS[name]}\n")
+            out.write(f"# TYPE {name} {kind}\n")
+            for sample, key, extra, value in lines:
+                out.write(f"{sample}{_fmt_labels(key, extra)} {_fmt_value(value)}\n")
+        return out.getvalue()
+
+    def write_textfile(self, path: str):
+        # The textfile collector may read at any moment: write aside, then rename.
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+
+def run_summary(metrics: Metrics, since: dict, error: str = None) -> dict:
+    """Structured summary of everything recorded since ``since`` (a ``snapshot``)."""
+    now = time.time()
+    before = since['counters']
+
+    def delta(key):
+        return metrics.counters.get(key, 0) - before.get(key, 0)
+
+    stages = {}
+    for (name, key), hist in metrics.histograms.items():
+        if name != 'pencilai_stage_seconds':
+            continue
+        h = hist.minus(since['histograms'].get((name, key)))
+        if not h.count:
+            continue
+        stages[dict(key)['stage']] = {
+            'count': h.count,
+            'seconds': round(h.sum, 3),
+            'p50': round(h.quantile(0.50), 4),
+            'p99': round(h.quantile(0.99), 4),
+        }
+    for (name, key) in metrics.counters:
+        if name != 'pencilai_stage_total':
+            continue
+        labels = dict(key)
+        n = delta((name, key))
+        if n and labels['result'] != 'ok':
+            stages.setdefault(labels['stage'], {})[labels['result']] = n
+
+    channels = {}
+    for (name, key) in metrics.counters:
+        field = {'pencilai_messages_scanned_total': 'messages',
+                 'pencilai_download_bytes_total': 'bytes'}.get(name)
+        if field:
+            channels.setdefault(dict(key)['channel'], {})[field] = delta((name, key))
+
+    return {
+        'started_at': datetime.datetime.fromtimestamp(since['at']).isoformat(timespec='seconds'),
+        'finished_at': datetime.datetime.fromtimestamp(now).isoformat(timespec='seconds'),
+        'seconds': round(now - since['at'], 3),
+        'ok': error is None,
+        'error': error,
+        'stages': stages,
+        'channels': channels,
+        'bytes_downloaded': sum(c.get('bytes', 0) for c in channels.values()),
+        'db_rows': delta(('pencilai_db_rows_total', ())),
+        'evicted': {'files': delta(('pencilai_evicted_files_total', ())),
+                    'bytes': delta(('pencilai_evicted_bytes_total', ()))},
+        'flood_wait_seconds': delta(('pencilai_flood_wait_seconds_total', ())),
+        'cas': {'hits': delta(('pencilai_cas_hits_total', ())),
+                'saved_bytes': delta(('pencilai_cas_saved_bytes_total', ()))},
+        'queue_peak': {dict(key)['queue']: value for (name, key), value in metrics.peaks.items()
+                       if name == 'pencilai_queue_depth'},
+    }
+
+
+def log_summary(summary: dict, path: str = ''):
+    """Append ``summary`` to a JSON-lines log and echo it as one line."""
+    line = json.dumps(summary, ensure_ascii=False, separators=(',', ':'))
+    if path:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+    print(f"📊 run summary {line}")
+
+
+class MetricsExporter:
+    """Publishes a registry as a textfile (rewritten every ``interval`` s) and/or on ``GET /metrics``."""
+
+    def __init__(self, metrics: Metrics, textfile: str = '', listen: str = '', interval: float = 15.0):
+        self.metrics = metrics
+        self.textfile = textfile
+        self.listen = listen
+        self.interval = interval
+        self._server = None
+        self._task = None
+
+    async def start(self):
+        import asyncio
+
+        if self.listen:
+            host, _, port = self.listen.rpartition(':')
+            self._server = await asyncio.start_server(self._handle, host or '127.0.0.1', int(port))
+            print(f"📈 metrics on http://{host or '127.0.0.1'}:{port}/metrics")
+        if self.textfile:
+            self._task = asyncio.create_task(self._writer())
+
+    def write(self):
+        if self.textfile:
+            try:
+                self.metrics.write_textfile(self.textfile)
+            except OSError as e:
+                print(f"⚠️  metrics textfile {self.textfile}: {e}")
+
+    async def _writer(self):
+        import asyncio
+
+        while True:
+            self.write()
+            await asyncio.sleep(self.interval)
+
+    async def _handle(self, reader, writer):
+        import asyncio
+
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=5)
+            parts = request.split(b' ', 2)
+            path = parts[1].split(b'?', 1)[0] if len(parts) > 1 else b''
+            if parts[0] in (b'GET', b'HEAD') and path == b'/metrics':
+                body = self.metrics.render().encode('utf-8')
+                head = (f"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n")
+            else:
+                body = b'not found\n'
+                head = f"HTTP/1.1 404 Not Found\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+            writer.write(head.encode('ascii') + (body if parts[0] != b'HEAD' else b''))
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def stop(self):
+        import asyncio
+
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        self.write()
+
+
+@contextlib.contextmanager
+def profiled(kind: str, out_dir: str, top: int = 25):
+    """Profile the block with ``kind`` 'cpu' (cProfile) or 'mem' (tracemalloc); no-op otherwise.
+
+    Writes ``profile-<stamp>.pstats`` / ``.txt`` under ``out_dir`` and prints the top entries.
+    """
+    if kind not in ('cpu', 'mem'):
+        yield
+        return
+    os.makedirs(out_dir, exist_ok=True)
+    stem = os.path.join(out_dir, f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{kind}")
+
+    if kind == 'cpu':
+        import cProfile
+        import pstats
+
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            prof.dump_stats(stem + '.pstats')
+            report = io.StringIO()
+            pstats.Stats(prof, stream=report).sort_stats('cumulative').print_stats(top)
+            with open(stem + '.txt', 'w', encoding='utf-8') as f:
+                f.write(report.getvalue())
+            print(report.getvalue())
+            print(f"🔬 cpu profile written to {stem}.pstats")
+        return
+
+    import tracemalloc
+
+    tracemalloc.start(10)
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        stats = snapshot.statistics('lineno')[:top]
+        lines = [f"peak traced memory: {peak / 1024 / 1024:.1f} MiB"] + [str(s) for s in stats]
+        with open(stem + '.txt', 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        print('\n'.join(lines))
+        print(f"🔬 memory profile written to {stem}.txt")
@@ -1,30 +1,12 @@
-import sqlite3
-import json
 import time
 import os
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DEFAULT_CONFIG = os.path.join(BASE_DIR, 'config.json')
 
-def _load_config_paths():
-    # Use config.json if present; fallback to config.example.json for path defaults
-    cfg_path = os.environ.get('PENCILAI_CONFIG', DEFAULT_CONFIG)
-    if not os.path.exists(cfg_path):
-        cfg_path = os.path.join(BASE_DIR, 'config.example.json')
-    with open(cfg_path, 'r', encoding='utf-8') as f:
-        cfg = json.load(f)
-    paths = cfg.get('paths', {}) if isinstance(cfg, dict) else {}
-    db_path = paths.get('db_path', './gallery.db')
-    tg_dir = paths.get('tg_gallery_dir', '../tg_gallery')
-    # resolve relative paths against scripts/ directory
-    if not os.path.isabs(db_path):
-        db_path = os.path.abspath(os.path.join(BASE_DIR, db_path))
-    if not os.path.isabs(tg_dir):
-        tg_dir = os.path.abspath(os.path.join(BASE_DIR, tg_dir))
-    return db_path, tg_dir
+from storage import GalleryDB
+from metadata import backfill
+from config import config_path
 
-
-# resolved paths
-db_path, gallery_dir = _load_config_paths()
+# 路径统一由 config.py 解析（同一进程内只读一次配置）
+db_path, gallery_dir = config_path('db_path'), config_path('tg_gallery_dir')
 
 
 # 数据库路径
@@ -33,17 +15,17 @@ def migrate_and_init():
         print("❌ 数据库文件不存在，请确认路径。")
         return
 
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    db = GalleryDB(db_path)
+    cursor = db.conn.cursor()
     
     print("🚀 启动数据库按需修复与优化...")
 
-    # --- 1. 结构检查：添加字段 ---
-    try:
-        cursor.execute("ALTER TABLE images ADD COLUMN captured_at INTEGER")
-        print("✅ 成功添加 captured_at 字段。")
-    except sqlite3.OperationalError:
-        print("ℹ️  captured_at 字段已存在。")
+    # --- 1. 结构检查：添加缺失字段（并建立 idx_images_ts 等索引）---
+    added = db.ensure_schema()
+    if added:
+        print(f"✅ 成功添加字段: {', '.join(added)}")
+    else:
+        print("ℹ️  所有字段均已存在。")
 
     # --- 2. 区别对待：仅初始化未赋值的入库时间 ---
     # 检查还有多少图片没有入库时间
@@ -59,17 +41,21 @@ def migrate_and_init():
     else:
         print("ℹ️  所有图片均已有入库时间，跳过初始化。")
 
-    # --- 3. 索引检查：自动判断是否存在 ---
-    # CREATE INDEX IF NOT EXISTS 是最优实践，它会自动检测是否存在
-    print("⚡ 正在检查并维护复合排序索引 (idx_sort_flow)...")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sort_flow ON images (captured_at, timestamp)")
+    db.conn.commit()
+
+    # --- 2b. 展示元数据：尺寸 / 字节数 / 缩略图 / 占位色，多进程并行补齐 ---
+    print("🖼️  正在补齐图片展示元数据（尺寸、大小、缩略图、占位色）...")
+    filled = backfill(db, gallery_dir)
+    print(f"✅ 已补齐 {filled} 条记录的展示元数据。" if filled else "ℹ️  所有图片均已有展示元数据，跳过。")
+
+    # --- 3. 索引检查：ensure_schema 已按 IF NOT EXISTS 维护复合排序索引 ---
+    print("⚡ 排序索引 (idx_images_ts / idx_sort_channel) 已就绪。")
     
     # --- 4. 物理清理 (VACUUM) ---
     print("🧹 正在整理数据库物理空间...")
     cursor.execute("VACUUM")
     
-    conn.commit()
-    conn.close()
+    db.close()
     
     print("-" * 50)
     print(f"✅ 数据库优化任务完成！")
@@ -77,4 +63,7 @@ def migrate_and_init():
     print(f"📊 数据状态：已补全（跳过已有值）。")
 
 if __name__ == "__main__":
-    migrate_and_init()
\ No newline at end of file
+    import argparse
+
+    argparse.ArgumentParser(description="数据库结构升级、索引维护与元数据补齐").parse_args()
+    migrate_and_init()
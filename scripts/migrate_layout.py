@@ -0,0 +1,228 @@
+"""Move an existing gallery into the configured layout (see layout.py), online and resumable.
+
+Each batch of files is moved in three steps, recorded in the ``layout_moves``
+journal so a crash at any point resumes where it stopped:
+
+1. plan:    (old, new) pairs are written to the journal ('planned');
+2. link:    every file is hard-linked at its new path, so both paths serve
+            the same bytes, then one transaction rewrites every reference
+            (images, files, renditions, phashes, blob_refs) and marks the pairs
+            'committed';
+3. finish:  once all batches are committed the page manifests are rebuilt
+            against the new paths, and only then are the old links removed.
+
+The website keeps working throughout: pages rendered from old manifests
+still find the old links until the new manifests are live.  Where hard links
+are not supported the file is renamed instead and old manifest links break
+until step 3.  The migrator holds the gallery lock exclusive (see scheduler.py), so
+scheduled runs skip while it works.  Renditions follow their originals into
+``renditions/<shard>/``.
+
+Usage:
+  python migrate_layout.py [--batch 500] [--pause 0.2] [--dry-run]
+"""
+
+import os
+import sys
+import time
+import errno
+import posixpath
+
+from storage import GalleryDB
+from layout import iter_gallery, place, resolve, layout_from_config, thumb_name_for, shard_dirs
+from thumbs import THUMB_SUFFIX, ORIGINAL_EXTS
+from renditions import RENDITION_DIR, rendition_dir_for
+from manifests import build_from_config
+from scheduler import gallery_lock
+from config import config_path, load_config
+
+BATCH = 500
+SAMPLE_LIMIT = 10
+RENDITION_PREFIX = RENDITION_DIR + '/'
+
+
+def _is_original(rel: str) -> bool:
+    lower = rel.lower()
+    return lower.endswith(ORIGINAL_EXTS) and not lower.endswith(THUMB_SUFFIX)
+
+
+def pending_moves(gallery_dir: str, layout):
+    """Yield (old, new) for every file not yet where ``layout`` puts it."""
+    for rel, _ in iter_gallery(gallery_dir):
+        target = place(rel, layout)
+        if target != rel:
+            yield rel, target
+
+
+def _rendition_moves(conn, old: str, new: str):
+    old_dir, new_dir = posixpath.dirname(old), posixpath.dirname(new)
+    for (name,) in conn.execute("SELECT name FROM renditions WHERE file_name = ?", (old,)):
+        if posixpath.dirname(name) == old_dir:
+            moved = posixpath.join(new_dir, posixpath.basename(name))
+            yield RENDITION_PREFIX + name, RENDITION_PREFIX + moved
+
+
+def _link(gallery_dir: str, old: str, new: str) -> str:
+    """Make ``new`` point at ``old``'s file; returns 'linked', 'moved', 'done' or 'conflict'/'missing'."""
+    src, dst = resolve(gallery_dir, old), resolve(gallery_dir, new)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.link(src, dst)
+        return 'linked'
+    except FileExistsError:
+        if os.path.exists(src) and not os.path.samefile(src, dst):
+            return 'conflict'
+        return 'done'
+    except FileNotFoundError:
+        # Already moved by an earlier, interrupted attempt (or deleted since).
+        return 'done' if os.path.exists(dst) else 'missing'
+    except OSError as e:
+        if e.errno not in (errno.EPERM, errno.EXDEV, errno.ENOTSUP, errno.EMLINK):
+            raise
+        os.replace(src, dst)
+        return 'moved'
+
+
+def _commit(conn, pairs):
+    """Rewrite every reference of the moved files and mark the pairs committed, in one transaction."""
+    with conn:
+        for old, new in pairs:
+            if old.startswith(RENDITION_PREFIX):
+                conn.execute("UPDATE renditions SET name = ? WHERE name = ?",
+                             (new[len(RENDITION_PREFIX):], old[len(RENDITION_PREFIX):]))
+            elif old.endswith(THUMB_SUFFIX):
+                conn.execute("UPDATE images SET thumb_name = ? WHERE thumb_name = ?", (new, old))
+            else:
+                conn.execute("UPDATE images SET file_name = ?, thumb_name = CASE WHEN thumb_name = ? THEN ? "
+                             "ELSE thumb_name END WHERE file_name = ?", (new, thumb_name_for(old),
+                                                                         thumb_name_for(new), old))
+                conn.execute("UPDATE files SET file_name = ? WHERE file_name = ?", (new, old))
+                conn.execute("UPDATE renditions SET file_name = ? WHERE file_name = ?", (new, old))
+                conn.execute("UPDATE phashes SET file_name = ? WHERE file_name = ?", (new, old))
+                conn.execute("UPDATE phashes SET dup_of = ? WHERE dup_of = ?", (new, old))
+                conn.execute("UPDATE blob_refs SET file_name = ? WHERE file_name = ?", (new, old))
+        conn.executemany("UPDATE layout_moves SET state = 'committed' WHERE old = ?", [(old,) for old, _ in pairs])
+
+
+def _apply(conn, gallery_dir: str, pairs):
+    """Link and commit planned pairs; returns (committed, problems)."""
+    ok, problems = [], []
+    for old, new in pairs:
+        result = _link(gallery_dir, old, new)
+        if result in ('conflict', 'missing'):
+            problems.append((old, new, result))
+        else:
+            ok.append((old, new))
+    _commit(conn, ok)
+    if problems:
+        with conn:
+            conn.executemany("DELETE FROM layout_moves WHERE old = ?", [(p[0],) for p in problems])
+    return len(ok), problems
+
+
+def _plan(conn, batch):
+    pairs = []
+    for old, new in batch:
+        pairs.append((old, new))
+        if _is_original(old):
+            pairs.extend(_rendition_moves(conn, old, new))
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO layout_moves (old, new, state) VALUES (?, ?, 'planned')", pairs)
+    return pairs
+
+
+def _finish(conn, gallery_dir: str):
+    """Drop the old links of committed moves and the journal rows; returns files unlinked."""
+    removed = 0
+    rows = conn.execute("SELECT old, new FROM layout_moves WHERE state = 'committed'").fetchall()
+    for old, new in rows:
+        src, dst = resolve(gallery_dir, old), resolve(gallery_dir, new)
+        try:
+            if os.path.samefile(src, dst):
+                os.remove(src)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    with conn:
+        conn.executemany("DELETE FROM layout_moves WHERE old = ?", [(old,) for old, _ in rows])
+    # Shard directories of the previous layout that are now empty, deepest first.
+    for root in (gallery_dir, rendition_dir_for(gallery_dir)):
+        for rel, path in sorted(shard_dirs(root), key=lambda d: -d[0].count('/')):
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+    return removed
+
+
+def migrate(cfg: dict, batch_size: int = BATCH, pause: float = 0.0, dry_run: bool = False):
+    layout = layout_from_config(cfg)
+    gallery_dir = config_path('tg_gallery_dir', cfg)
+    db_path = config_path('db_path', cfg)
+
+    if dry_run:
+        todo = list(pending_moves(gallery_dir, layout))
+        print(f"🗂️  [dry run] {len(todo)} files would move to the {layout.scheme} layout")
+        for old, new in todo[:SAMPLE_LIMIT]:
+            print(f"    - {old} -> {new}")
+        return len(todo)
+
+    # Every ingest run (shard workers included) holds the gallery lock shared.
+    with gallery_lock(db_path, exclusive=True) as acquired:
+        if not acquired:
+            print("⏭️  an ingest run holds the lock; try again when it is done")
+            return None
+        db = GalleryDB(db_path)
+        db.ensure_schema()
+        conn = db.conn
+        try:
+            moved = 0
+            problems = []
+
+            # Resume: finish linking whatever an interrupted run had planned.
+            planned = conn.execute("SELECT old, new FROM layout_moves WHERE state = 'planned'").fetchall()
+            if planned:
+                print(f"↩️  resuming {len(planned)} planned moves")
+                n, p = _apply(conn, gallery_dir, planned)
+                moved, problems = moved + n, problems + p
+
+            batch = []
+            started = time.monotonic()
+            for pair in pending_moves(gallery_dir, layout):
+                batch.append(pair)
+                if len(batch) >= batch_size:
+                    n, p = _apply(conn, gallery_dir, _plan(conn, batch))
+                    moved, problems = moved + n, problems + p
+                    batch = []
+                    print(f"  📦 {moved} files moved ({moved / max(time.monotonic() - started, 1e-6):.0f}/s)")
+                    if pause:
+                        time.sleep(pause)
+            if batch:
+                n, p = _apply(conn, gallery_dir, _plan(conn, batch))
+                moved, problems = moved + n, problems + p
+
+            # New paths go live in the manifests before the old links disappear.
+            if conn.execute("SELECT 1 FROM layout_moves WHERE state = 'committed' LIMIT 1").fetchone():
+                build_from_config(cfg, db)
+            removed = _finish(conn, gallery_dir)
+            db.set_meta('layout', f"{layout.scheme}:{layout.depth}")
+        finally:
+            db.close()
+
+    for old, new, why in problems[:SAMPLE_LIMIT]:
+        print(f"  ⚠️  {old} -> {new}: {why}")
+    print(f"✅ layout {layout.scheme}: {moved} files moved, {removed} old links removed, {len(problems)} skipped")
+    return moved
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Move the gallery into the configured directory layout')
+    parser.add_argument('--batch', type=int, default=BATCH, help='files per transaction')
+    parser.add_argument('--pause', type=float, default=0.0, help='seconds to sleep between batches')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    result = migrate(load_config(), batch_size=max(1, args.batch), pause=args.pause, dry_run=args.dry_run)
+    sys.exit(0 if result is not None else 1)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""One entry point for the ingest and maintenance scripts.
+
+Each command runs one script's own command line (``pencilai sync --full``
+is ``sync_to_db.py --full``, ``pencilai sync --help`` its help) and imports
+that script only when it is chosen: this module imports nothing but
+``runpy``, so a cron job pays for the one script it runs.  Paths and
+settings come from config.py, the same as when the scripts are run
+directly.  ``benchmark.py run --stages startup`` tracks how long each
+command takes to start.
+
+Usage:
+  python pencilai.py COMMAND [args ...]
+  python pencilai.py --help
+"""
+
+import os
+import sys
+import runpy
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# command -> (script, leading arguments, summary)
+COMMANDS = {
+    'ingest': ('main.py', ['once'], 'one ingest run over the configured channels'),
+    'daemon': ('main.py', ['daemon'], 'scheduled ingest runs (timer_config.json)'),
+    'thumbs': ('main.py', ['thumbs'], 'render missing thumbnails/renditions, republish the manifests'),
+    'import-state': ('main.py', ['import-state'], 'import download_history.txt and last_ids.json into the DB'),
+    'sync': ('sync_to_db.py', [], 'register gallery files that have no DB row'),
+    'cleanup': ('cleanup_library.py', [], 'delete dead rows and orphan files, apply album sampling'),
+    'migrate': ('migrate_db.py', [], 'upgrade the DB schema and backfill metadata'),
+    'sitemap': ('generate_sitemap.py', [], 'write the sitemap, push changed pages'),
+    'manifests': ('manifests.py', [], 'republish the page manifests'),
+    'feed': ('feed_server.py', [], 'serve gallery pages as JSON'),
+    'query': ('query.py', [], 'search captions and page through the gallery'),
+    'shards': ('shards.py', [], 'sharded ingest: coordinator, workers, lease status'),
+    'replay': ('replay.py', [], 'replay recorded channel scans through ingest'),
+}
+
+
+def usage() -> str:
+    lines = ['usage: pencilai COMMAND [args ...]', '', 'commands:']
+    lines += [f"  {name:<13} {summary}" for name, (_, _, summary) in COMMANDS.items()]
+    lines += ['', "'pencilai COMMAND --help' lists the options of one command."]
+    return '\n'.join(lines)
+
+
+def main(argv=None) -> int:
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage(), file=sys.stdout if argv else sys.stderr)
+        return 0 if argv else 2
+    if argv[0] not in COMMANDS:
+        print(f"pencilai: unknown command {argv[0]!r}\n\n{usage()}", file=sys.stderr)
+        return 2
+    script, lead, _ = COMMANDS[argv[0]]
+    # The script sees the command line it would have had when run directly.
+    sys.argv = [f"pencilai {argv[0]}"] + lead + argv[1:]
+    if BASE_DIR not in sys.path:
+        sys.path.insert(0, BASE_DIR)
+    runpy.run_path(os.path.join(BASE_DIR, script), run_name='__main__')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+"""Keyset-paginated gallery queries and caption search.
+
+Pages are ordered newest first by ``(timestamp, rowid)``, the order of the
+published manifests (manifests.LATEST_ORDER), so a feed that continues after
+a server-rendered page neither repeats nor skips images.  They continue from
+an opaque cursor (the key of the last row shown) instead of an OFFSET: each
+page is one seek into ``idx_images_ts`` (or ``idx_sort_channel`` when
+filtered by channel) plus ``limit`` rows, so page 10 000 costs what page 1
+does.  The date filter is on the same ``timestamp``, so it narrows that seek.
+
+Text search goes through the FTS5 index ``captions_fts``; every word must
+appear in the caption (with the trigram tokenizer: as a substring, which
+suits CJK).  Words shorter than three characters fall back to a LIKE scan of
+the captions.  ``tag`` filters on one exact hashtag.
+
+Usage:
+  python query.py [text ...] [--channel C] [--tag T] [--since 2024-01-01] [--until 2024-02-01]
+                  [--limit 50] [--cursor TOKEN] [--json]
+"""
+
+import sys
+import json
+import base64
+import datetime
+from collections import namedtuple
+
+from manifests import LIVE_IMAGES
+
+MAX_LIMIT = 500
+TRIGRAM_MIN = 3
+
+COLUMNS = ('id', 'channel', 'timestamp', 'captured_at', 'file_name', 'thumb_name', 'file_size', 'width', 'height',
+           'placeholder', 'caption')
+SELECT = '''SELECT i.rowid, i.id, i.channel, i.timestamp, i.captured_at, i.file_name, i.thumb_name, i.file_size, i.width,
+    i.height, i.placeholder, c.text FROM images i
+    LEFT JOIN captions c ON c.channel = i.channel AND c.msg_id = CAST(i.id AS INTEGER)'''
+ORDER = "ORDER BY i.timestamp DESC, i.rowid DESC"
+
+Page = namedtuple('Page', 'items cursor')
+
+
+def encode_cursor(timestamp: int, rowid: int) -> str:
+    key = json.dumps([timestamp, rowid], separators=(',', ':'))
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token: str):
+    """``(timestamp, rowid)``, or ``(timestamp, id, channel)`` for a cursor from before the manifest order."""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        if len(key) == 2:
+            return int(key[0]), int(key[1])
+        # Old cursors: (captured_at, timestamp, id[, channel]).
+        return int(key[1]), str(key[2]), str(key[3]) if len(key) == 4 else None
+    except (ValueError, TypeError, IndexError) as e:
+        raise ValueError(f"invalid cursor: {token!r}") from e
+
+
+def _resume_key(conn, after):
+    """The ``(timestamp, rowid)`` to continue after; an old cursor's row is looked up by its message ID."""
+    if len(after) == 2:
+        return after
+    timestamp, msg_id, channel = after
+    row = conn.execute("SELECT rowid FROM images WHERE timestamp = ? AND id = ? AND (? IS NULL OR channel = ?) "
+                       "ORDER BY rowid DESC LIMIT 1", (timestamp, msg_id, channel, channel)).fetchone()
+    # A row deleted since then: continue with the next older second.
+    return timestamp, row[0] if row else 0
+
+
+def _match_expr(words) -> str:
+    # Each word as a quoted FTS5 string, so user input never parses as query syntax.
+    return ' AND '.join('"{}"'.format(w.replace('"', '""')) for w in words)
+
+
+def _uses_trigram(conn) -> bool:
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'captions_fts'").fetchone()
+    if row is None:
+        raise RuntimeError("caption search needs SQLite with FTS5 (captions_fts is missing)")
+    return 'trigram' in row[0]
+
+
+def _filters(conn, channel, since, until, text, tag):
+    where, args = [LIVE_IMAGES], []
+    if channel:
+        where.append("i.channel = ?")
+        args.append(channel)
+    if since is not None:
+        where.append("i.timestamp >= ?")
+        args.append(int(since))
+    if until is not None:
+        where.append("i.timestamp < ?")
+        args.append(int(until))
+    if tag:
+        where.append("EXISTS (SELECT 1 FROM hashtags h WHERE h.tag = ? AND h.channel = i.channel "
+                     "AND h.msg_id = CAST(i.id AS INTEGER))")
+        args.append(tag.lstrip('#').lower())
+    words = (text or '').split()
+    if words:
+        short = [w for w in words if len(w) < TRIGRAM_MIN] if _uses_trigram(conn) else []
+        indexed = [w for w in words if w not in short]
+        if indexed:
+            where.append("c.id IN (SELECT rowid FROM captions_fts WHERE captions_fts MATCH ?)")
+            args.append(_match_expr(indexed))
+        for w in short:
+            where.append("c.text LIKE ? ESCAPE '\\'")
+            args.append('%' + w.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+    return where, args
+
+
+def page(conn, limit: int = 50, cursor: str = None, channel: str = None, since: int = None, until: int = None,
+         text: str = None, tag: str = None) -> Page:
+    """One page of live images, newest first; ``since``/``until`` are epoch seconds (message date).
+
+    ``Page.cursor`` continues after the last item, or is None on the last page.
+    """
+    limit = max(1, min(int(limit), MAX_LIMIT))
+    where, args = _filters(conn, channel, since, until, text, tag)
+    if cursor:
+        where.append("(i.timestamp, i.rowid) < (?, ?)")
+        args.extend(_resume_key(conn, decode_cursor(cursor)))
+
+    sql = f"{SELECT} WHERE {' AND '.join(where)} {ORDER} LIMIT ?"
+    rows = conn.execute(sql, args + [limit + 1]).fetchall()
+    items = [dict(zip(COLUMNS, row[1:])) for row in rows[:limit]]
+    last = rows[limit - 1] if len(rows) > limit else None
+    return Page(items, encode_cursor(last[COLUMNS.index('timestamp') + 1], last[0]) if last else None)
+
+
+def _epoch(day: str) -> int:
+    return int(datetime.datetime.strptime(day, '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from config import config_path, load_config
+    from storage import connect
+
+    cfg = load_config()
+
+    parser = argparse.ArgumentParser(description='Page through and search the gallery')
+    parser.add_argument('text', nargs='*', help='words that must all appear in the caption')
+    parser.add_argument('--channel', default=None)
+    parser.add_argument('--tag', default=None, help='exact hashtag, with or without #')
+    parser.add_argument('--since', type=_epoch, default=None, help='first message date, YYYY-MM-DD (UTC)')
+    parser.add_argument('--until', type=_epoch, default=None, help='day after the last message date')
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--cursor', default=None, help='the "next" token printed by the previous page')
+    parser.add_argument('--json', action='store_true', help='print the page as JSON')
+    args = parser.parse_args()
+
+    conn = connect(config_path('db_path', cfg), readonly=True)
+    try:
+        result = page(conn, args.limit, args.cursor, args.channel, args.since, args.until,
+                      ' '.join(args.text), args.tag)
+    except (ValueError, RuntimeError) as e:
+        print(f"❌ {e}")
+        sys.exit(2)
+    finally:
+        conn.close()
+
+    if args.json:
+        print(json.dumps({'items': result.items, 'next': result.cursor}, ensure_ascii=False))
+    else:
+        for item in result.items:
+            when = datetime.datetime.fromtimestamp(item['timestamp'], datetime.timezone.utc).strftime('%Y-%m-%d %H:%M')
+            caption = (item['caption'] or '').replace('\n', ' ')
+            print(f"  {when}  {item['channel'] or '-':<20}  {item['file_name']}  {caption[:60]}")
+        print(f"next: {result.cursor}" if result.cursor else "(last page)")
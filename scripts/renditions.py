@@ -0,0 +1,311 @@
+"""Responsive renditions: several widths per original, for ``srcset``.
+
+Every original gets one WebP per configured width (plus AVIF when enabled
+and Pillow can encode it), written to ``<gallery>/renditions/`` as
+``<shard>/<base>_<w>w_<key>.<ext>``, where ``<shard>`` is the original's own
+directory under the gallery (empty for the flat layout, see layout.py).  ``key`` hashes the source bytes together with
+(width, format, quality), so a rerun finds its outputs already on disk and
+skips the decode, while a changed source or setting produces new names.
+Widths at or above the source width collapse into one native-size output, so
+small and mid-size originals are re-encoded too instead of being served raw.
+
+All missing outputs of an image, and the legacy ``_thumb.webp``, come from a
+single decode.  The ``renditions`` table is the per-image manifest the page
+manifests turn into ``srcset``; ``src_size``/``src_mtime`` let the batch skip
+unchanged sources without hashing them again.
+
+Usage:
+  python renditions.py [--workers N]
+"""
+
+import os
+import sys
+import hashlib
+import posixpath
+from collections import namedtuple
+
+from imageinfo import read_dimensions
+from layout import iter_gallery, rel_name, resolve
+from thumbs import ORIGINAL_EXTS, SIZE_THRESHOLD, TARGET_WIDTH, THUMB_SUFFIX, thumb_path_for
+
+RENDITION_DIR = 'renditions'
+DEFAULT_WIDTHS = (360, 720, 1080)
+DEFAULT_QUALITY = 80
+THUMB_QUALITY = 85
+PURGE_CHUNK = 500
+
+# widths: ascending tuple; formats: ('webp',) or ('webp', 'avif').
+RenditionSpec = namedtuple('RenditionSpec', 'widths formats quality')
+
+INSERT_RENDITION = ('''INSERT OR REPLACE INTO renditions
+    (file_name, width, format, name, height, bytes, spec, src_hash, src_size, src_mtime)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''')
+
+
+def avif_supported() -> bool:
+    try:
+        from PIL import features
+        if features.check('avif'):
+            return True
+    except Exception:
+        pass
+    try:
+        import pillow_avif  # noqa: F401  (registers the AVIF plugin)
+        return True
+    except ImportError:
+        return False
+
+
+def spec_from_config(cfg: dict) -> RenditionSpec:
+    rcfg = cfg.get('renditions', {})
+    widths = tuple(sorted({int(w) for w in rcfg.get('widths', DEFAULT_WIDTHS) if int(w) > 0})) or DEFAULT_WIDTHS
+    formats = ('webp',)
+    if rcfg.get('avif'):
+        if avif_supported():
+            formats += ('avif',)
+        else:
+            print("⚠️  renditions.avif is on but this Pillow cannot encode AVIF, skipping the AVIF tier")
+    return RenditionSpec(widths, formats, int(rcfg.get('quality', DEFAULT_QUALITY)))
+
+
+def spec_signature(spec: RenditionSpec) -> str:
+    return f"{','.join(map(str, spec.widths))}|{','.join(spec.formats)}|{spec.quality}"
+
+
+def rendition_dir_for(gallery_dir: str) -> str:
+    return os.path.join(gallery_dir, RENDITION_DIR)
+
+
+def _hash_file(path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _targets(src_w: int, src_h: int, spec: RenditionSpec):
+    """Distinct (width, height) outputs for a source, largest first."""
+    sizes = {}
+    for w in spec.widths:
+        w = min(w, src_w)
+        sizes[w] = max(1, round(src_h * w / src_w))
+    return sorted(sizes.items(), reverse=True)
+
+
+def _save(img, path: str, fmt: str, quality: int):
+    tmp = f"{path}.tmp"
+    try:
+        img.save(tmp, fmt.upper(), quality=quality)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def render_image(image_path: str, spec: RenditionSpec, thumb: bool = True, gallery_dir: str = None):
+    """Bring all renditions of ``image_path`` (and its legacy thumbnail) up to date.
+
+    Returns a picklable dict describing the outputs; only missing files are
+    rendered, all from one decode.  Errors propagate to the caller.
+    ``gallery_dir`` defaults to the image's own directory (flat layout).
+    """
+    st = os.stat(image_path)
+    src_hash = _hash_file(image_path)
+    gallery_dir = gallery_dir or os.path.dirname(image_path)
+    out_dir = rendition_dir_for(gallery_dir)
+    shard = posixpath.dirname(rel_name(gallery_dir, image_path))
+    base = posixpath.join(shard, os.path.splitext(os.path.basename(image_path))[0])
+
+    dims = read_dimensions(image_path)
+    img = None
+    if not dims:
+        from PIL import Image
+        img = Image.open(image_path)
+        dims = img.size
+
+    items = []
+    missing = []
+    for w, h in _targets(dims[0], dims[1], spec):
+        for fmt in spec.formats:
+            key = hashlib.blake2b(f"{src_hash}:{w}:{fmt}:{spec.quality}".encode(), digest_size=5).hexdigest()
+            name = f"{base}_{w}w_{key}.{fmt}"
+            item = [w, fmt, name, h, 0]
+            items.append(item)
+            if not os.path.exists(resolve(out_dir, name)):
+                missing.append(item)
+
+    thumb_path = thumb_path_for(image_path)
+    need_thumb = thumb and st.st_size >= SIZE_THRESHOLD and not os.path.exists(thumb_path)
+
+    hashes = placeholder = None
+    if missing or need_thumb:
+        from PIL import Image
+        if 'avif' in spec.formats:
+            avif_supported()
+        os.makedirs(resolve(out_dir, shard), exist_ok=True)
+        if img is None:
+            img = Image.open(image_path)
+        with img:
+            largest = max([m[0] for m in missing] + ([TARGET_WIDTH] if need_thumb else []))
+            if img.format == 'JPEG' and img.size[0] > largest * 2:
+                # libjpeg downscales by 1/2..1/8 while decoding; LANCZOS does the rest.
+                img.draft('RGB', (largest, max(1, int(img.size[1] * largest / img.size[0]))))
+            frame = img if img.mode in ("RGB", "L") else img.convert("RGB")
+            jobs = [(m[0], m[3], m) for m in missing]
+            if need_thumb:
+                tw = min(TARGET_WIDTH, frame.size[0])
+                jobs.append((tw, max(1, int(frame.size[1] * tw / frame.size[0])), None))
+            # Largest first, each step resized from the previous one.
+            for w, h, item in sorted(jobs, key=lambda j: -j[0]):
+                if frame.size[0] != w:
+                    frame = frame.resize((w, h), Image.Resampling.LANCZOS)
+                if item is None:
+                    _save(frame, thumb_path, 'webp', THUMB_QUALITY)
+                else:
+                    _save(frame, resolve(out_dir, item[2]), item[1], spec.quality)
+            # Perceptual hashes (dedup.py) and the placeholder colour come from the smallest frame.
+            from dedup import image_hashes
+            from metadata import placeholder_of
+            hashes = image_hashes(frame)
+            placeholder = placeholder_of(frame)
+    elif img is not None:
+        img.close()
+
+    for item in items:
+        item[4] = os.path.getsize(resolve(out_dir, item[2]))
+    thumb_size = os.path.getsize(thumb_path) if os.path.exists(thumb_path) else 0
+    return {
+        'src_hash': src_hash,
+        'src_size': st.st_size,
+        'src_mtime': st.st_mtime_ns,
+        'spec': spec_signature(spec),
+        'items': [tuple(i) for i in items],
+        'rendered': len(missing),
+        'thumb': thumb_path if need_thumb else None,
+        'thumb_size': thumb_size,
+        'placeholder': placeholder,
+        'hashes': hashes,
+    }
+
+
+def render_job(image_path: str, spec: RenditionSpec, gallery_dir: str = None):
+    # Runs in a worker process; returns a picklable (path, result, error) triple.
+    try:
+        return image_path, render_image(image_path, spec, gallery_dir=gallery_dir), None
+    except Exception as e:
+        return image_path, None, f"{type(e).__name__}: {e}"
+
+
+def record_result(db, image_path: str, result: dict, gallery_dir: str = None):
+    """Store a ``render_image`` result (and the image's thumb/placeholder metadata); remove superseded outputs."""
+    gallery_dir = gallery_dir or os.path.dirname(image_path)
+    file_name = rel_name(gallery_dir, image_path)
+    out_dir = rendition_dir_for(gallery_dir)
+    names = {item[2] for item in result['items']}
+    stale = [name for (name,) in db.conn.execute("SELECT name FROM renditions WHERE file_name = ?", (file_name,))
+             if name not in names]
+    db.queue("DELETE FROM renditions WHERE file_name = ?", (file_name,))
+    for w, fmt, name, h, size in result['items']:
+        db.queue(INSERT_RENDITION, (file_name, w, fmt, name, h, size, result['spec'], result['src_hash'],
+                                    result['src_size'], result['src_mtime']))
+    thumb_name = rel_name(gallery_dir, thumb_path_for(image_path)) if result['thumb_size'] else ''
+    db.queue("UPDATE images SET thumb_name = ?, thumb_size = ?, placeholder = COALESCE(?, placeholder) "
+             "WHERE file_name = ?", (thumb_name, result['thumb_size'], result['placeholder'], file_name))
+    for name in stale:
+        try:
+            os.remove(resolve(out_dir, name))
+        except FileNotFoundError:
+            pass
+
+
+def purge_renditions(conn, gallery_dir: str, file_names) -> int:
+    """Delete the rendition files and rows of ``file_names``; returns bytes freed."""
+    out_dir = rendition_dir_for(gallery_dir)
+    file_names = list(file_names)
+    freed = 0
+    for i in range(0, len(file_names), PURGE_CHUNK):
+        chunk = file_names[i:i + PURGE_CHUNK]
+        marks = ','.join('?' * len(chunk))
+        for (name,) in conn.execute(f"SELECT name FROM renditions WHERE file_name IN ({marks})", chunk):
+            path = resolve(out_dir, name)
+            try:
+                st = os.stat(path)
+                os.remove(path)
+                freed += st.st_size if st.st_nlink == 1 else 0
+            except FileNotFoundError:
+                pass
+        with conn:
+            conn.execute(f"DELETE FROM renditions WHERE file_name IN ({marks})", chunk)
+    return freed
+
+
+def find_stale(conn, gallery_dir: str, spec: RenditionSpec):
+    """Yield originals whose renditions are missing, outdated or lack a needed thumbnail."""
+    signature = spec_signature(spec)
+    names = set()
+    originals = []
+    for rel, entry in iter_gallery(gallery_dir):
+        names.add(rel)
+        lower = entry.name.lower()
+        if lower.endswith(ORIGINAL_EXTS) and not lower.endswith(THUMB_SUFFIX):
+            originals.append((rel, entry))
+    for rel, entry in originals:
+        st = entry.stat()
+        row = conn.execute("SELECT spec, src_size, src_mtime FROM renditions WHERE file_name = ? LIMIT 1",
+                           (rel,)).fetchone()
+        thumb_ok = st.st_size < SIZE_THRESHOLD or f"{os.path.splitext(rel)[0]}{THUMB_SUFFIX}" in names
+        if row == (signature, st.st_size, st.st_mtime_ns) and thumb_ok:
+            continue
+        yield entry.path
+
+
+def regenerate(db, gallery_dir: str, spec: RenditionSpec, workers: int = None):
+    """Bring every original under ``gallery_dir`` up to date on all cores.
+
+    Returns ``(updated, failures)``: how many originals were (re)checked and a
+    list of (path, error) pairs.
+    """
+    db.flush()
+    todo = list(find_stale(db.conn, gallery_dir, spec))
+    workers = workers or os.cpu_count() or 1
+    print(f"🖼️  {len(todo)} originals need renditions ({spec_signature(spec)}), rendering on {workers} processes...")
+
+    updated, rendered, failures = 0, 0, []
+    if todo:
+        from concurrent.futures import ProcessPoolExecutor
+
+        chunksize = max(1, min(64, len(todo) // (workers * 4)))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for image_path, result, error in pool.map(render_job, todo, [spec] * len(todo), [gallery_dir] * len(todo),
+                                                      chunksize=chunksize):
+                if error:
+                    failures.append((image_path, error))
+                    print(f"  ❌ {os.path.basename(image_path)}: {error}")
+                    continue
+                record_result(db, image_path, result, gallery_dir)
+                updated += 1
+                rendered += result['rendered']
+    db.flush()
+
+    print(f"✅ renditions: {updated} originals checked, {rendered} files rendered, failed: {len(failures)}")
+    return updated, failures
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from config import config_path, load_config
+    from storage import GalleryDB
+
+    parser = argparse.ArgumentParser(description='Render missing or outdated responsive renditions')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    cfg = load_config()
+    with GalleryDB(config_path('db_path', cfg)) as db:
+        db.ensure_schema()
+        _, failures = regenerate(db, config_path('tg_gallery_dir', cfg),
+                                 spec_from_config(cfg), workers=args.workers)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,242 @@
+"""Record channel scans and replay them offline through the ingest pipeline.
+
+With ``main.py once --record scans.ndjson.gz`` (or ``daemon --record``),
+every message a channel scan sees is appended to a gzip-compressed NDJSON
+archive, one line per message:
+
+  {"ch": channel, "id": 123, "g": grouped_id|null, "d": epoch, "p": [[type, w, h, bytes], ...]|null, "t": caption}
+
+Each run appends one gzip member; a run killed mid-write leaves a truncated
+last member, which the reader stops at.
+
+``replay`` feeds an archive back through the real ``process_channel``:
+grouping, album sampling, downloads, renditions, dedup and the DB writes all
+run as they would live.  Only Telegram is replaced, by ``ReplayClient``.  It
+serves the archived messages of each channel newest first, from the
+channel's cursor on.  Photo bytes come from a local media dir (a copy of
+the gallery, matched on channel and message ID in the file name).  Photos
+not found there get a synthetic JPEG of about their recorded size (``--missing
+synthetic``, handy for load tests) or fail (``--missing fail``).  Every
+recorded photo size announces the local file's byte count, so the size
+policy still picks a size and the download check passes.
+
+Replays usually go to a scratch DB and gallery (``--db``/``--gallery``): a
+gallery that already has a channel's messages skips them (``seen`` and the
+cursors).
+
+Usage:
+  python replay.py ARCHIVE [--media DIR] [--missing synthetic|fail] [--db PATH] [--gallery DIR]
+                   [--channels a b ...] [--limit N]
+"""
+
+import os
+import re
+import gzip
+import json
+import copy
+import zlib
+import asyncio
+import datetime
+
+from downloads import photo_sizes
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MEDIA_NAME_RE = re.compile(r'^photo_(?P<ch>.+)_\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}_[^_]+_(?P<id>\d+)\.\w+$')
+
+
+class ScanRecorder:
+    """Appends the messages seen by channel scans to a gzip NDJSON archive."""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._f = gzip.open(path, 'at', encoding='utf-8')
+        self.count = 0
+
+    def record(self, channel: str, message):
+        photo = getattr(message, 'photo', None)
+        line = {'ch': channel, 'id': int(message.id), 'g': message.grouped_id,
+                'd': int(message.date.timestamp()),
+                'p': [list(s) for s in photo_sizes(photo)] if photo else None,
+                't': getattr(message, 'raw_text', None) or getattr(message, 'text', None) or ''}
+        self._f.write(json.dumps(line, ensure_ascii=False, separators=(',', ':')) + '\n')
+        self.count += 1
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+            print(f"📼 recorded {self.count} messages to {self.path}")
+
+
+def read_archive(path: str):
+    """Yield archived message dicts; stops quietly at a truncated last member."""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        except (EOFError, zlib.error):
+            print(f"⚠️  {path}: truncated at the end (interrupted run), replaying what was complete")
+        except json.JSONDecodeError:
+            print(f"⚠️  {path}: damaged line, replaying what came before it")
+
+
+class _Size:
+    __slots__ = ('type', 'w', 'h', 'size')
+
+    def __init__(self, size_type, w, h, size):
+        self.type, self.w, self.h, self.size = size_type, w, h, size
+
+
+class _Photo:
+    __slots__ = ('sizes',)
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+
+
+class ReplayMessage:
+    """Just the attributes of a Telethon message that ingest reads."""
+
+    def __init__(self, rec: dict, channel: str, media_bytes: int):
+        self.id = rec['id']
+        self.channel = channel
+        self.grouped_id = rec.get('g')
+        self.date = datetime.datetime.fromtimestamp(rec['d'], datetime.timezone.utc)
+        self.raw_text = self.text = rec.get('t') or ''
+        sizes = rec.get('p')
+        self.photo = _Photo([_Size(t, w, h, media_bytes) for t, w, h, _ in sizes]) if sizes is not None else None
+
+
+class ReplayClient:
+    """Stands in for ``TelegramClient``: archived messages, local media."""
+
+    def __init__(self, archive: str, media_dir: str = None, missing: str = 'synthetic'):
+        self.missing = missing
+        self._channels = {}
+        for rec in read_archive(archive):
+            # The same message can be in several recorded runs; the last record wins.
+            self._channels.setdefault(rec['ch'], {})[rec['id']] = rec
+        self._media = index_media(media_dir) if media_dir else {}
+        self._synthetic = {}
+
+    @property
+    def channels(self):
+        return sorted(self._channels)
+
+    async def start(self, phone=None, password=None):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def get_entity(self, channel):
+        # Channel metadata is not archived; None leaves the recorded ``channels`` row alone.
+        return None
+
+    def _source(self, channel: str, rec: dict):
+        """(local path, None) or (None, synthetic bytes) for a photo; (None, None) when it has no media."""
+        path = self._media.get((channel, rec['id']))
+        if path is not None or self.missing != 'synthetic':
+            return path, None
+        w, h = max(((w, h) for _, w, h, _ in rec['p']), default=(640, 480))
+        if (w, h) not in self._synthetic:
+            self._synthetic[(w, h)] = _synthetic_jpeg(w, h)
+        return None, self._synthetic[(w, h)]
+
+    async def iter_messages(self, channel, limit=None, min_id=0):
+        records = self._channels.get(channel, {})
+        count = 0
+        for msg_id in sorted(records, reverse=True):
+            if msg_id <= min_id or (limit and count >= limit):
+                break
+            count += 1
+            rec = records[msg_id]
+            media_bytes = 0
+            if rec.get('p') is not None:
+                path, data = self._source(channel, rec)
+                media_bytes = os.path.getsize(path) if path else len(data or b'')
+            yield ReplayMessage(rec, channel, media_bytes)
+
+    async def download_media(self, message, file=None, thumb=None):
+        path, data = self._source(message.channel, self._channels[message.channel][message.id])
+        if path is None and data is None:
+            raise FileNotFoundError(f"no local media for {message.channel}/{message.id}")
+        if data is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+        if isinstance(file, str):
+            with open(file, 'wb') as f:
+                f.write(data)
+        else:
+            file.write(data)
+        return file
+
+
+def index_media(media_dir: str):
+    """(channel, msg_id) -> path of every gallery-named original under ``media_dir``."""
+    from layout import iter_gallery
+    from thumbs import THUMB_SUFFIX
+
+    media = {}
+    for _, entry in iter_gallery(media_dir):
+        m = MEDIA_NAME_RE.match(entry.name)
+        if m and not entry.name.endswith(THUMB_SUFFIX):
+            media[(m.group('ch'), int(m.group('id')))] = entry.path
+    return media
+
+
+def _synthetic_jpeg(w: int, h: int) -> bytes:
+    import io
+    from PIL import Image
+
+    # Capped: a load test needs realistic decode work, not 2560px noise per photo.
+    scale = min(1.0, 1280 / max(w, h))
+    img = Image.effect_noise((max(1, int(w * scale)), max(1, int(h * scale))), 60).convert('RGB')
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=85)
+    return buf.getvalue()
+
+
+def replay(cfg: dict, archive: str, media_dir: str = None, missing: str = 'synthetic', channels=None):
+    """Run the archive through one ingest run; returns the run summary."""
+    from main import run_task_once
+
+    client = ReplayClient(archive, media_dir, missing)
+    channels = channels or client.channels
+    cfg = copy.deepcopy(cfg)
+    # Our own session lock, so a live ingest on the real session is not blocked.
+    cfg['paths']['session_file'] = os.path.abspath(archive) + '.replay'
+    print(f"📼 replaying {archive}: {len(channels)} channels"
+          f"{f', media from {media_dir}' if media_dir else ''}, missing media: {missing}")
+    return asyncio.run(run_task_once(cfg, channels=channels, make_client=lambda *args: client))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from config import load_config
+
+    parser = argparse.ArgumentParser(description='Replay recorded channel scans through the ingest pipeline')
+    parser.add_argument('archive', help='a .ndjson.gz written by main.py --record')
+    parser.add_argument('--media', default=None, help='dir with the original photos (e.g. a gallery copy)')
+    parser.add_argument('--missing', choices=['synthetic', 'fail'], default='synthetic')
+    parser.add_argument('--db', default=None, help='replay into this DB instead of paths.db_path')
+    parser.add_argument('--gallery', default=None, help='replay into this dir instead of paths.tg_gallery_dir')
+    parser.add_argument('--channels', nargs='*', default=None, help='default: every channel in the archive')
+    parser.add_argument('--limit', type=int, default=None, help='messages per channel (default telegram.limit_count)')
+    args = parser.parse_args()
+
+    cfg = load_config()
+    if args.db:
+        cfg['paths']['db_path'] = os.path.abspath(args.db)
+    if args.gallery:
+        cfg['paths']['tg_gallery_dir'] = os.path.abspath(args.gallery)
+    if args.limit is not None:
+        cfg['telegram']['limit_count'] = args.limit
+    replay(cfg, args.archive, args.media, args.missing, args.channels)
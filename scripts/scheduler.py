@@ -0,0 +1,248 @@
+"""Native asyncio scheduler for the ingest daemon.
+
+Replaces the ``schedule`` library plus 1-second polling loop.  Runs are
+single-flight: the loop awaits each run before planning the next one, and a
+``flock`` on ``<session>.lock`` keeps a manual ``main.py once`` from opening
+the Telethon session while the daemon is using it.  Every ingest run, under
+any session (shard workers included), also holds ``gallery_lock`` shared;
+tools that rename files or blobs under it take that lock exclusive.
+
+Every channel has its own due time in ``channel_schedule``:
+
+- ``interval`` mode: a channel's interval follows its posting rate (an
+  EWMA of new messages per second), aiming for ``target_messages`` new
+  messages per poll, clamped to [``min_mins``, ``max_mins``].  Quiet
+  channels back off by doubling.  Channels that are due together share one
+  run (and one Telegram login).
+- ``daily`` mode: every channel runs once a day at ``time``.
+
+Each due time gets +/- ``jitter`` (a fraction of the interval) so polls
+do not hit Telegram at fixed boundaries.  ``timer_config.json`` is checked on
+every tick and re-applied when it changes; no restart is needed.
+
+timer_config.json:
+  {"mode": "interval", "days": 0, "hours": 6, "mins": 0,
+   "adaptive": true, "min_mins": 30, "max_mins": 1440, "target_messages": 20, "jitter": 0.1}
+  {"mode": "daily", "time": "04:30", "jitter": 0.01}
+"""
+
+import os
+import json
+import time
+import fcntl
+import random
+import asyncio
+import datetime
+import contextlib
+
+from storage import connect, ensure_schema
+
+TICK = 5.0
+RATE_ALPHA = 0.5
+DEFAULT_TIMER = {"mode": "interval", "days": 0, "hours": 6, "mins": 0}
+
+
+@contextlib.contextmanager
+def run_lock(path: str, shared: bool = False):
+    """Non-blocking process lock, exclusive unless ``shared``; yields False when it cannot be taken."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        if not shared:
+            os.ftruncate(fd, 0)
+            os.write(fd, str(os.getpid()).encode())
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def gallery_lock(db_path: str, exclusive: bool = False):
+    """The gallery-wide ingest lock: ingest runs hold it shared, migrate_layout.py and cas.py exclusive."""
+    return run_lock(db_path + '.ingest.lock', shared=not exclusive)
+
+
+class TimerConfig:
+    """Parsed timer_config.json; all durations in seconds."""
+
+    def __init__(self, conf: dict):
+        self.mode = 'daily' if conf.get('mode') == 'daily' else 'interval'
+        self.daily_at = str(conf.get('time') or '00:00')
+        self._hh, self._mm = (int(x) for x in self.daily_at.split(':')[:2])
+        base_m = int(conf.get('days', 0)) * 1440 + int(conf.get('hours', 0)) * 60 + int(conf.get('mins', 0))
+        self.base = max(base_m, 1) * 60.0
+        self.adaptive = bool(conf.get('adaptive', True)) and self.mode == 'interval'
+        self.min_interval = max(60.0, float(conf.get('min_mins', max(base_m // 12, 5))) * 60)
+        self.max_interval = max(self.min_interval, float(conf.get('max_mins', base_m * 4)) * 60)
+        self.target = max(1, int(conf.get('target_messages', 20)))
+        self.jitter = min(0.5, max(0.0, float(conf.get('jitter', 0.1))))
+
+    def clamp(self, interval: float) -> float:
+        if not self.adaptive:
+            return self.base
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def next_daily(self, now: float) -> float:
+        today = datetime.datetime.fromtimestamp(now).replace(hour=self._hh, minute=self._mm, second=0,
+                                                             microsecond=0)
+        at = today.timestamp()
+        return at if at > now else (today + datetime.timedelta(days=1)).timestamp()
+
+    def describe(self) -> str:
+        if self.mode == 'daily':
+            return f"daily at {self.daily_at}"
+        if self.adaptive:
+            return (f"every {self.base / 60:.0f} min, adaptive {self.min_interval / 60:.0f}-"
+                    f"{self.max_interval / 60:.0f} min")
+        return f"every {self.base / 60:.0f} min"
+
+
+def load_timer(path: str) -> dict:
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(DEFAULT_TIMER, f, ensure_ascii=False)
+        return dict(DEFAULT_TIMER)
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+class Scheduler:
+    """Plans per-channel runs and executes them one at a time.
+
+    ``run(channels)`` is awaited for each batch of due channels and returns the
+    run summary of metrics.py (or None when the run was skipped); its
+    per-channel ``messages`` counts drive the adaptive intervals.
+    """
+
+    def __init__(self, channels, timer_path: str, db_path: str, run, metrics=None):
+        self.channels = list(channels)
+        self.timer_path = timer_path
+        self.run = run
+        self.metrics = metrics
+        self.conn = connect(db_path)
+        ensure_schema(self.conn)
+        self.timer = None
+        self._timer_mtime = None
+        self._rng = random.Random()
+
+    def _jittered(self, interval: float) -> float:
+        j = self.timer.jitter
+        return interval * (1 + self._rng.uniform(-j, j))
+
+    def _state(self):
+        return {row[0]: list(row[1:]) for row in self.conn.execute(
+            "SELECT channel, interval, next_due, rate, last_run FROM channel_schedule")}
+
+    def _save(self, channel, interval, next_due, rate, last_run):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO channel_schedule (channel, interval, next_due, rate, last_run) "
+                              "VALUES (?, ?, ?, ?, ?)", (channel, interval, next_due, rate, last_run))
+        if self.metrics is not None:
+            self.metrics.set('pencilai_channel_interval_seconds', round(interval), channel=channel)
+
+    def reload_if_changed(self, now: float = None) -> bool:
+        """Re-read timer_config.json when its mtime changed; re-plan every channel with the new bounds."""
+        try:
+            mtime = os.stat(self.timer_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if self.timer is not None and mtime == self._timer_mtime:
+            return False
+        first = self.timer is None
+        try:
+            timer = TimerConfig(load_timer(self.timer_path))
+            mtime = os.stat(self.timer_path).st_mtime_ns
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            # A half-written or broken file keeps the previous settings (the defaults at startup).
+            print(f"⚠️  timer config {self.timer_path} ignored: {e}")
+            if not first:
+                self._timer_mtime = mtime
+                return False
+            timer = TimerConfig(DEFAULT_TIMER)
+        self.timer, self._timer_mtime = timer, mtime
+        now = now or time.time()
+        state = self._state()
+        for ch in self.channels:
+            interval, next_due, rate, last_run = state.get(ch, (None, None, None, None))
+            if interval is None:
+                # New channel: poll it right away.
+                self._save(ch, timer.base, now, None, None)
+                continue
+            new_interval = timer.clamp(interval)
+            if timer.mode == 'daily':
+                new_due = min(next_due, timer.next_daily(now)) if first else timer.next_daily(now)
+            elif first:
+                # Keep the persisted plan across restarts, capped by the (possibly shorter) interval.
+                new_due = min(next_due, now + new_interval)
+            elif last_run is None:
+                new_due = next_due
+            else:
+                new_due = last_run + self._jittered(new_interval)
+            self._save(ch, new_interval, new_due, rate, last_run)
+        print(f"⏱️  timer {'loaded' if first else 'reloaded'}: {timer.describe()}")
+        return True
+
+    def due(self, now: float):
+        state = self._state()
+        return [ch for ch in self.channels if ch in state and state[ch][1] <= now]
+
+    def next_wakeup(self, now: float) -> float:
+        state = self._state()
+        dues = [state[ch][1] for ch in self.channels if ch in state]
+        return min(dues) if dues else now + self.timer.base
+
+    def plan(self, channels, summary: dict, now: float):
+        """Move each channel's due time past this run, adapting its interval to its posting rate."""
+        state = self._state()
+        counts = (summary or {}).get('channels', {})
+        timer = self.timer
+        for ch in channels:
+            interval, _, rate, last_run = state.get(ch, (timer.base, None, None, None))
+            if summary is None:
+                # Failed or skipped (another process held the lock): retry soon, learn nothing.
+                self._save(ch, interval, now + self._jittered(min(interval, timer.min_interval)), rate, last_run)
+                continue
+            if timer.mode == 'daily':
+                self._save(ch, interval, timer.next_daily(now) + self._rng.uniform(0, timer.jitter * 86400),
+                           rate, now)
+                continue
+            new = counts.get(ch, {}).get('messages', 0)
+            if last_run:
+                observed = new / max(now - last_run, 1.0)
+                rate = observed if rate is None else RATE_ALPHA * observed + (1 - RATE_ALPHA) * rate
+            if timer.adaptive and rate:
+                interval = timer.target / rate
+            elif timer.adaptive and last_run:
+                interval *= 2
+            interval = timer.clamp(interval)
+            self._save(ch, interval, now + self._jittered(interval), rate, now)
+
+    async def run_forever(self):
+        self.reload_if_changed()
+        while True:
+            now = time.time()
+            due = self.due(now)
+            if due:
+                print(f"⏰ {len(due)}/{len(self.channels)} channels due: {', '.join(due)}")
+                summary = None
+                try:
+                    summary = await self.run(due)
+                except Exception as e:
+                    print(f"❌ scheduled run failed: {e}")
+                self.plan(due, summary, time.time())
+                wake = self.next_wakeup(time.time())
+                print(f"💤 next run at {datetime.datetime.fromtimestamp(wake).strftime('%Y-%m-%d %H:%M:%S')}")
+            # Short ticks so timer_config.json edits take effect within seconds.
+            await asyncio.sleep(max(0.0, min(TICK, self.next_wakeup(time.time()) - time.time())))
+            self.reload_if_changed()
+
+    def close(self):
+        self.conn.close()
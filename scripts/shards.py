@@ -0,0 +1,315 @@
+"""Sharded ingest: channels leased to several worker processes, one Telegram session each.
+
+A single ``main.py`` run scans every channel through one session, so one
+account's rate limits and one process bound the whole ingest.  Here a
+coordinator (``run``) keeps N worker processes alive.  Each worker leases a
+batch of channels from ``channel_leases`` in gallery.db, ingests them with
+its own session (``main.run_task_once``) and hands them back, with
+``last_done`` set if the run completed (a failed or cancelled run leaves them
+due).  A channel can be leased when nobody holds it (or the
+lease expired) and it was last done more than ``rescan_mins`` ago.
+
+While a batch runs, its worker renews the leases every
+``heartbeat_seconds``.  A crashed or hung worker stops renewing; after
+``lease_seconds`` another worker takes the channels over and resumes from
+their cursors.  A worker that finds one of its leases taken over cancels its
+run.
+
+What the workers share lives in gallery.db and the gallery dir:
+
+- ``seen`` keys and cursors are per channel, so the lease makes them exclusive.
+- Blobs are linked atomically (cas.py).
+- Eviction is serialized by a lock file (disk_budget.py).
+- Perceptual hashes of other workers become visible once flushed.  A race
+  inside the flush interval leaves two first copies, which dedup.py links later.
+
+The coordinator restarts workers that exit and rebuilds the page manifests
+when the DB changed.  Run either this or ``main.py daemon``, not both.
+
+Config (``shards`` section):
+  "workers": [{"session_file": "./anon_w0"},
+              {"session_file": "./anon_w1", "api_id": 1, "api_hash": "...", "phone_number": "+1..."}],
+  "lease_seconds": 300, "heartbeat_seconds": 60, "rescan_mins": 30, "batch": 4, "manifest_interval": 60
+  (workers beyond the list use session ./anon_w<index> and the telegram section's account)
+
+Each session logs in once, interactively: python shards.py worker --index 1 --once
+
+Usage:
+  python shards.py run [--workers N] [--stub]
+  python shards.py worker --index I [--once] [--stub]
+  python shards.py status
+
+``--stub`` replaces Telegram with the synthetic client of stub_client.py, to try the
+leasing locally.
+"""
+
+import os
+import sys
+import copy
+import time
+import socket
+import asyncio
+import datetime
+import subprocess
+
+from storage import connect, ensure_schema, GalleryDB
+from metrics import Metrics
+from scheduler import run_lock
+from manifests import build_from_config
+from config import config_path, load_config
+
+POLL = 15.0
+RESTART_DELAY = 30.0
+ACCOUNT_KEYS = ('api_id', 'api_hash', 'phone_number', 'two_step_password')
+
+
+class LeaseTable:
+    """This worker's view of ``channel_leases``; every change is one short IMMEDIATE transaction."""
+
+    def __init__(self, db_path: str, worker: str, lease_seconds: float = 300, rescan: float = 1800):
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        self.rescan = rescan
+        self.conn = connect(db_path)
+        ensure_schema(self.conn)
+
+    def _state(self):
+        return {row[0]: row[1:] for row in self.conn.execute(
+            "SELECT channel, worker, expires_at, last_done FROM channel_leases")}
+
+    def acquire(self, channels, limit: int, now: float = None):
+        """Lease up to ``limit`` free, due channels, least recently done first; returns them."""
+        now = now or time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            state = self._state()
+            free = []
+            for ch in channels:
+                worker, expires_at, last_done = state.get(ch, (None, 0, None))
+                if worker and worker != self.worker and expires_at > now:
+                    continue
+                if last_done is not None and last_done > now - self.rescan:
+                    continue
+                free.append((last_done or 0, ch))
+            picked = [ch for _, ch in sorted(free)[:max(1, limit)]]
+            self.conn.executemany('''INSERT INTO channel_leases (channel, worker, expires_at, heartbeat_at)
+                VALUES (?, ?, ?, ?) ON CONFLICT(channel) DO UPDATE SET worker = excluded.worker,
+                expires_at = excluded.expires_at, heartbeat_at = excluded.heartbeat_at''',
+                                  [(ch, self.worker, now + self.lease_seconds, now) for ch in picked])
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        return picked
+
+    def renew(self, channels, now: float = None):
+        """Extend our leases on ``channels``; returns the ones we still hold."""
+        now = now or time.time()
+        channels = list(channels)
+        marks = ','.join('?' * len(channels))
+        with self.conn:
+            self.conn.execute(f"UPDATE channel_leases SET expires_at = ?, heartbeat_at = ? "
+                              f"WHERE worker = ? AND channel IN ({marks})",
+                              (now + self.lease_seconds, now, self.worker, *channels))
+        return {row[0] for row in self.conn.execute(
+            f"SELECT channel FROM channel_leases WHERE worker = ? AND channel IN ({marks})", (self.worker, *channels))}
+
+    def finish(self, channels, now: float = None):
+        """Hand back ``channels`` after a completed run: not due again for ``rescan`` seconds."""
+        self._hand_back(channels, "last_done = ?", (now or time.time(),))
+
+    def release(self, channels):
+        """Hand back ``channels`` without a completed run: any worker may lease them again."""
+        self._hand_back(channels)
+
+    def _hand_back(self, channels, stamp: str = None, params=()):
+        channels = list(channels)
+        if not channels:
+            return
+        marks = ','.join('?' * len(channels))
+        with self.conn:
+            self.conn.execute(f"UPDATE channel_leases SET worker = NULL, expires_at = 0{', ' + stamp if stamp else ''} "
+                              f"WHERE worker = ? AND channel IN ({marks})", (*params, self.worker, *channels))
+
+    def next_eligible(self, channels, now: float = None) -> float:
+        """Earliest time one of ``channels`` could be leased."""
+        now = now or time.time()
+        state = self._state()
+        times = []
+        for ch in channels:
+            worker, expires_at, last_done = state.get(ch, (None, 0, None))
+            held = expires_at if worker and worker != self.worker else 0
+            times.append(max(held, (last_done or 0) + self.rescan))
+        return min(times) if times else now + POLL
+
+    def close(self):
+        self.conn.close()
+
+
+def worker_config(cfg: dict, index: int) -> dict:
+    """``cfg`` with worker ``index``'s session file and (optionally) its own Telegram account."""
+    wcfg = copy.deepcopy(cfg)
+    workers = cfg.get('shards', {}).get('workers') or []
+    own = workers[index] if index < len(workers) else {}
+    wcfg['paths']['session_file'] = own.get('session_file', f"./anon_w{index}")
+    for key in ACCOUNT_KEYS:
+        if key in own:
+            wcfg['telegram'][key] = own[key]
+    return wcfg
+
+
+async def _keep_alive(leases: LeaseTable, channels, run, interval: float, lost: list):
+    while True:
+        await asyncio.sleep(interval)
+        gone = [ch for ch in channels if ch not in leases.renew(channels)]
+        if gone:
+            lost.extend(gone)
+            print(f"⚠️  lease lost on {', '.join(gone)} (taken over after expiry), stopping this run")
+            run.cancel()
+            return
+
+
+async def run_worker(cfg: dict, index: int, once: bool = False, make_client=None):
+    """Lease, ingest and hand back channels until stopped (with ``once``: until none is due)."""
+    from main import run_task_once
+
+    scfg = cfg.get('shards', {})
+    db_path = config_path('db_path', cfg)
+    channels = cfg['telegram'].get('channels', [])
+    heartbeat = float(scfg.get('heartbeat_seconds', 60))
+    batch = int(scfg.get('batch', 4))
+    wcfg = worker_config(cfg, index)
+    worker = f"{socket.gethostname()}:{os.getpid()}:{index}"
+    leases = LeaseTable(db_path, worker, lease_seconds=max(float(scfg.get('lease_seconds', 300)), heartbeat * 2),
+                        rescan=float(scfg.get('rescan_mins', 30)) * 60)
+    # Cumulative over the worker's lifetime, like the daemon's registry.
+    metrics = Metrics()
+    print(f"👷 worker {index} ({worker}) on session {wcfg['paths']['session_file']}")
+    try:
+        while True:
+            leased = leases.acquire(channels, batch)
+            if not leased:
+                if once:
+                    break
+                await asyncio.sleep(min(POLL, max(1.0, leases.next_eligible(channels) - time.time())))
+                continue
+            print(f"🔑 worker {index} leased: {', '.join(leased)}")
+            run = asyncio.create_task(run_task_once(wcfg, metrics, channels=leased, manifests=False,
+                                                    make_client=make_client))
+            lost, summary = [], None
+            beat = asyncio.create_task(_keep_alive(leases, leased, run, heartbeat, lost))
+            try:
+                summary = await run
+            except asyncio.CancelledError:
+                if not lost:
+                    raise
+            except Exception as e:
+                print(f"❌ worker {index}: run failed: {e}")
+            finally:
+                beat.cancel()
+                await asyncio.gather(beat, return_exceptions=True)
+                held = [ch for ch in leased if ch not in lost]
+                # Only a completed run counts as done; a failed, skipped (session locked) or
+                # cancelled one hands its channels back still due.
+                if summary is not None:
+                    leases.finish(held)
+                else:
+                    leases.release(held)
+            if summary is None:
+                if once:
+                    break
+                await asyncio.sleep(POLL)
+    finally:
+        leases.close()
+
+
+def run_coordinator(cfg: dict, workers: int, stub: bool = False):
+    """Keep ``workers`` worker processes running and the manifests current."""
+    scfg = cfg.get('shards', {})
+    db_path = config_path('db_path', cfg)
+    manifest_interval = float(scfg.get('manifest_interval', 60))
+    with run_lock(db_path + '.shards.lock') as acquired:
+        if not acquired:
+            print("⏭️  another coordinator is already running on this gallery")
+            return
+        procs, next_start = {}, {}
+        # The manifests are built on this connection, so data_version only moves for the workers' commits.
+        db = GalleryDB(db_path)
+        db.ensure_schema()
+        version, built_at = None, 0.0
+        print(f"🧭 coordinator: {workers} workers{' (stub client)' if stub else ''}")
+        try:
+            while True:
+                now = time.monotonic()
+                for i in range(workers):
+                    proc = procs.get(i)
+                    if proc is not None and proc.poll() is None:
+                        continue
+                    if proc is not None and i not in next_start:
+                        print(f"⚠️  worker {i} exited with {proc.returncode}, restarting in {RESTART_DELAY:.0f}s")
+                        next_start[i] = now + RESTART_DELAY
+                    if now >= next_start.get(i, 0):
+                        procs[i] = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker',
+                                                     '--index', str(i)] + (['--stub'] if stub else []))
+                        next_start.pop(i, None)
+                current = db.conn.execute("PRAGMA data_version").fetchone()[0]
+                if current != version and now - built_at >= manifest_interval:
+                    version, built_at = current, now
+                    build_from_config(cfg, db)
+                time.sleep(POLL / 3)
+        finally:
+            for proc in procs.values():
+                if proc.poll() is None:
+                    proc.terminate()
+            for proc in procs.values():
+                try:
+                    proc.wait(timeout=60)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+            db.close()
+
+
+def print_status(cfg: dict):
+    db_path = config_path('db_path', cfg)
+    conn = connect(db_path, readonly=True)
+    now = time.time()
+    for channel, worker, expires_at, last_done in conn.execute(
+            "SELECT channel, worker, expires_at, last_done FROM channel_leases ORDER BY channel"):
+        held = f"{worker}, expires in {expires_at - now:.0f}s" if worker else 'free'
+        done = datetime.datetime.fromtimestamp(last_done).strftime('%Y-%m-%d %H:%M:%S') if last_done else 'never'
+        print(f"  {channel:<24}  {held:<48}  last done {done}")
+    conn.close()
+
+
+if __name__ == '__main__':
+    import signal
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Sharded ingest over leased channels')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    run_p = sub.add_parser('run', help='start and supervise the worker processes')
+    run_p.add_argument('--workers', type=int, default=None, help='default: one per configured shards.workers entry')
+    run_p.add_argument('--stub', action='store_true', help='synthetic Telegram client (local testing)')
+    worker_p = sub.add_parser('worker', help='run one worker in the foreground')
+    worker_p.add_argument('--index', type=int, required=True)
+    worker_p.add_argument('--once', action='store_true', help='exit once no channel is due')
+    worker_p.add_argument('--stub', action='store_true', help='synthetic Telegram client (local testing)')
+    sub.add_parser('status', help='show the channel leases')
+    args = parser.parse_args()
+
+    cfg = load_config()
+    # SIGTERM unwinds like Ctrl-C: the coordinator stops its workers, a worker hands its batch back.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        if args.cmd == 'run':
+            count = args.workers or len(cfg.get('shards', {}).get('workers') or []) or 1
+            run_coordinator(cfg, count, stub=args.stub)
+        elif args.cmd == 'worker':
+            from stub_client import client_factory
+
+            asyncio.run(run_worker(cfg, args.index, once=args.once,
+                                   make_client=client_factory() if args.stub else None))
+        else:
+            print_status(cfg)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,372 @@
+"""Shared SQLite layer for gallery.db.
+
+Every script goes through this module instead of opening ad-hoc connections:
+
+- ``connect`` opens a connection in WAL mode with tuned pragmas, so the PHP
+  front end keeps reading while a script writes.
+- ``ensure_schema`` creates/upgrades the tables and indexes.
+- ``GalleryDB`` keeps one long-lived connection per process and buffers
+  inserts, flushing them in batched transactions by count or by age.
+
+``images`` is unique on (channel, id), since Telegram message IDs are only
+unique within a channel.  Ingestion state lives here too: ``seen`` is the
+(channel, msg_id) dedup set and ``cursors`` holds the per-channel last
+scanned message ID.  ``files``
+indexes original sizes and ages for the disk budget (see disk_budget.py),
+``renditions`` lists the responsive outputs of each original (see
+renditions.py), ``phashes`` holds perceptual hashes for dedup.py and
+``channel_schedule`` the per-channel poll plan of scheduler.py;
+``layout_moves`` is the journal of migrate_layout.py; ``blobs`` and
+``blob_refs`` are the reference-counted content store of cas.py;
+``albums`` and ``album_members`` record grouped messages and how they were
+sampled (see albums.py); ``captions``, ``hashtags`` and ``channels`` hold
+the message text and channel metadata captured at ingest, searched through
+the ``captions_fts`` index (see captions.py and query.py); ``channel_leases``
+hands channels to the ingest workers of shards.py; ``perm_keys`` caches the
+sort keys of the random manifest orders (see manifests.py).  ``file_name`` columns
+hold paths relative to the gallery dir (see layout.py).  An empty
+channel in ``seen`` marks a legacy ID imported from download_history.txt,
+whose channel could not be recovered.
+"""
+
+import os
+import time
+import sqlite3
+from contextlib import contextmanager
+
+from metrics import Metrics
+
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KB = 64 * 1024
+
+# Columns added after the first release; ensure_schema() adds whichever are missing.
+IMAGE_COLUMNS = [
+    ('captured_at', 'INTEGER'),
+    # Display metadata (see metadata.py); NULL means "not probed yet".
+    ('width', 'INTEGER'),
+    ('height', 'INTEGER'),
+    ('file_size', 'INTEGER'),
+    ('thumb_name', 'TEXT'),
+    ('thumb_size', 'INTEGER'),
+    ('placeholder', 'TEXT'),
+]
+
+INSERT_IMAGE = ("INSERT OR IGNORE INTO images (id, channel, timestamp, file_name, captured_at, width, height, file_size) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+INSERT_SEEN = "INSERT OR IGNORE INTO seen (channel, msg_id) VALUES (?, ?)"
+
+
+def connect(db_path: str, readonly: bool = False) -> sqlite3.Connection:
+    if readonly:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=BUSY_TIMEOUT_MS / 1000)
+    else:
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000)
+        # WAL lets readers (PHP, sitemap) run while we write; NORMAL only
+        # fsyncs at checkpoints, which is safe in WAL mode.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+def table_columns(conn: sqlite3.Connection, table: str):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def ensure_schema(conn: sqlite3.Connection):
+    """Create or upgrade the gallery schema.  Returns the list of added columns."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS images
+        (id TEXT NOT NULL, channel TEXT, timestamp INTEGER, file_name TEXT, captured_at INTEGER)''')
+    existing = table_columns(conn, 'images')
+    added = []
+    for name, decl in IMAGE_COLUMNS:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE images ADD COLUMN {name} {decl}")
+            added.append(name)
+    if _rekey_images(conn):
+        added.append('images(channel, id) key')
+    # Message IDs are per channel: the same ID in two channels is two images.
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_images_key ON images (channel, id)")
+    # Keyset pagination of query.py follows the manifests' (timestamp, rowid): idx_images_ts serves it, and
+    # idx_sort_channel per channel.  The older captured_at-first indexes are replaced.
+    if 'captured_at' in {row[2] for row in conn.execute("PRAGMA index_info(idx_sort_channel)")}:
+        conn.execute("DROP INDEX idx_sort_channel")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sort_channel ON images (channel, timestamp)")
+    conn.execute("DROP INDEX IF EXISTS idx_sort_keyset")
+    conn.execute("DROP INDEX IF EXISTS idx_sort_flow")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_images_file ON images (file_name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_images_ts ON images (timestamp)")
+    conn.execute('''CREATE TABLE IF NOT EXISTS seen
+        (channel TEXT NOT NULL, msg_id INTEGER NOT NULL, PRIMARY KEY (msg_id, channel)) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS cursors
+        (channel TEXT PRIMARY KEY, last_id INTEGER NOT NULL, updated_at INTEGER)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS files
+        (file_name TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime INTEGER NOT NULL)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_files_mtime ON files (mtime)")
+    conn.execute('''CREATE TABLE IF NOT EXISTS manifest_pages
+        (order_key TEXT NOT NULL, page INTEGER NOT NULL, digest TEXT NOT NULL,
+         PRIMARY KEY (order_key, page)) WITHOUT ROWID''')
+    # Sort keys of the random manifest orders (manifests.perm_key), computed once per image and seed.
+    conn.execute('''CREATE TABLE IF NOT EXISTS perm_keys
+        (img INTEGER NOT NULL, seed INTEGER NOT NULL, perm INTEGER NOT NULL, PRIMARY KEY (img, seed)) WITHOUT ROWID''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_perm_keys_order ON perm_keys (seed, perm)")
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS images_drop_perm AFTER DELETE ON images BEGIN
+        DELETE FROM perm_keys WHERE img = OLD.rowid;
+        END''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS sitemap_shards
+        (shard INTEGER PRIMARY KEY, digest TEXT NOT NULL, lastmod TEXT)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS push_state
+        (url TEXT PRIMARY KEY, digest TEXT NOT NULL, pushed_at INTEGER)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS push_quota
+        (day TEXT PRIMARY KEY, used INTEGER NOT NULL)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS renditions
+        (file_name TEXT NOT NULL, width INTEGER NOT NULL, format TEXT NOT NULL, name TEXT NOT NULL,
+         height INTEGER, bytes INTEGER, spec TEXT, src_hash TEXT, src_size INTEGER, src_mtime INTEGER,
+         PRIMARY KEY (file_name, width, format)) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS phashes
+        (file_name TEXT PRIMARY KEY, phash INTEGER NOT NULL, dhash INTEGER NOT NULL,
+         b0 INTEGER, b1 INTEGER, b2 INTEGER, b3 INTEGER, dup_of TEXT, distance INTEGER)''')
+    for k in range(4):
+        # Multi-index hashing bands; only first copies are ever looked up.
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_phash_b{k} ON phashes (b{k}) WHERE dup_of IS NULL")
+    conn.execute('''CREATE TABLE IF NOT EXISTS channel_schedule
+        (channel TEXT PRIMARY KEY, interval REAL NOT NULL, next_due REAL NOT NULL, rate REAL, last_run REAL)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS channel_leases
+        (channel TEXT PRIMARY KEY, worker TEXT, expires_at REAL NOT NULL DEFAULT 0, heartbeat_at REAL,
+         last_done REAL)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS layout_moves
+        (old TEXT PRIMARY KEY, new TEXT NOT NULL, state TEXT NOT NULL)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS blobs
+        (sha256 TEXT PRIMARY KEY, size INTEGER NOT NULL, refs INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS blob_refs
+        (file_name TEXT PRIMARY KEY, sha256 TEXT NOT NULL, size INTEGER NOT NULL)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_blob_refs_sha ON blob_refs (sha256)")
+    # refs is maintained here rather than by callers, so buffered ref inserts can run in any order.
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS blob_refs_add AFTER INSERT ON blob_refs BEGIN
+        INSERT OR IGNORE INTO blobs (sha256, size, refs) VALUES (NEW.sha256, NEW.size, 0);
+        UPDATE blobs SET refs = refs + 1 WHERE sha256 = NEW.sha256;
+        END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS blob_refs_drop AFTER DELETE ON blob_refs BEGIN
+        UPDATE blobs SET refs = refs - 1 WHERE sha256 = OLD.sha256;
+        END''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS albums
+        (channel TEXT NOT NULL, grouped_id TEXT NOT NULL, size INTEGER NOT NULL, policy TEXT NOT NULL,
+         first_id INTEGER, captured_at INTEGER, PRIMARY KEY (channel, grouped_id)) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS album_members
+        (channel TEXT NOT NULL, grouped_id TEXT NOT NULL, msg_id INTEGER NOT NULL, position INTEGER NOT NULL,
+         sampled INTEGER NOT NULL, PRIMARY KEY (channel, grouped_id, msg_id)) WITHOUT ROWID''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_album_members_msg ON album_members (channel, msg_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_album_members_unsampled ON album_members (channel, msg_id) "
+                 "WHERE sampled = 0")
+    # captions.id is an INTEGER PRIMARY KEY so the rowids captions_fts points at survive VACUUM.
+    conn.execute('''CREATE TABLE IF NOT EXISTS captions
+        (id INTEGER PRIMARY KEY, channel TEXT NOT NULL, msg_id INTEGER NOT NULL, text TEXT NOT NULL,
+         UNIQUE (channel, msg_id))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS hashtags
+        (tag TEXT NOT NULL, channel TEXT NOT NULL, msg_id INTEGER NOT NULL,
+         PRIMARY KEY (tag, channel, msg_id)) WITHOUT ROWID''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_hashtags_msg ON hashtags (channel, msg_id)")
+    conn.execute('''CREATE TABLE IF NOT EXISTS channels
+        (channel TEXT PRIMARY KEY, peer_id INTEGER, title TEXT, username TEXT, updated_at INTEGER)''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS images_drop_caption AFTER DELETE ON images BEGIN
+        DELETE FROM captions WHERE channel = OLD.channel AND msg_id = CAST(OLD.id AS INTEGER);
+        DELETE FROM hashtags WHERE channel = OLD.channel AND msg_id = CAST(OLD.id AS INTEGER);
+        END''')
+    ensure_search_index(conn)
+    conn.execute('''CREATE TABLE IF NOT EXISTS meta
+        (key TEXT PRIMARY KEY, value TEXT)''')
+    conn.commit()
+    return added
+
+
+def _rekey_images(conn: sqlite3.Connection) -> bool:
+    """Rebuild an ``images`` table keyed on the bare message ID; returns True if it did.
+
+    SQLite cannot drop a primary key in place, so the table is copied (rowids
+    included: the random manifest orders are keyed on them) and its indexes and
+    triggers are recreated by ``ensure_schema``.  Rows that collided across
+    channels were never stored; ``sync_to_db.py --full`` registers their files.
+    """
+    info = list(conn.execute("PRAGMA table_info(images)"))
+    if [row[1] for row in info if row[5]] != ['id']:
+        return False
+    columns = [row[1] for row in info]
+    decls = ', '.join('id TEXT NOT NULL' if name == 'id' else f"{name} {decl}".strip()
+                      for _, name, decl, *_ in info)
+    names = ', '.join(columns)
+    if conn.in_transaction:
+        conn.commit()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DROP TRIGGER IF EXISTS images_drop_caption")
+        conn.execute("DROP TRIGGER IF EXISTS images_drop_perm")
+        conn.execute(f"CREATE TABLE images_rekeyed ({decls})")
+        conn.execute(f"INSERT INTO images_rekeyed (rowid, {names}) SELECT rowid, {names} FROM images")
+        conn.execute("DROP TABLE images")
+        conn.execute("ALTER TABLE images_rekeyed RENAME TO images")
+    return True
+
+
+def ensure_search_index(conn: sqlite3.Connection) -> bool:
+    """Create the FTS5 index over ``captions`` and the triggers that keep it in sync.
+
+    The trigram tokenizer (SQLite 3.34+) matches substrings, which is what
+    CJK captions without spaces need; older builds fall back to unicode61.
+    Returns False when this SQLite has no FTS5 (search is then unavailable).
+    """
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'captions_fts'").fetchone():
+        return True
+    tokenizer = 'trigram' if sqlite3.sqlite_version_info >= (3, 34, 0) else 'unicode61'
+    try:
+        conn.execute(f'''CREATE VIRTUAL TABLE captions_fts USING fts5
+            (text, content='captions', content_rowid='id', tokenize='{tokenizer}')''')
+    except sqlite3.OperationalError:
+        return False
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS captions_fts_add AFTER INSERT ON captions BEGIN
+        INSERT INTO captions_fts (rowid, text) VALUES (NEW.id, NEW.text);
+        END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS captions_fts_drop AFTER DELETE ON captions BEGIN
+        INSERT INTO captions_fts (captions_fts, rowid, text) VALUES ('delete', OLD.id, OLD.text);
+        END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS captions_fts_edit AFTER UPDATE ON captions BEGIN
+        INSERT INTO captions_fts (captions_fts, rowid, text) VALUES ('delete', OLD.id, OLD.text);
+        INSERT INTO captions_fts (rowid, text) VALUES (NEW.id, NEW.text);
+        END''')
+    # Captions recorded before the index existed (or by a build without FTS5).
+    conn.execute("INSERT INTO captions_fts (captions_fts) VALUES ('rebuild')")
+    return True
+
+
+class GalleryDB:
+    """Long-lived writer connection with buffered, batched inserts.
+
+    ``add_image`` and friends only append to an in-memory buffer; the buffer
+    is written in a single transaction once it holds ``batch_size`` rows or its
+    oldest row is ``flush_interval`` seconds old.  ``close`` flushes what is left.
+    Each flush is timed as the ``db_write`` stage of ``metrics``; callables in
+    ``flush_hooks`` run after each committed flush (to drop state that only
+    mirrors buffered rows).
+    """
+
+    def __init__(self, db_path: str, batch_size: int = 200, flush_interval: float = 2.0, metrics: Metrics = None):
+        self.db_path = db_path
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.metrics = metrics or Metrics()
+        self.conn = connect(db_path)
+        self._buffers = []  # [sql, rows] runs, in queue order
+        self._count = 0
+        self._seen_keys = set()
+        self._first_at = 0.0
+        self.flush_hooks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def ensure_schema(self):
+        return ensure_schema(self.conn)
+
+    @property
+    def pending(self) -> int:
+        """Rows queued and not yet committed."""
+        return self._count
+
+    @contextmanager
+    def transaction(self):
+        """Run a block of statements in one transaction (after flushing the buffer)."""
+        self.flush()
+        try:
+            yield self.conn
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+
+    def queue(self, sql: str, row):
+        """Buffer one parameter row for ``sql``; all buffered statements commit together, in queue order."""
+        if not self._count:
+            self._first_at = time.monotonic()
+        if self._buffers and self._buffers[-1][0] == sql:
+            self._buffers[-1][1].append(row)
+        else:
+            self._buffers.append([sql, [row]])
+        self._count += 1
+        self.maybe_flush()
+
+    def add_image(self, msg_id, channel, timestamp, file_name, captured_at, width=None, height=None, file_size=None):
+        self.queue(INSERT_IMAGE, (str(msg_id), channel, int(timestamp), file_name, captured_at, width, height, file_size))
+
+    def mark_seen(self, channel, msg_id):
+        """Buffer a dedup key; it is committed in the same transaction as the image rows."""
+        key = (channel, int(msg_id))
+        if key in self._seen_keys:
+            return
+        self._seen_keys.add(key)
+        self.queue(INSERT_SEEN, key)
+
+    def is_seen(self, channel, msg_id) -> bool:
+        msg_id = int(msg_id)
+        if (channel, msg_id) in self._seen_keys:
+            return True
+        row = self.conn.execute("SELECT 1 FROM seen WHERE msg_id = ? AND channel IN (?, '') LIMIT 1",
+                                (msg_id, channel)).fetchone()
+        return row is not None
+
+    def get_cursor(self, channel) -> int:
+        row = self.conn.execute("SELECT last_id FROM cursors WHERE channel = ?", (channel,)).fetchone()
+        return int(row[0]) if row else 0
+
+    def set_cursor(self, channel, last_id: int):
+        """Advance a channel cursor; buffered rows are flushed first so the cursor never runs ahead of them."""
+        self.flush()
+        with self.conn:
+            self.conn.execute('''INSERT INTO cursors (channel, last_id, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(channel) DO UPDATE SET last_id = MAX(last_id, excluded.last_id),
+                updated_at = excluded.updated_at''', (channel, int(last_id), int(time.time())))
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.flush()
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def maybe_flush(self):
+        if not self._count:
+            return
+        if self._count >= self.batch_size or time.monotonic() - self._first_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if not self._count:
+            return 0
+        # Consecutive rows of one statement run as one executemany.
+        with self.metrics.timed('db_write'), self.conn:
+            for sql, rows in self._buffers:
+                self.conn.executemany(sql, rows)
+        # Only a committed batch leaves the buffer: if the transaction failed (SQLITE_BUSY
+        # from another writer, ...), its rows and seen keys stay queued for the next flush.
+        count = self._count
+        self._buffers, self._count = [], 0
+        self._seen_keys.clear()
+        for hook in self.flush_hooks:
+            hook()
+        self.metrics.inc('pencilai_db_rows_total', count)
+        return count
+
+    def close(self):
+        if self.conn is None:
+            return
+        try:
+            self.flush()
+        finally:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,99 @@
+"""A synthetic Telegram client for benchmarks and local runs without Telegram.
+
+``FakeTelegramClient`` stands in for ``telethon.TelegramClient`` as far as the
+ingest pipeline uses it: every channel serves the same reproducible history of
+single photos and albums (newest first), and downloads return canned JPEG bytes
+after a configurable latency.  benchmark.py times the ingest stage against it;
+``shards.py --stub`` runs workers on it.
+"""
+
+import io
+import types
+import random
+import zlib
+import asyncio
+import datetime
+
+EPOCH = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def jpeg_bytes(width: int, height: int, seed: int) -> bytes:
+    from PIL import Image
+
+    random.seed(seed)
+    img = Image.effect_noise((width, height), 40 + random.random() * 40).convert('RGB')
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=90)
+    return buf.getvalue()
+
+
+def album_ids(rng: random.Random, count: int, start_id: int):
+    """Yield (msg_id, group) with albums of 1-10 photos, like a real channel."""
+    msg_id = start_id
+    while count > 0:
+        size = min(count, rng.choice([1, 1, 1, 2, 3, 4, 6, 10]))
+        group = f"{msg_id}" if size > 1 else None
+        for _ in range(size):
+            yield msg_id, group or f"S{msg_id}"
+            msg_id += 1
+        count -= size
+
+
+class FakeMessage:
+    def __init__(self, msg_id: int, grouped_id, photo: bool = True):
+        self.id = msg_id
+        self.grouped_id = grouped_id
+        self.photo = photo
+        self.date = (EPOCH + datetime.timedelta(seconds=msg_id * 37)).replace(tzinfo=None)
+        self.text = ''
+
+
+class FakeTelegramClient:
+    """Serves ``messages`` per channel (newest first) and canned photo bytes after ``latency`` seconds."""
+
+    def __init__(self, messages: int, latency: float, jitter: float, payload: bytes, seed: int = 0):
+        self.messages = messages
+        self.latency = latency
+        self.jitter = jitter
+        self.payload = payload
+        self._rng = random.Random(seed)
+        self.downloaded_bytes = 0
+
+    async def start(self, phone=None, password=None):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def get_entity(self, channel):
+        return types.SimpleNamespace(id=zlib.crc32(channel.encode()), title=channel.title(), username=channel)
+
+    async def iter_messages(self, channel, limit=None, min_id=0):
+        rng = random.Random(f"{channel}")
+        ids = list(album_ids(rng, self.messages, 1))
+        count = 0
+        for msg_id, group in reversed(ids):
+            if msg_id <= min_id or (limit and count >= limit):
+                break
+            count += 1
+            yield FakeMessage(msg_id, None if group.startswith('S') else int(group), photo=msg_id % 17 != 0)
+
+    async def download_media(self, message, file=None, thumb=None):
+        await asyncio.sleep(max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter)))
+        if isinstance(file, str):
+            with open(file, 'wb') as f:
+                f.write(self.payload)
+        else:
+            # A stream (downloads.PartFile), like Telethon accepts.
+            file.write(self.payload)
+        self.downloaded_bytes += len(self.payload)
+        return file
+
+
+def client_factory(messages: int = 200, latency: float = 0.01, jitter: float = 0.005):
+    """A ``make_client(session, api_id, api_hash)`` for main.run_task_once that builds stub clients."""
+    payload = jpeg_bytes(320, 240, 0)
+    return lambda *args: FakeTelegramClient(messages, latency, jitter, payload)
@@ -1,65 +1,101 @@
-import os
-import json
-import sqlite3
+import re
+import calendar
 from datetime import datetime
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DEFAULT_CONFIG = os.path.join(BASE_DIR, 'config.json')
-
-def _load_config_paths():
-    # Use config.json if present; fallback to config.example.json for path defaults
-    cfg_path = os.environ.get('PENCILAI_CONFIG', DEFAULT_CONFIG)
-    if not os.path.exists(cfg_path):
-        cfg_path = os.path.join(BASE_DIR, 'config.example.json')
-    with open(cfg_path, 'r', encoding='utf-8') as f:
-        cfg = json.load(f)
-    paths = cfg.get('paths', {}) if isinstance(cfg, dict) else {}
-    db_path = paths.get('db_path', './gallery.db')
-    tg_dir = paths.get('tg_gallery_dir', '../tg_gallery')
-    # resolve relative paths against scripts/ directory
-    if not os.path.isabs(db_path):
-        db_path = os.path.abspath(os.path.join(BASE_DIR, db_path))
-    if not os.path.isabs(tg_dir):
-        tg_dir = os.path.abspath(os.path.join(BASE_DIR, tg_dir))
-    return db_path, tg_dir
-
-
-# resolved paths
-db_path, gallery_dir = _load_config_paths()
+
+from storage import GalleryDB
+from layout import iter_gallery, tree_mtime
+from config import config_path
+
+# 路径统一由 config.py 解析（同一进程内只读一次配置）
+db_path, gallery_dir = config_path('db_path'), config_path('tg_gallery_dir')
+
+
+_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+_TIME = re.compile(r'^\d{2}-\d{2}-\d{2}$')
+
+
+def parse_file_name(name):
+    """解析两种命名格式，返回 (频道, 时间戳, 消息ID)；无法识别时返回 None。
+
+    - main.py:  photo_<频道>_<日期>_<时间>_<组>_<ID>.jpg（频道名可含下划线，按右侧定位字段；时间为 UTC）
+    - 旧格式:   photo_<日期>_<时间>_<ID>.jpg（频道记为 "Legacy"，时间按本地时区解析，与旧版一致）
+    """
+    if not name.startswith('photo_') or not name.endswith('.jpg') or name.endswith('_thumb.webp'):
+        return None
+    parts = name[:-4].split('_')
+    if len(parts) >= 6 and _DATE.match(parts[-4]) and _TIME.match(parts[-3]) and parts[-1].isdigit():
+        channel = '_'.join(parts[1:-4])
+        dt = datetime.strptime(f"{parts[-4]} {parts[-3]}", '%Y-%m-%d %H-%M-%S')
+        return channel, calendar.timegm(dt.timetuple()), int(parts[-1])
+    if len(parts) == 4 and _DATE.match(parts[1]) and _TIME.match(parts[2]) and parts[3].isdigit():
+        dt = datetime.strptime(f"{parts[1]} {parts[2]}", '%Y-%m-%d %H-%M-%S')
+        return "Legacy", int(dt.timestamp()), int(parts[3])
+    return None
 
 
 # 配置与 main.py 保持一致
-def sync_existing_files():
-    # 初始化数据库连接
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS images 
-        (id TEXT PRIMARY KEY, channel TEXT, timestamp INTEGER, file_name TEXT)''')
-
-    # 只扫描原图（不扫描 thumb 缩略图）
-    files = [f for f in os.listdir(gallery_dir) if f.endswith('.jpg') and not f.endswith('_thumb.webp')]
-    print(f"📡 发现本地 {len(files)} 张存量图片，正在补录进数据库...")
-
-    count = 0
-    for f in files:
-        try:
-            # 文件名格式：photo_2024-12-25_12-00-00_ID.jpg
-            parts = f.replace('.jpg', '').split('_')
-            if len(parts) >= 4:
-                # 解析日期和时间
-                date_str = f"{parts[1]} {parts[2].replace('-', ':')}"
-                ts = int(datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S').timestamp())
-                msg_id = parts[3]
-                
-                # 写入数据库，标记频道为 "Legacy" (存量图无法追溯原始频道)
-                cursor.execute("INSERT OR IGNORE INTO images VALUES (?, ?, ?, ?)", 
-                               (msg_id, "Legacy", ts, f))
-                count += 1
-        except Exception as e:
+def sync_existing_files(full=False):
+    """增量补录：只处理上次同步之后新增的文件。
+
+    高水位线 (mtime_ns, inode) 记录在 meta 表；目录及各分片子目录的 mtime 均未变化时直接跳过扫描，
+    否则只扫描 mtime 晚于上次同步的目录（未新增文件的分片目录连 stat 都省掉）。
+    file_name 存相对画廊目录的路径（分片布局下含子目录，见 layout.py）。
+    full=True 时忽略水位线，全量重扫（例如用 cp -p / rsync -a 拷入保留旧 mtime 的文件后）。
+    """
+    # 初始化数据库连接（共用 storage 层：WAL + 批量事务，表结构与 main.py 一致）
+    db = GalleryDB(db_path, batch_size=1000)
+    db.ensure_schema()
+
+    dir_mtime = tree_mtime(gallery_dir)
+    hwm = (0, 0)
+    since = 0
+    if not full:
+        since = int(db.get_meta('sync_dir_mtime', 0))
+        if since == dir_mtime:
+            print("ℹ️  目录自上次同步后没有变化，跳过扫描。")
+            db.close()
+            return 0
+        hwm = tuple(int(x) for x in db.get_meta('sync_hwm', '0:0').split(':'))
+
+    print(f"📡 正在增量扫描本地图片（水位线 mtime_ns={hwm[0]}）...")
+
+    count = skipped = unknown = 0
+    new_hwm = hwm
+    # mtime 早于上次同步所记 tree_mtime 的目录此后没有新增条目，整个跳过
+    for rel, entry in iter_gallery(gallery_dir, changed_since=since):
+        # 只处理原图（不处理 thumb 缩略图）
+        if not entry.name.endswith('.jpg'):
+            continue
+        st = entry.stat()
+        mark = (st.st_mtime_ns, entry.inode())
+        if mark <= hwm:
+            skipped += 1
             continue
-    
-    conn.commit()
-    conn.close()
-    print(f"✅ 成功补录 {count} 条数据。现在你可以修改前端 PHP 使用 SQL 排序了！")
+        new_hwm = max(new_hwm, mark)
+        parsed = parse_file_name(entry.name)
+        if parsed is None:
+            unknown += 1
+            continue
+        channel, ts, msg_id = parsed
+        # captured_at 取文件 mtime（入库时间）；seen 防止 main.py 重复下载；files 供磁盘配额使用
+        db.add_image(msg_id, channel, ts, rel, int(st.st_mtime), file_size=st.st_size)
+        if channel != "Legacy":
+            db.mark_seen(channel, msg_id)
+        db.queue("INSERT OR REPLACE INTO files (file_name, size, mtime) VALUES (?, ?, ?)",
+                 (rel, st.st_size, int(st.st_mtime)))
+        count += 1
+
+    db.flush()
+    db.set_meta('sync_hwm', f"{new_hwm[0]}:{new_hwm[1]}")
+    db.set_meta('sync_dir_mtime', dir_mtime)
+    db.close()
+    print(f"✅ 成功补录 {count} 条数据（跳过已同步 {skipped} 个，无法识别 {unknown} 个）。")
+    return count
 
 if __name__ == "__main__":
-    sync_existing_files()
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="把 tg_gallery 中的存量图片补录进数据库")
+    parser.add_argument('--full', action='store_true', help="忽略水位线，全量重扫")
+    args = parser.parse_args()
+    sync_existing_files(full=args.full)
@@ -0,0 +1,215 @@
+"""Thumbnail stage: WebP thumbnails rendered in a process pool.
+
+Pillow work (decode, LANCZOS resize, WebP encode) is CPU bound and holds the
+GIL, so it never runs on the ingest event loop.  ``ThumbnailStage`` feeds a
+``ProcessPoolExecutor`` with a bounded backlog; ``regenerate_missing`` is the
+standalone batch that fills in every missing thumbnail of the gallery.  The
+stage also runs the multi-width jobs of renditions.py.
+
+Usage:
+  python thumbs.py [gallery_dir] [--workers N]
+"""
+
+import os
+import sys
+import time
+
+from metrics import Metrics
+
+# asyncio and the process pool are imported where they are used: every maintenance
+# script imports this module (through layout.py) and should not pay for them.
+
+TARGET_WIDTH = 1080
+SIZE_THRESHOLD = 300 * 1024
+ORIGINAL_EXTS = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
+THUMB_SUFFIX = '_thumb.webp'
+
+
+def thumb_path_for(image_path: str) -> str:
+    base, _ = os.path.splitext(image_path)
+    return f"{base}{THUMB_SUFFIX}"
+
+
+def create_thumbnail_1080p(image_path: str, target_width: int = TARGET_WIDTH, size_threshold: int = SIZE_THRESHOLD):
+    """Render ``<base>_thumb.webp`` next to ``image_path``.
+
+    Returns the thumbnail path, or None when the original is small enough to be
+    served as-is or already has a thumbnail.  Errors propagate to the caller.
+    """
+    if os.path.getsize(image_path) < size_threshold:
+        return None
+    thumb_path = thumb_path_for(image_path)
+    if os.path.exists(thumb_path):
+        return None
+
+    from PIL import Image
+
+    with Image.open(image_path) as img:
+        w, h = img.size
+        if img.format == 'JPEG' and w > target_width * 2:
+            # Let libjpeg downscale by 1/2, 1/4 or 1/8 while decoding; the
+            # result stays >= target_width so LANCZOS still does the final pass.
+            img.draft('RGB', (target_width, max(1, int(h * target_width / w))))
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        if img.size[0] > target_width:
+            w_percent = (target_width / float(img.size[0]))
+            new_height = int(float(img.size[1]) * float(w_percent))
+            img = img.resize((target_width, new_height), Image.Resampling.LANCZOS)
+        tmp_path = thumb_path + '.tmp'
+        img.save(tmp_path, "WEBP", quality=85)
+    os.replace(tmp_path, thumb_path)
+    return thumb_path
+
+
+def _thumb_job(image_path: str):
+    # Runs in a worker process; return a picklable (path, thumb, error) triple.
+    try:
+        return image_path, create_thumbnail_1080p(image_path), None
+    except Exception as e:
+        tmp_path = thumb_path_for(image_path) + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return image_path, None, f"{type(e).__name__}: {e}"
+
+
+class ThumbnailStage:
+    """Async front-end of a thumbnail process pool with a bounded backlog.
+
+    ``submit`` returns as soon as the job is queued; it only waits when
+    ``backlog`` jobs are already outstanding, which back-pressures the
+    downloaders instead of letting pending images pile up in memory.  The
+    ``thumbnail`` stage time in ``metrics`` runs from submit to result, so it
+    includes time spent waiting for a free worker.
+    """
+
+    def __init__(self, workers: int = None, backlog: int = 64, job=None, on_result=None, metrics: Metrics = None):
+        import asyncio
+        from concurrent.futures import ProcessPoolExecutor
+
+        self.workers = workers or os.cpu_count() or 1
+        # ``job(path)`` runs in the pool and returns (path, result, error);
+        # ``on_result(path, result)`` runs on the event loop for each success.
+        self._job = job or _thumb_job
+        self._on_result = on_result
+        self.metrics = metrics or Metrics()
+        self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        self._slots = asyncio.Semaphore(max(1, backlog))
+        self._pending = set()
+        self.done = 0
+        self.failed = []
+
+    async def submit(self, image_path: str):
+        import asyncio
+
+        await self._slots.acquire()
+        loop = asyncio.get_running_loop()
+        fut = loop.run_in_executor(self._pool, self._job, image_path)
+        task = asyncio.ensure_future(self._collect(fut, time.perf_counter()))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    def reuse(self, image_path: str, result):
+        """Deliver a result produced without the pool (outputs linked from an identical file, see cas.py)."""
+        self.metrics.stage('thumbnail', 0.0, 'skipped')
+        self._deliver(image_path, result)
+
+    def _deliver(self, image_path: str, result):
+        # A failing callback (SQL, I/O in dedup or record_result) fails this image, not the stage.
+        try:
+            if self._on_result is not None:
+                self._on_result(image_path, result)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            self.failed.append((image_path, error))
+            print(f"      ⚠️  recording thumbnail failed: {os.path.basename(image_path)}: {error}")
+        else:
+            self.done += 1
+
+    @property
+    def backlog(self) -> int:
+        return len(self._pending)
+
+    async def _collect(self, fut, started: float):
+        try:
+            image_path, result, error = await fut
+        except Exception as e:
+            # The pool itself broke (e.g. a worker was OOM-killed).
+            image_path, error = '?', f"{type(e).__name__}: {e}"
+        finally:
+            self._slots.release()
+        self.metrics.stage('thumbnail', time.perf_counter() - started, 'error' if error else 'ok')
+        if error:
+            self.failed.append((image_path, error))
+            print(f"      ⚠️  thumbnail failed: {os.path.basename(image_path)}: {error}")
+        else:
+            self._deliver(image_path, result)
+
+    async def close(self):
+        import asyncio
+
+        if self._pending:
+            await asyncio.gather(*list(self._pending), return_exceptions=True)
+        self._pool.shutdown(wait=True)
+
+
+def find_missing(gallery_dir: str, size_threshold: int = SIZE_THRESHOLD):
+    """Yield originals under ``gallery_dir`` (and its shard dirs) that need but lack a thumbnail."""
+    from layout import iter_gallery
+
+    names = set()
+    originals = []
+    for rel, entry in iter_gallery(gallery_dir):
+        names.add(rel)
+        lower = entry.name.lower()
+        if lower.endswith(ORIGINAL_EXTS) and not lower.endswith(THUMB_SUFFIX):
+            originals.append((rel, entry))
+    for rel, entry in originals:
+        base, _ = os.path.splitext(rel)
+        if f"{base}{THUMB_SUFFIX}" in names:
+            continue
+        if entry.stat().st_size < size_threshold:
+            continue
+        yield entry.path
+
+
+def regenerate_missing(gallery_dir: str, workers: int = None):
+    """Render every missing thumbnail under ``gallery_dir`` on all cores.
+
+    Returns ``(created, failures)``: the originals that got a thumbnail and a list of
+    (path, error) pairs.
+    """
+    todo = list(find_missing(gallery_dir))
+    workers = workers or os.cpu_count() or 1
+    print(f"🖼️  {len(todo)} originals without thumbnail, rendering on {workers} processes...")
+
+    created = []
+    failures = []
+    if todo:
+        from concurrent.futures import ProcessPoolExecutor
+
+        chunksize = max(1, min(64, len(todo) // (workers * 4)))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for image_path, thumb, error in pool.map(_thumb_job, todo, chunksize=chunksize):
+                if error:
+                    failures.append((image_path, error))
+                    print(f"  ❌ {os.path.basename(image_path)}: {error}")
+                elif thumb:
+                    created.append(image_path)
+
+    print(f"✅ thumbnails created: {len(created)}, failed: {len(failures)}")
+    return created, failures
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from config import config_path
+
+    parser = argparse.ArgumentParser(description='Regenerate missing gallery thumbnails')
+    parser.add_argument('gallery_dir', nargs='?', default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    _, failures = regenerate_missing(args.gallery_dir or config_path('tg_gallery_dir'), workers=args.workers)
+    sys.exit(1 if failures else 0)
@@ -39,9 +39,19 @@ function penc_get_all_images(): array {
 
     $rows = [];
     try {
-        $db = new SQLite3($db_path);
-        // Keep backward compatibility with your schema: images(id, channel, timestamp, file_name, captured_at)
-        $res = $db->query('SELECT file_name, timestamp FROM images ORDER BY timestamp DESC');
+        $db = new SQLite3($db_path, SQLITE3_OPEN_READONLY);
+        // scripts/ write in WAL mode; wait briefly instead of failing on a checkpoint lock.
+        $db->busyTimeout(2000);
+        // The rows and order of the published manifests (LIVE_IMAGES / LATEST_ORDER in scripts/manifests.py):
+        // no empty files, no near-duplicates linked to a first copy by scripts/dedup.py.
+        $live = "WHERE file_name IS NOT NULL AND file_name != '' AND (file_size IS NULL OR file_size > 0) ";
+        $order = 'ORDER BY timestamp DESC, rowid DESC';
+        $cols = 'SELECT file_name, timestamp, width, height, file_size, thumb_name, thumb_size, placeholder FROM images ';
+        $res = @$db->query($cols.$live.'AND file_name NOT IN (SELECT file_name FROM phashes WHERE dup_of IS NOT NULL) '.$order);
+        // Older schemas: without phashes (scripts/dedup.py), without the display metadata columns
+        // (scripts/metadata.py), or just images(id, channel, timestamp, file_name, captured_at).
+        if (!$res) $res = @$db->query($cols.$live.$order);
+        if (!$res) $res = $db->query('SELECT file_name, timestamp FROM images '.$order);
         while ($res && ($row = $res->fetchArray(SQLITE3_ASSOC))) {
             if (!empty($row['file_name'])) $rows[] = $row;
         }
@@ -52,3 +62,70 @@ function penc_get_all_images(): array {
 
     return $rows;
 }
+
+/**
+ * Directory holding the page manifests published by scripts/manifests.py.
+ *
+ * Priority: PENCILAI_MANIFEST_DIR constant, env PENCILAI_MANIFEST_DIR,
+ * then <wp-root>/scripts/manifests.
+ */
+function penc_manifest_dir(): string {
+    if (defined('PENCILAI_MANIFEST_DIR') && PENCILAI_MANIFEST_DIR) return rtrim(PENCILAI_MANIFEST_DIR, '/');
+    if (getenv('PENCILAI_MANIFEST_DIR')) return rtrim(getenv('PENCILAI_MANIFEST_DIR'), '/');
+    return rtrim(ABSPATH, '/').'/scripts/manifests';
+}
+
+/**
+ * The manifest index (index.json: totals and settings), read once per request;
+ * null when no manifest has been published yet.
+ */
+function penc_manifest_index(): ?array {
+    static $index = false;
+    if ($index === false) {
+        $raw = @file_get_contents(penc_manifest_dir().'/index.json');
+        $index = ($raw === false) ? null : json_decode($raw, true);
+        if (!is_array($index) || !isset($index['pages'])) $index = null;
+    }
+    return $index;
+}
+
+/**
+ * Images per gallery page: the manifests' per_page (manifests.per_page in
+ * scripts/config.json), so the fallback pages like the published ones.
+ */
+function penc_items_per_page(): int {
+    $index = penc_manifest_index();
+    return max(1, (int)($index['per_page'] ?? 15));
+}
+
+/**
+ * Read one precomputed gallery page.
+ *
+ * Returns ['items' => [['f','t','s','w','h','p'], ...], 'total_pages' => int], or null
+ * when no manifest has been published yet (the template then falls back to
+ * penc_get_all_images()).
+ */
+function penc_read_manifest(string $sort_mode, int $seed, int $page): ?array {
+    $dir = penc_manifest_dir();
+    $index = penc_manifest_index();
+    if ($index === null) return null;
+
+    if ($sort_mode === 'random') {
+        $seeds = max(1, (int)($index['random_seeds'] ?? 1));
+        $order = 'random-'.(abs($seed) % $seeds);
+        $total_pages = max(1, (int)($index['random_pages'] ?? 1));
+    } else {
+        $order = 'latest';
+        $total_pages = max(1, (int)$index['pages']);
+    }
+
+    $items = [];
+    if ($page >= 1 && $page <= $total_pages) {
+        $page_raw = @file_get_contents($dir.'/'.$order.'/'.$page.'.json');
+        $data = ($page_raw === false) ? null : json_decode($page_raw, true);
+        if (!is_array($data)) return null;
+        $items = $data['items'] ?? [];
+    }
+
+    return ['items' => $items, 'total_pages' => $total_pages];
+}
@@ -24,20 +24,53 @@ $texts = [
 $t = $texts[$lang];
 
 // ---------- helpers ----------
-function penc_render_card(string $fn, array $t): void {
-    $base_name = pathinfo($fn, PATHINFO_FILENAME);
-    $thumb_fn = $base_name . '_thumb.webp';
-    $display_fn = file_exists(ABSPATH . 'tg_gallery/' . $thumb_fn) ? $thumb_fn : $fn;
+// $item: a manifest entry ['f' => file, 't' => thumb, 's' => bytes, ...] or just ['f' => file].
+function penc_srcset(array $list, string $base_url): string {
+    $parts = [];
+    foreach ($list as $r) {
+        $parts[] = esc_url($base_url . $r[0]) . ' ' . (int)$r[1] . 'w';
+    }
+    return implode(', ', $parts);
+}
+
+function penc_render_card(array $item, array $t): void {
+    $fn = $item['f'];
+    if (isset($item['t'])) {
+        $display_fn = ($item['t'] !== '') ? $item['t'] : $fn;
+    } else {
+        // $fn may carry a shard directory (see scripts/layout.py); the thumbnail sits next to it.
+        $thumb_fn = preg_replace('/\.[^.\/]+$/', '', $fn) . '_thumb.webp';
+        $display_fn = file_exists(ABSPATH . 'tg_gallery/' . $thumb_fn) ? $thumb_fn : $fn;
+    }
     $img_url = home_url('/tg_gallery/');
+    // Stored dimensions let the browser reserve the card box before the image arrives.
+    $dims = (!empty($item['w']) && !empty($item['h'])) ? ' width="' . (int)$item['w'] . '" height="' . (int)$item['h'] . '"' : '';
+    $frame_style = (!empty($item['p']) && preg_match('/^#[0-9a-f]{6}$/i', $item['p'])) ? ' style="background-color:' . $item['p'] . '"' : '';
 
     echo '<div class="gallery-item-card">';
-        echo '<div class="img-frame">';
+        echo '<div class="img-frame"' . $frame_style . '>';
             echo '<a href="' . esc_url($img_url.$fn) . '" target="_blank" rel="noopener">';
-                echo '<img data-src="' . esc_url($img_url.$display_fn) . '" class="lazy-load" alt="" oncontextmenu="return false;">';
+                // Cards are ~31% of the 1400px column (47% under 800px); let the browser pick the width.
+                $sizes = '(max-width: 800px) 47vw, min(31vw, 434px)';
+                if (!empty($item['r'])) {
+                    $r_url = $img_url . 'renditions/';
+                    echo '<picture>';
+                    if (!empty($item['a'])) {
+                        echo '<source type="image/avif" data-srcset="' . penc_srcset($item['a'], $r_url) . '" sizes="' . $sizes . '">';
+                    }
+                    echo '<img data-src="' . esc_url($img_url.$display_fn) . '" data-srcset="' . penc_srcset($item['r'], $r_url) . '" sizes="' . $sizes . '"' . $dims . ' class="lazy-load" alt="" oncontextmenu="return false;">';
+                    echo '</picture>';
+                } else {
+                    echo '<img data-src="' . esc_url($img_url.$display_fn) . '"' . $dims . ' class="lazy-load" alt="" oncontextmenu="return false;">';
+                }
             echo '</a>';
         echo '</div>';
         echo '<div class="card-meta">';
-            $fs = (file_exists(ABSPATH.'tg_gallery/'.$fn)) ? round(filesize(ABSPATH.'tg_gallery/'.$fn)/1024, 1) . 'KB' : '0KB';
+            if (isset($item['s'])) {
+                $fs = round($item['s']/1024, 1) . 'KB';
+            } else {
+                $fs = (file_exists(ABSPATH.'tg_gallery/'.$fn)) ? round(filesize(ABSPATH.'tg_gallery/'.$fn)/1024, 1) . 'KB' : '0KB';
+            }
             echo '<span class="file-size">' . esc_html($fs) . '</span>';
             echo '<a class="download-btn" href="' . esc_url($img_url.$fn) . '" download>' . esc_html($t['download']) . '</a>';
         echo '</div>';
@@ -47,10 +80,17 @@ function penc_render_card(string $fn, array $t): void {
 function penc_fallback_scan(): array {
     $dir = ABSPATH . 'tg_gallery/';
     if (!is_dir($dir)) return [];
-    $files = glob($dir . '*.{jpg,jpeg,png,webp,gif}', GLOB_BRACE) ?: [];
-    $files = array_values(array_filter($files, fn($p) => strpos($p, '_thumb.webp') === false));
+    // Top level plus up to two levels of shard directories (hash "3f/a0/", date "2024/05/").
+    $files = [];
+    foreach (['', '*/', '*/*/'] as $sub) {
+        foreach (glob($dir . $sub . '*.{jpg,jpeg,png,webp,gif}', GLOB_BRACE) ?: [] as $p) {
+            $rel = substr($p, strlen($dir));
+            if (strpos($rel, 'renditions/') === 0 || strpos($rel, '_thumb.webp') !== false) continue;
+            $files[] = $p;
+        }
+    }
     usort($files, fn($a,$b) => filemtime($b) <=> filemtime($a));
-    return array_map(fn($p) => basename($p), $files);
+    return array_map(fn($p) => substr($p, strlen($dir)), $files);
 }
 
 // ---------- data ----------
@@ -58,35 +98,49 @@ $sort_mode = ($_GET['sort_mode'] ?? 'latest');
 $sort_mode = in_array($sort_mode, ['latest','random'], true) ? $sort_mode : 'latest';
 $seed = isset($_GET['seed']) ? intval($_GET['seed']) : 0;
 
-$items_per_page = 15;
+$items_per_page = function_exists('penc_items_per_page') ? penc_items_per_page() : 15;
 $current_page = max(1, intval($_GET['paged'] ?? 1));
 
-$meta_rows = function_exists('penc_get_all_images') ? penc_get_all_images() : [];
-$files = [];
-if (!empty($meta_rows)) {
-    foreach ($meta_rows as $r) {
-        if (!empty($r['file_name'])) $files[] = $r['file_name'];
-    }
+if ($sort_mode === 'random' && $seed <= 0) $seed = random_int(1, 999999);
+
+// Fast path: one precomputed page from scripts/manifests.py, no table scan.
+$manifest = function_exists('penc_read_manifest') ? penc_read_manifest($sort_mode, $seed, $current_page) : null;
+
+if ($manifest !== null) {
+    $paged_items = $manifest['items'];
+    $total_pages = $manifest['total_pages'];
 } else {
-    $files = penc_fallback_scan();
-}
+    $meta_rows = function_exists('penc_get_all_images') ? penc_get_all_images() : [];
+    $files = [];
+    if (!empty($meta_rows)) {
+        foreach ($meta_rows as $r) {
+            if (empty($r['file_name'])) continue;
+            // Rows with stored metadata render without touching the filesystem.
+            $files[] = isset($r['width'], $r['thumb_size']) ? [
+                'f' => $r['file_name'], 't' => (string)($r['thumb_name'] ?? ''), 's' => (int)$r['file_size'],
+                'w' => (int)$r['width'], 'h' => (int)$r['height'], 'p' => (string)($r['placeholder'] ?? ''),
+            ] : ['f' => $r['file_name']];
+        }
+    } else {
+        $files = array_map(fn($fn) => ['f' => $fn], penc_fallback_scan());
+    }
 
-$total_files = count($files);
+    $total_files = count($files);
 
-if ($sort_mode === 'random') {
-    if ($seed <= 0) $seed = random_int(1, 999999);
-    mt_srand($seed);
-    for ($i = $total_files - 1; $i > 0; $i--) {
-        $j = mt_rand(0, $i);
-        $tmp = $files[$i];
-        $files[$i] = $files[$j];
-        $files[$j] = $tmp;
+    if ($sort_mode === 'random') {
+        mt_srand($seed);
+        for ($i = $total_files - 1; $i > 0; $i--) {
+            $j = mt_rand(0, $i);
+            $tmp = $files[$i];
+            $files[$i] = $files[$j];
+            $files[$j] = $tmp;
+        }
     }
-}
 
-$offset = ($current_page - 1) * $items_per_page;
-$paged_files = array_slice($files, $offset, $items_per_page);
-$total_pages = max(1, (int)ceil($total_files / $items_per_page));
+    $offset = ($current_page - 1) * $items_per_page;
+    $paged_items = array_slice($files, $offset, $items_per_page);
+    $total_pages = max(1, (int)ceil($total_files / $items_per_page));
+}
 
 ?><!DOCTYPE html>
 <html <?php language_attributes(); ?>>
@@ -106,7 +160,7 @@ $total_pages = max(1, (int)ceil($total_files / $items_per_page));
         .gallery-item-card { width: 31%; margin-bottom: 40px; background: transparent; float: left; }
         .img-frame { background: #f4f4f4; border-radius: 4px; overflow: hidden; position: relative; min-height: 200px; transition: transform 0.3s ease, box-shadow 0.3s ease; }
         .img-frame:hover { transform: translateY(-3px); box-shadow: 0 10px 20px rgba(0,0,0,0.08); }
-        .gallery-item-card img { width: 100%; display: block; max-height: 600px; object-fit: cover; object-position: top; opacity: 0; transition: opacity 0.5s ease; }
+        .gallery-item-card img { width: 100%; height: auto; display: block; max-height: 600px; object-fit: cover; object-position: top; opacity: 0; transition: opacity 0.5s ease; }
         .gallery-item-card img.loaded { opacity: 1; }
         .card-meta { display: flex; justify-content: space-between; align-items: center; margin-top: 8px; padding: 0 4px; }
         .file-size { font-size: 10px; color: #ccc; }
@@ -143,11 +197,11 @@ $total_pages = max(1, (int)ceil($total_files / $items_per_page));
 <div class="main-content-area">
     <div id="gallery-container" class="gallery-grid">
         <?php
-        if (empty($paged_files)) {
+        if (empty($paged_items)) {
             echo '<p style="color:#999; font-size:12px;">' . esc_html($t['empty']) . '</p>';
         } else {
-            foreach ($paged_files as $fn) {
-                penc_render_card($fn, $t);
+            foreach ($paged_items as $item) {
+                penc_render_card($item, $t);
             }
         }
         ?>
@@ -205,6 +259,11 @@ document.addEventListener("DOMContentLoaded", function() {
         entries.forEach(entry => {
             if (!entry.isIntersecting) return;
             const img = entry.target;
+            const pic = img.parentElement;
+            if (pic && pic.tagName === 'PICTURE') {
+                pic.querySelectorAll('source[data-srcset]').forEach(s => { s.srcset = s.dataset.srcset; });
+            }
+            if (img.dataset.srcset) img.srcset = img.dataset.srcset;
             img.src = img.dataset.src;
             img.onload = () => { img.classList.add('loaded'); debouncedLayout(); };
             observer.unobserve(img);